@@ -0,0 +1,112 @@
+import argparse
+import logging
+import numpy as np
+import os
+import pandas as pd
+import platform
+import tempfile
+import time
+
+import loading_data as loader
+import subject_level_stats as stats
+import synthetic_data
+
+from datetime import datetime
+from instrumentation import PeakMemory
+from preprocessing import preprocessing_pipeline
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('BenchmarkLogger')
+
+BENCHMARK_PARAMETERS = {'alpha': 1 / 50, 'minimum_n_cutoff': 20, 'time_window_for_baseline': -100,
+                        'window_start': 1000, 'window_end': 2000, 'metrics_search_start': 0,
+                        'metrics_search_end': 500}
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.csv')
+
+
+# Scaling benchmarks of the analysis pipeline on synthetic data
+def measure(function, *args, **kwargs):
+    """
+    Runs function and returns its result with the wall time, cpu time, the peak resident memory of the process
+    during the run and the increase of the peak over the memory at the start (worker processes are not included)
+    """
+    with PeakMemory() as memory:
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        result = function(*args, **kwargs)
+        wall_time, cpu_time = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    return result, {'wall_time': wall_time, 'cpu_time': cpu_time, 'peak_memory_mb': memory.peak / 2 ** 20,
+                    'memory_increase_mb': (memory.peak - memory.start) / 2 ** 20}
+
+
+def benchmark_stages(directory, n_subjects, n_sessions=1, n_trials=200, seed=0, n_workers=1):
+    """
+    Generates a synthetic data set of n_subjects in directory and measures every stage of the pipeline:
+    data generation, load_all_data (without cache), preprocessing_pipeline and run_inhibition_subjects
+    (on the successful trials). Returns one row per stage.
+    """
+    rows = []
+
+    def record(stage, measurement, n_rows):
+        rows.append({'stage': stage, 'n_rows': n_rows, **measurement})
+        logger.info(f'{stage} with {n_subjects} subjects: {measurement["wall_time"]:.3f} s, '
+                    f'{measurement["peak_memory_mb"]:.1f} MB.')
+
+    path_names, measurement = measure(synthetic_data.write_jatos_export, directory, n_subjects=n_subjects,
+                                      n_sessions=n_sessions, n_trials=n_trials, seed=seed)
+    record('generate', measurement, np.nan)
+
+    data, measurement = measure(loader.load_all_data, path_names, n_workers=n_workers, use_cache=False)
+    record('load_all_data', measurement, len(data))
+    del data
+
+    outputs, measurement = measure(preprocessing_pipeline, path_names['out_file'])
+    trial_data = outputs[3]
+    record('preprocessing_pipeline', measurement, len(trial_data))
+    del outputs
+
+    successful_trials = trial_data[trial_data.success == 1]
+    (rates, metrics, errors), measurement = measure(stats.run_inhibition_subjects, successful_trials,
+                                                    BENCHMARK_PARAMETERS, n_workers=n_workers)
+    record('run_inhibition_subjects', measurement, len(successful_trials))
+    if len(errors) > 0:
+        logger.warning(f'{len(errors)} subjects failed in the benchmark.')
+    return rows
+
+
+def run_benchmarks(subject_counts=(10, 100, 1000), n_sessions=1, n_trials=200, seed=0, n_workers=1,
+                   results_file=RESULTS_FILE, label=''):
+    """
+    Runs benchmark_stages for every number of subjects (each in a temporary directory) and appends the results
+    with a timestamp, the label and the library versions to results_file, so that runs can be compared over time.
+    Returns the results of this run.
+    """
+    run = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'label': label,
+           'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+           'n_sessions': n_sessions, 'n_trials': n_trials, 'n_workers': n_workers}
+    results = []
+    for n_subjects in subject_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            for row in benchmark_stages(directory, n_subjects, n_sessions, n_trials, seed, n_workers):
+                results.append({**run, 'n_subjects': n_subjects, **row})
+    results = pd.DataFrame(results)
+    results.to_csv(results_file, mode='a', header=not os.path.exists(results_file), index=False)
+    logger.info(f'saved benchmark results to {results_file}.')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scaling benchmark of the manual inhibition analysis')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_FILE)
+    parser.add_argument('--label', default='')
+    arguments = parser.parse_args()
+    benchmark = run_benchmarks(arguments.subjects, arguments.sessions, arguments.trials, arguments.seed,
+                               arguments.workers, arguments.results, arguments.label)
+    print(benchmark[['n_subjects', 'stage', 'n_rows', 'wall_time', 'cpu_time', 'peak_memory_mb',
+                     'memory_increase_mb']].to_string())
@@ -0,0 +1,210 @@
+import helper_funcs as helper
+import logging
+import numpy as np
+import pandas as pd
+import ragged
+import subject_level_stats as stats
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('BootstrapLogger')
+
+# the 9 conditions in the order of the rates of OneSubjectInhibition, with their flash x jump cells
+CONDITION_CELLS = {stats.condition_name(flash, jump): stats.condition_cells(flash, jump)
+                   for flash in [None, 0, 1] for jump in [None, 0, 1]}
+CONDITIONS = [name for name in stats.empty_property_array if name in CONDITION_CELLS]
+
+
+# Library for bootstrap confidence bands of movement rates and dip metrics
+def bootstrap_subject(subject, n_resamples=1000, seed=None, chunk_size=100, n_workers=1, confidence=0.95,
+                      null_condition='no_flash_no_shift', mask_rate=True, normalization='per_window',
+                      metrics_normalization='null_condition'):
+    """
+    Bootstrap of the rates and metrics of one OneSubjectInhibition (with preprocessed_trial_data set).
+    Trials are resampled with replacement within each flash x jump cell, so every condition keeps its number
+    of trials. The rates are linear in the drawn trials: a resample weights the binned onset inputs and the
+    windows of the trials with how often they were drawn, and the rates of a chunk of resamples are filtered at once
+    (see helper.kernel_sum_from_inputs).
+    Chunks of chunk_size resamples get independent seeds derived from seed, so the result does not depend on
+    n_workers. The resampled curves are kept as float32 (n_resamples x 9 conditions x time per curve type).
+    Returns the percentile bands of the rates (one row per condition and time point) and of the metrics (one row
+    per condition and metric).
+    """
+    start = time.perf_counter()
+    inputs = resampling_inputs(subject)
+    options = {'null_condition': null_condition, 'mask_rate': mask_rate, 'normalization': normalization,
+               'metrics_normalization': metrics_normalization}
+    resamples = run_resampling(_resample_trials, (inputs, options), n_resamples, seed, chunk_size, n_workers)
+    logger.info(f'{n_resamples} trial resamples of subject {subject.prolific_id} took '
+                f'{time.perf_counter() - start:.3f} s.')
+    return (curve_bands(resamples, ['rate', 'normalized_null_condition_rate'], CONDITIONS, subject.scale,
+                        confidence),
+            metric_bands(resamples, CONDITIONS, confidence))
+
+
+def bootstrap_subjects(rates, n_resamples=1000, seed=None, chunk_size=100, n_workers=1, confidence=0.95,
+                       column='normalized_null_condition_rate', search_start=0, search_end=500):
+    """
+    Bootstrap of the group mean curves: subjects of a tidy rates frame (see stats.run_inhibition_subjects)
+    are resampled with replacement, the mean curves of a chunk of resamples are one matrix product.
+    search_start and search_end are the time points between which the metrics are computed.
+    Returns the percentile bands of the mean curves and of the metrics of the mean curves.
+    """
+    start = time.perf_counter()
+    subjects, conditions, scale, curves = stats.stack_rates_frame(rates, column)
+    search = np.where((scale >= search_start) & (scale < search_end))[0]
+    inputs = {'curves': curves, 'scale': scale, 'search': (search[0], search[-1] + 1), 'column': column}
+    resamples = run_resampling(_resample_subjects, (inputs,), n_resamples, seed, chunk_size, n_workers)
+    logger.info(f'{n_resamples} resamples of {len(subjects)} subjects took {time.perf_counter() - start:.3f} s.')
+    return (curve_bands(resamples, [column], list(conditions), scale, confidence),
+            metric_bands(resamples, list(conditions), confidence))
+
+
+def resampling_inputs(subject):
+    """
+    Everything a trial resample needs, computed once: the cell of every trial, the onset inputs with the trial
+    of every onset (see helper.onset_steps) and the windows of the trials
+    """
+    data = subject.preprocessed_trial_data
+    onsets = ragged.get_ragged(data, 'touchOnTime_to_trialOnTime_to_flashOnTime_aligned')
+    steps, input_a, input_b, in_scale = helper.onset_steps(onsets.values, subject.scale, subject.alpha)
+    return {
+        'trial_cells': 2 * data['flashShown'].to_numpy(dtype=int) + data['stimJumped'].to_numpy(dtype=int),
+        'onset_trials': onsets.row_ids[in_scale],
+        'steps': steps,
+        'input_a': input_a,
+        'input_b': input_b,
+        'window_starts': data['trialOnTime_to_trialOnTime_to_flashOnTime_aligned'].to_numpy(dtype=float),
+        'window_ends': data['trialEndTime_to_trialOnTime_to_flashOnTime_aligned'].to_numpy(dtype=float),
+        'scale': subject.scale,
+        'alpha': subject.alpha,
+        'minimum_n_cutoff': subject.minimum_n_cutoff,
+        'time_window_for_baseline': subject.time_window_for_baseline,
+        'search': (subject.metrics_search_start[0], subject.metrics_search_end[0]),
+    }
+
+
+def run_resampling(chunk_function, arguments, n_resamples, seed, chunk_size, n_workers):
+    """
+    Runs chunk_function(*arguments, n_resamples_of_chunk, seed_sequence) for all chunks, in a process pool if
+    n_workers > 1, and concatenates the resulting arrays along the first (resample) axis
+    """
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if n_workers > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(chunk_function, *[repeat(argument) for argument in arguments], sizes, seeds))
+    else:
+        results = [chunk_function(*arguments, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+    return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+
+
+def _resample_trials(inputs, options, n_resamples, seed_sequence):
+    """
+    Rates, normalized rates and metrics of n_resamples trial resamples (resamples x conditions (x time))
+    """
+    rng = np.random.default_rng(seed_sequence)
+    trial_cells = inputs['trial_cells']
+    scale = inputs['scale']
+    n_scale = len(scale)
+
+    # how often every trial is drawn, resampled within its cell
+    counts = np.zeros((n_resamples, len(trial_cells)))
+    for cell in range(4):
+        trials = np.where(trial_cells == cell)[0]
+        if len(trials) > 0:
+            counts[:, trials] = rng.multinomial(len(trials), np.full(len(trials), 1 / len(trials)), size=n_resamples)
+    resample_cells = 4 * np.arange(n_resamples)[:, np.newaxis] + trial_cells
+
+    # onset inputs and trial windows weighted by the counts, per resample and cell
+    keys = (resample_cells[:, inputs['onset_trials']] * n_scale + inputs['steps']).ravel()
+    onset_counts = counts[:, inputs['onset_trials']].ravel()
+    inputs_a = np.bincount(keys, weights=onset_counts * np.tile(inputs['input_a'], n_resamples),
+                           minlength=n_resamples * 4 * n_scale).reshape(n_resamples, 4, n_scale)
+    inputs_b = np.bincount(keys, weights=onset_counts * np.tile(inputs['input_b'], n_resamples),
+                           minlength=n_resamples * 4 * n_scale).reshape(n_resamples, 4, n_scale)
+    kernel_sums = helper.kernel_sum_from_inputs(inputs_a, inputs_b, inputs['alpha'])
+    coverage = helper.trials_per_window(np.tile(inputs['window_starts'], n_resamples),
+                                        np.tile(inputs['window_ends'], n_resamples), scale,
+                                        groups=resample_cells.ravel(), n_groups=n_resamples * 4,
+                                        weights=counts.ravel()).reshape(n_resamples, 4, n_scale)
+
+    # conditions are sums of cells
+    cell_matrix = np.array([np.isin(np.arange(4), CONDITION_CELLS[name]) for name in CONDITIONS], dtype=float)
+    n_trials = cell_matrix @ np.bincount(trial_cells, minlength=4)
+    kernel_sums = np.einsum('ck,rkt->rct', cell_matrix, kernel_sums)
+    if options['normalization'] == 'per_window':
+        rates = kernel_sums * 1000 / np.maximum(np.einsum('ck,rkt->rct', cell_matrix, coverage), 1)
+    elif options['normalization'] == 'uniform':
+        rates = kernel_sums * 1000 / n_trials[:, np.newaxis]
+    else:
+        raise ValueError('Unknown normalization argument. '
+                         'Use "per_window" or "uniform"')
+    if options['mask_rate']:
+        rates = rates * (n_trials > inputs['minimum_n_cutoff'])[:, np.newaxis]
+
+    null_rates = rates[:, [CONDITIONS.index(options['null_condition'])]].copy()
+    null_rates[null_rates <= 1] = 1
+    normalized_null_condition_rates = rates / null_rates
+    if options['metrics_normalization'] == 'null_condition':
+        metric_curves = normalized_null_condition_rates
+    elif options['metrics_normalization'] == 'baseline':
+        in_baseline = (scale < 0) & (scale > inputs['time_window_for_baseline'])
+        metric_curves = rates / rates[..., in_baseline].mean(axis=-1, keepdims=True)
+    elif options['metrics_normalization'] == 'none':
+        metric_curves = rates
+    else:
+        raise ValueError(f'The normalization argument {options["metrics_normalization"]} is not known. '
+                         f'Please use "null_condition" (default), "baseline", "none"')
+
+    metrics = stats.compute_metrics(metric_curves, scale, *inputs['search'])
+    return {'rate': rates.astype(np.float32),
+            'normalized_null_condition_rate': normalized_null_condition_rates.astype(np.float32),
+            **metrics}
+
+
+def _resample_subjects(inputs, n_resamples, seed_sequence):
+    """
+    Mean curves and their metrics of n_resamples subject resamples
+    """
+    rng = np.random.default_rng(seed_sequence)
+    curves = inputs['curves']
+    n_subjects = len(curves)
+    weights = rng.multinomial(n_subjects, np.full(n_subjects, 1 / n_subjects), size=n_resamples) / n_subjects
+    mean_curves = np.einsum('rs,sct->rct', weights, curves)
+    metrics = stats.compute_metrics(mean_curves, inputs['scale'], *inputs['search'])
+    return {inputs['column']: mean_curves.astype(np.float32), **metrics}
+
+
+def percentiles(confidence):
+    return [100 * (1 - confidence) / 2, 50, 100 * (1 + confidence) / 2]
+
+
+def curve_bands(resamples, columns, conditions, scale, confidence=0.95):
+    """
+    Percentile bands of resampled curves (resamples x conditions x time), one row per condition and time point
+    """
+    bands = {'condition': np.repeat(conditions, len(scale)), 'time': np.tile(scale, len(conditions))}
+    for column in columns:
+        lower, median, upper = np.percentile(resamples[column], percentiles(confidence), axis=0)
+        bands[f'{column}_lower'] = lower.ravel()
+        bands[f'{column}_median'] = median.ravel()
+        bands[f'{column}_upper'] = upper.ravel()
+    return pd.DataFrame(bands)
+
+
+def metric_bands(resamples, conditions, confidence=0.95):
+    """
+    Percentile bands of resampled metrics (resamples x conditions), one row per condition and metric
+    """
+    rows = []
+    for metric in ['minimum', 'magnitude', 'bottom', 'latency']:
+        lower, median, upper = np.percentile(resamples[metric], percentiles(confidence), axis=0)
+        rows.append(pd.DataFrame({'condition': conditions, 'metric': metric,
+                                  'lower': lower, 'median': median, 'upper': upper}))
+    return pd.concat(rows, ignore_index=True)
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('DataCacheLogger')
+
+
+# Library for caching combined data frames, validated by the content of their inputs
+def file_digest(file, size=None, block_size=1 << 20):
+    """
+    sha256 of the content of a file, read in blocks. With size, only the first size bytes are hashed.
+    """
+    digest = hashlib.sha256()
+    remaining = size
+    with open(file, 'rb') as f:
+        while remaining is None or remaining > 0:
+            block = f.read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+def input_digests(path_names, rules_file):
+    """
+    Content hashes of all inputs of load_all_data: source, extra file, questionnaire, correction rules
+    and every incomplete file
+    """
+    return {'source': file_digest(path_names['source']),
+            'extra': file_digest(path_names['extra']),
+            'extra_questions': file_digest(path_names['extra_questions']),
+            'correction_rules': file_digest(rules_file),
+            'incomplete': {file: file_digest(os.path.join(path_names['incomplete'], file))
+                           for file in sorted(os.listdir(path_names['incomplete']))}}
+
+
+def ingest_ledger(path_names, digests):
+    """
+    Record of the ingested data: the number of bytes read from each JATOS result file with the digest of these bytes,
+    and the digest of every incomplete file
+    """
+    return {'source': {'offset': os.path.getsize(path_names['source']), 'digest': digests['source']},
+            'extra': {'offset': os.path.getsize(path_names['extra']), 'digest': digests['extra']},
+            'incomplete': dict(digests['incomplete'])}
+
+
+def appended_offset(file, ledger_entry):
+    """
+    Returns the offset from which the file has to be read if data was only appended since the last ingestion,
+    None if the ingested part of the file changed
+    """
+    offset = ledger_entry['offset']
+    if os.path.getsize(file) < offset or file_digest(file, size=offset) != ledger_entry['digest']:
+        return None
+    return offset
+
+
+def cache_paths(path_names):
+    """
+    Location of the cached frame and its manifest. Defaults to the out file with a different extension.
+    """
+    cache_file = path_names.get('cache_file') or os.path.splitext(path_names['out_file'])[0] + '.parquet'
+    return cache_file, cache_file + '.manifest.json'
+
+
+def read_manifest(manifest_file):
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_manifest(manifest, manifest_file):
+    # write to a temporary file first, so that an interrupted run never leaves a valid-looking manifest
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def cached_parts_description(manifest_file, digests):
+    """
+    Row count, files, row counts and content hashes of the parts of the cached data set if its manifest matches
+    the digests of the current inputs, None otherwise. The data set of an incremental run (base and appended parts)
+    has another row order than a full rebuild from the same inputs.
+    """
+    manifest = read_manifest(manifest_file)
+    if manifest is None or 'parts' not in manifest or manifest['inputs'] != digests:
+        return None
+    return {'n_rows': manifest['n_rows'],
+            'parts': [[part['file'], part.get('n_rows'), part.get('digest')] for part in manifest['parts']]}
+
+
+def load_cached_frame(cache_file, manifest, digests):
+    """
+    Returns the cached frame if the manifest matches the digests of the current inputs, None otherwise
+    """
+    if manifest is None or 'parts' not in manifest:
+        logger.info('No cache found.')
+        return None
+    if manifest['inputs'] != digests:
+        changed = [key for key in digests if manifest['inputs'].get(key) != digests[key]]
+        logger.info(f'The cache is outdated, changed inputs: {changed}.')
+        return None
+    return read_cached_parts(cache_file, manifest)
+
+
+def read_cached_parts(cache_file, manifest):
+    """
+    Reads and combines all parts of the cached data set
+    """
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        data = pd.concat([read_frame(os.path.join(cache_dir, part['file']), part['format'], part['json_columns'],
+                                     part.get('dtypes'))
+                          for part in manifest['parts']], ignore_index=True)
+    except FileNotFoundError:
+        logger.info('A part of the cache is missing.')
+        return None
+    logger.info(f"Loaded {data.shape} from cache {cache_file} ({len(manifest['parts'])} parts).")
+    return data
+
+
+def save_cached_frame(data, cache_file, manifest_file, digests, ledger):
+    """
+    Replaces the cache with a single part holding the full data set
+    """
+    _remove_parts(cache_file, read_manifest(manifest_file))
+    part = _write_part(data, cache_file)
+    write_manifest({'inputs': digests, 'ledger': ledger, 'parts': [part], 'n_rows': len(data)}, manifest_file)
+    logger.info(f"Saved {data.shape} to cache {cache_file} ({part['format']}).")
+
+
+def append_cached_frame(new_data, cache_file, manifest_file, manifest, digests, ledger):
+    """
+    Writes new rows as an additional part of the cache, the existing parts are not touched
+    """
+    root, extension = os.path.splitext(cache_file)
+    part = _write_part(new_data, f"{root}_part{len(manifest['parts']):03d}{extension}")
+    write_manifest({'inputs': digests, 'ledger': ledger, 'parts': manifest['parts'] + [part],
+                    'n_rows': manifest['n_rows'] + len(new_data)}, manifest_file)
+    logger.info(f'Appended {new_data.shape} to cache {cache_file} as {part["file"]}.')
+
+
+def _write_part(data, file):
+    file_format, json_columns = write_frame(data, file)
+    return {'file': os.path.basename(file), 'format': file_format, 'json_columns': json_columns,
+            'dtypes': frame_dtypes(data), 'n_rows': len(data), 'digest': file_digest(file)}
+
+
+def _remove_parts(cache_file, manifest):
+    if manifest is None or 'parts' not in manifest:
+        return
+    cache_dir = os.path.dirname(cache_file)
+    for part in manifest['parts']:
+        try:
+            os.remove(os.path.join(cache_dir, part['file']))
+        except FileNotFoundError:
+            pass
+
+
+def write_frame(data, file):
+    """
+    Writes a frame to a typed, columnar parquet file. List columns are stored as parquet lists.
+    Object columns with mixed content (e.g. strings and lists) are stored as json strings.
+    Falls back to pickle if pyarrow is not installed.
+    Returns the format and the names of the json encoded columns.
+    """
+    if pa is None:
+        logger.warning('pyarrow is not installed, caching as pickle instead of parquet.')
+        data.to_pickle(file)
+        return 'pickle', []
+
+    data = data.reset_index(drop=True)
+    json_columns = []
+    for column in data.columns[data.dtypes == object]:
+        try:
+            pa.array(data[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            data[column] = [_to_json(value) for value in data[column]]
+            json_columns.append(column)
+    data.to_parquet(file, engine='pyarrow', index=False)
+    return 'parquet', json_columns
+
+
+def read_frame(file, file_format='parquet', json_columns=(), dtypes=None):
+    """
+    Reads a frame written with write_frame. With dtypes (see frame_dtypes), the frame gets the types it was
+    written with (see restore_dtypes).
+    """
+    if file_format == 'pickle':
+        return pd.read_pickle(file)
+
+    data = pd.read_parquet(file, engine='pyarrow')
+    for column in data.columns:
+        if column in json_columns:
+            data[column] = [json.loads(value) if isinstance(value, str) else value for value in data[column]]
+        elif data[column].dtype == object:
+            # parquet lists are returned as numpy arrays, the rest of the analysis works on lists
+            data[column] = [value.tolist() if hasattr(value, 'tolist') else value for value in data[column]]
+    return restore_dtypes(data, dtypes) if dtypes else data
+
+
+def frame_dtypes(data):
+    """
+    The pandas types of the columns of a frame, to be stored with the frame
+    """
+    return {column: str(dtype) for column, dtype in data.dtypes.items()}
+
+
+def restore_dtypes(data, dtypes):
+    """
+    Parquet stores columns without values (or object columns of numbers, e.g. subject) with a different type,
+    and missing values of object columns (e.g. list columns) as None. Both are restored to how the frame was
+    written: object columns with nan for missing values.
+    """
+    for column, dtype in dtypes.items():
+        if dtype == 'object':
+            values = data[column].astype(object)
+            data[column] = values.where(values.notna(), np.nan)
+        elif str(data[column].dtype) != dtype:
+            data[column] = data[column].astype(dtype)
+    return data
+
+
+def _to_json(value):
+    if isinstance(value, float) and value != value:
+        return None
+    return json.dumps(value, default=_json_default)
+
+
+def _json_default(value):
+    # numpy scalars and arrays
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
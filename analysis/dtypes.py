@@ -0,0 +1,84 @@
+import logging
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('DtypeLogger')
+
+# strings that repeat on every row of a subject, session or experiment part
+CATEGORICAL_COLUMNS = ['prolific_id', 'session_id', 'study_id', 'component', 'trial_type', 'test_part',
+                       'userInfo', 'condition']
+# trial outcomes and conditions that are 0/1 on every trial
+FLAG_COLUMNS = ['success', 'flashShown', 'stimJumped', 'lateResponse', 'orderResponse', 'tooManyTouches',
+                'screenInLandscape']
+
+
+# Library for memory lean column types of the experiment data
+def read_csv(file_name, categorical_columns=CATEGORICAL_COLUMNS, **kwargs):
+    """
+    Reads a data file with the repeated strings as categoricals, so that they are never stored once per row
+    """
+    return pd.read_csv(file_name, dtype={col: 'category' for col in categorical_columns}, **kwargs)
+
+
+def as_csv_types(data):
+    """
+    A copy of a loaded data frame (see loading_data.load_all_data) with the types it has when it is read back from
+    the out file: object columns of numbers or booleans get their numeric type, and the cells of other object
+    columns (e.g. lists, or dicts of the questionnaire) become the strings the out file holds.
+    Categorical columns are kept.
+    """
+    data = data.copy(deep=False)
+    for col in data.columns[data.dtypes == object]:
+        column = data[col].infer_objects()
+        if column.dtype == object:
+            column = column.map(lambda cell: cell if isinstance(cell, str) or _is_missing(cell) else str(cell))
+        data[col] = column
+    return data
+
+
+def _is_missing(cell):
+    return pd.api.types.is_scalar(cell) and pd.isna(cell)
+
+
+def optimize_dtypes(data, categorical_columns=CATEGORICAL_COLUMNS, flag_columns=FLAG_COLUMNS, report=True):
+    """
+    Converts the columns of data in place and returns data:
+    repeated strings become categoricals (unused categories of a subset are removed) and the flag columns become
+    int8 if they only hold 0 and 1. Other numeric columns keep their type, even if a subset only holds 0 and 1
+    (e.g. session_number), so that the types do not depend on the rows.
+    Times and coordinates keep float64: absolute timestamps are too large for float32 and all downstream
+    computations give identical results only with the original precision.
+    """
+    before = memory_usage(data) if report else None
+    for col in data.columns:
+        column = data[col]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            data[col] = column.cat.remove_unused_categories()
+        elif col in categorical_columns and column.dtype == object:
+            data[col] = column.astype('category')
+        elif col in flag_columns and is_flag_column(column):
+            data[col] = column.astype(np.int8)
+    if report:
+        logger.info(f'optimized the column types of {data.shape[0]} rows: {before:.1f} MB -> '
+                    f'{memory_usage(data):.1f} MB')
+    return data
+
+
+def is_flag_column(column):
+    """
+    Numeric columns that only contain 0 and 1 (without missing values)
+    """
+    if column.dtype == np.int8 or not pd.api.types.is_numeric_dtype(column.dtype) \
+            or pd.api.types.is_bool_dtype(column.dtype):
+        return False
+    return bool(column.isin([0, 1]).all())
+
+
+def memory_usage(data):
+    """
+    Memory of a data frame in MB, including the contents of object columns
+    """
+    return data.memory_usage(deep=True).sum() / 2 ** 20
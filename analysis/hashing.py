@@ -0,0 +1,13 @@
+import hashlib
+import inspect
+
+
+# Library for digests of code, shared by the data cache and the stage cache
+def code_digest(functions):
+    """
+    sha256 of the source code of functions (or classes, modules)
+    """
+    digest = hashlib.sha256()
+    for function in functions:
+        digest.update(inspect.getsource(function).encode())
+    return digest.hexdigest()
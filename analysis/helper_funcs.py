@@ -1,6 +1,7 @@
 import json
 import numpy as np
 import pandas as pd
+import ragged
 
 
 def clean_dataframe(data):
@@ -56,7 +57,7 @@ def align_to_multiple_values(data, column, multi_value_column):
     return data
 
 
-def causal_rate(move_onset, lock_window_start, lock_window_end, n_trials, alpha=1 / 50):
+def causal_rate(move_onset, lock_window_start, lock_window_end, n_trials, alpha=1 / 50, method='recursive'):
     """
 
      analyse rate in causal time window
@@ -65,6 +66,8 @@ def causal_rate(move_onset, lock_window_start, lock_window_end, n_trials, alpha=
                lock_window_start  - window before lock
                lock_window_end  - window after lock
                n_trials      - number of trials
+               method        - 'recursive' (default, O(onsets + time), see causal_kernel_sum) or
+                               'reference' (evaluates the kernel on all onsets at every time point)
 
      output:   rate    - movement rate
                scale   - time axis
@@ -79,6 +82,13 @@ def causal_rate(move_onset, lock_window_start, lock_window_end, n_trials, alpha=
     elif len(n_trials) != len(scale):
         raise ValueError('n_trials must have the same as the length of -lock_window_start:lock_window_end!'
                          f'But has length {len(n_trials)} instead of {len(scale)}')
+
+    if method == 'recursive':
+        rate = (causal_kernel_sum(move_onset, scale, alpha) * 1000 / np.asarray(n_trials)).tolist()
+        return rate, scale
+    elif method != 'reference':
+        raise ValueError(f'Unknown method {method}. Use "recursive" or "reference"')
+
     # alpha defines how much the distribution is shifted
     alpha = alpha
     # define empty arrays for scale and rate
@@ -99,6 +109,99 @@ def causal_rate(move_onset, lock_window_start, lock_window_end, n_trials, alpha=
     return rate, scale
 
 
+def causal_kernel_sum(move_onset, scale, alpha=1 / 50):
+    """
+    Sum of the causal alpha kernels alpha**2 * tau * exp(-alpha * tau), tau = t - onset + 1 / alpha > 0,
+    of all onsets at every time t of the 1 ms scale. Exact, in O(onsets + time):
+    With A(t) = sum(exp(-alpha * tau)) and B(t) = sum(tau * exp(-alpha * tau)) over the onsets with tau > 0,
+    one step on the scale gives A(t+1) = d * A(t) and B(t+1) = d * (B(t) + A(t)), d = exp(-alpha).
+    Every onset enters at the first time step with tau > 0, binned with its exact tau at that step.
+    """
+    inputs_a, inputs_b = onset_inputs(move_onset, scale, alpha)
+    return kernel_sum_from_inputs(inputs_a, inputs_b, alpha)
+
+
+def kernel_sum_from_inputs(inputs_a, inputs_b, alpha=1 / 50):
+    """
+    Causal kernel sum from binned onset inputs (see onset_inputs). Works along the last axis, so that a stack of
+    inputs (e.g. resamples x time) is filtered at once.
+    """
+    kernel_a = exponential_filter(inputs_a, alpha)
+    previous_a = np.zeros_like(kernel_a)
+    previous_a[..., 1:] = kernel_a[..., :-1]
+    kernel_b = exponential_filter(np.exp(-alpha) * previous_a + inputs_b, alpha)
+    return alpha ** 2 * kernel_b
+
+
+def onset_steps(move_onset, scale, alpha=1 / 50):
+    """
+    Step of the scale at which the kernel of every onset starts (tau > 0), with exp(-alpha * tau) and
+    tau * exp(-alpha * tau) at that step. Onsets after the end of the scale are dropped, in_scale marks the kept ones.
+    """
+    move_onset = np.asarray(move_onset, dtype=float).flatten()
+    steps = np.maximum(np.floor(move_onset - 1 / alpha - scale[0]).astype(np.int64) + 1, 0)
+    in_scale = steps < len(scale)
+    steps = steps[in_scale]
+    tau = scale[steps] - move_onset[in_scale] + 1 / alpha
+    return steps, np.exp(-alpha * tau), tau * np.exp(-alpha * tau), in_scale
+
+
+def onset_inputs(move_onset, scale, alpha=1 / 50):
+    """
+    Bins onsets to the step of the scale at which their kernel starts (tau > 0).
+    Returns the binned exp(-alpha * tau) and tau * exp(-alpha * tau) at that step.
+    """
+    steps, input_a, input_b, _ = onset_steps(move_onset, scale, alpha)
+    inputs_a = np.bincount(steps, weights=input_a, minlength=len(scale))
+    inputs_b = np.bincount(steps, weights=input_b, minlength=len(scale))
+    return inputs_a, inputs_b
+
+
+def exponential_filter(inputs, alpha):
+    """
+    y[i] = exp(-alpha) * y[i - 1] + inputs[i] along the last axis, computed with cumulative sums in blocks
+    that keep the exponential scaling finite
+    """
+    inputs = np.asarray(inputs, dtype=float)
+    output = np.empty_like(inputs)
+    n_steps = inputs.shape[-1]
+    block = max(1, int(50 / alpha))
+    carry = np.zeros(inputs.shape[:-1])
+    for start in range(0, n_steps, block):
+        end = min(start + block, n_steps)
+        growth = np.exp(alpha * np.arange(end - start))
+        output[..., start:end] = (np.cumsum(inputs[..., start:end] * growth, axis=-1) +
+                                  carry[..., np.newaxis] * np.exp(-alpha)) / growth
+        carry = output[..., end - 1]
+    return output
+
+
+def trials_per_window(window_starts, window_ends, scale, groups=None, n_groups=1, weights=None):
+    """
+    Number of trials whose window covers each time point of the scale, i.e. the histogram of
+    np.arange(round(start), round(end)) over all trials (the last bin also counts scale[-1] + 1).
+    Counted with a difference array: +1 at the start and -1 at the end of every window, then a cumulative sum.
+    With groups (an integer label < n_groups per trial), one row of counts per group is returned.
+    With weights, every trial counts with its weight (e.g. how often it was drawn in a bootstrap resample).
+    """
+    n_bins = len(scale) + 1
+    starts = np.clip(np.round(np.asarray(window_starts, dtype=float)) - scale[0], 0, n_bins).astype(np.int64)
+    ends = np.clip(np.round(np.asarray(window_ends, dtype=float)) - scale[0], 0, n_bins).astype(np.int64)
+    if groups is None:
+        groups = np.zeros(len(starts), dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+
+    valid = ends > starts
+    group_offsets = groups[valid] * (n_bins + 1)
+    weights = None if weights is None else np.asarray(weights, dtype=float)[valid]
+    differences = np.bincount(group_offsets + starts[valid], weights=weights, minlength=n_groups * (n_bins + 1)) - \
+        np.bincount(group_offsets + ends[valid], weights=weights, minlength=n_groups * (n_bins + 1))
+    coverage = np.cumsum(differences.reshape(n_groups, n_bins + 1), axis=1)
+    counts = coverage[:, :len(scale)]
+    counts[:, -1] += coverage[:, len(scale)]
+    return counts if n_groups > 1 else counts[0]
+
+
 def load_strings(col, index, dtype):
     collected_array = np.array([json.loads(col[x]) for x in index], copy=False, dtype=dtype)
     if dtype == object:
@@ -112,69 +215,60 @@ def load_strings(col, index, dtype):
 def convert_string_to_array(trial_data):
     """
     Interative and hard-coded translation of string-based columns to numpy arrays
+    List columns (json strings or lists) are decoded in bulk with ragged.RaggedArray
     :param trial_data: the trial data frame from my manual inhibition experiment
     :return: None
     """
-    trial_data['animation_timestamps_list'] = load_strings(trial_data.animation_timestamps, trial_data.index, object)
-    trial_data['touchOn_list'] = load_strings(trial_data.touchOn, trial_data.index, object)
-    trial_data['touchOff_list'] = load_strings(trial_data.touchOff, trial_data.index, object)
-    trial_data['scheduled_eventOn_float'] = load_strings(trial_data.scheduled_change_onset, trial_data.index, float)
-    trial_data['eventOn_float'] = load_strings(trial_data.flashOnTime, trial_data.index, float)
-    trial_data['touchX_list'] = load_strings(trial_data.touchX, trial_data.index, object)
-    trial_data['touchY_list'] = load_strings(trial_data.touchY, trial_data.index, object)
-    trial_data['position_x_list'] = load_strings(trial_data.position_x, trial_data.index, object)
-    trial_data['position_y_list'] = load_strings(trial_data.position_y, trial_data.index, object)
-    trial_data['shifted_position_x_list'] = load_strings(trial_data.shifted_position_x, trial_data.index, object)
-    trial_data['shifted_position_y_list'] = load_strings(trial_data.shifted_position_y, trial_data.index, object)
+    for col in ['animation_timestamps', 'touchOn', 'touchOff', 'touchX', 'touchY', 'position_x', 'position_y',
+                'shifted_position_x', 'shifted_position_y']:
+        trial_data[f'{col}_list'] = ragged.RaggedArray.from_json_strings(trial_data[col]).to_lists()
+    # the first (only) value of the lists, json strings or lists as returned by loading_data.load_all_data
+    trial_data['scheduled_eventOn_float'] = ragged.get_ragged(trial_data, 'scheduled_change_onset').first()
+    trial_data['eventOn_float'] = ragged.get_ragged(trial_data, 'flashOnTime').first()
 
 
-def align_to_multiple_values_filter_first(data, column, multi_value_column):
-    aligned_list = []
+def align_to_multiple_values_filter_first(data, column, multi_value_column, reference=None, as_lists=True):
+    """
+    For every value in multi_value_column (e.g. touches), the distance to the first value in column
+    (e.g. animation frames) at or after it. Values without a later entry in column are skipped.
+    Computed for all trials at once with a binary search, see ragged.distance_to_next.
+    reference: the decoded column, if it is already at hand
+    as_lists: the result column holds python lists, otherwise arrays that share one buffer
+    """
     colname = "{}_to_{}".format(column, multi_value_column)
-    for idx in data.index:
-        index_list = []
-        for value in data.loc[idx, multi_value_column]:
-            aligned_values = [x - value for x in data.loc[idx, column]]
-            aligned_values = np.array(aligned_values)
-            aligned_values = aligned_values[aligned_values >= 0]
-            try:
-                index_list.append(min(aligned_values))
-            except ValueError:
-                pass
-        try:
-            index_list = np.concatenate(index_list)
-        except:
-            pass
-        aligned_list.append(index_list)
-    data[colname] = aligned_list
+    reference = ragged.get_ragged(data, column) if reference is None else reference
+    aligned = ragged.distance_to_next(reference, ragged.get_ragged(data, multi_value_column))
+    data[colname] = aligned.to_lists() if as_lists else aligned.to_arrays()
 
     return data
 
 
 def get_position_at_response_time(data, start_position_col, shift_position_col, response_time_col, change_time_col):
-    pos_at_touch = []
+    return positions_at_response_time(data, start_position_col, shift_position_col, response_time_col,
+                                      change_time_col).to_lists()
 
-    for idx in data.index:
-        touch_on = data[response_time_col][idx]
-        change_on = data[change_time_col][idx]
-        pos_before = data[start_position_col][idx]
-        pos_after = data[shift_position_col][idx]
-        if len(touch_on) < len(pos_before):
-            # not enough touches
-            pos_before = pos_before[:len(touch_on)]
-            pos_after = pos_after[:len(touch_on)]
-        elif len(touch_on) > len(pos_before):
-            # too many touches
-            touch_on = touch_on[:len(pos_before)]
 
-        mask_before = touch_on <= change_on
-        masked_positions_before = np.array(pos_before)[mask_before]
-        masked_positions_after = np.array(pos_after)[np.where(mask_before == False)]
-        masked_positions = np.concatenate([masked_positions_before, masked_positions_after])
+def positions_at_response_time(data, start_position_col, shift_position_col, response_time_col, change_time_col):
+    """
+    Position of the dot of every touch: the start position if the touch was at or before the change time,
+    the shifted position otherwise. Touches and positions are truncated to the shorter of both
+    (not enough touches/too many touches). Within a trial, the positions of touches before the change come first.
+    Computed on the flat arrays of all trials, returns a ragged array.
+    """
+    touch_on = ragged.get_ragged(data, response_time_col)
+    pos_before = ragged.get_ragged(data, start_position_col)
+    pos_after = ragged.get_ragged(data, shift_position_col)
 
-        pos_at_touch.append(masked_positions.tolist())
+    n_touches = np.minimum(touch_on.lengths, pos_before.lengths)
+    touch_on = touch_on.truncate(n_touches)
+    pos_before = pos_before.truncate(n_touches)
+    pos_after = pos_after.truncate(n_touches)
 
-    return pos_at_touch
+    change_on = np.repeat(data[change_time_col].to_numpy(dtype=float), n_touches)
+    after_change = ~(touch_on.values <= change_on)
+    positions = np.where(after_change, pos_after.values, pos_before.values)
+    order = np.argsort(2 * touch_on.row_ids + after_change, kind='stable')
+    return ragged.RaggedArray(positions[order], touch_on.offsets, data.index)
 
 
 def subtract_arrays_missing_values(array_a, array_b):
@@ -188,6 +282,15 @@ def subtract_arrays_missing_values(array_a, array_b):
     return result
 
 
+def subtract_ragged_missing_values(ragged_a, ragged_b):
+    """
+    Trial-wise a - b of two ragged arrays, the longer trial is truncated to the length of the shorter
+    """
+    n_values = np.minimum(ragged_a.lengths, ragged_b.lengths)
+    ragged_a = ragged_a.truncate(n_values)
+    return ragged_a.with_values(ragged_a.values - ragged_b.truncate(n_values).values)
+
+
 def compute_distance_pythagoras(x1, x2, y1, y2):
     x_val = x1 - x2
     y_val = y1 - y2
@@ -205,8 +308,8 @@ def pythagoras(x_value, y_value):
 def cart2pol(x, y):
     radius = np.sqrt(x**2 + y**2)
     theta_rad = np.arctan2(y, x)
-    if theta_rad < 0:
-        theta_rad += 2 * np.pi
+    # map negative angles to [pi, 2 pi), works on arrays as well
+    theta_rad = theta_rad + 2 * np.pi * (theta_rad < 0)
     theta_dva = theta_rad * (180/np.pi)
     return radius, theta_rad, theta_dva
 
@@ -218,7 +321,8 @@ def pol2cart(radius, theta):
 
 
 def get_angles_from_list(x_distance, y_distance):
-    return [cart2pol(x_distance[x], y_distance[x])[2] for x in range(len(x_distance))]
+    return cart2pol(np.asarray(x_distance, dtype=float),
+                    np.asarray(y_distance, dtype=float)[:len(x_distance)])[2].tolist()
 
 
 def calibration_valid(params):
@@ -246,4 +350,46 @@ def smooth_array(array, time_array, smooth_before, smooth_after, time):
     end = time + smooth_after
     idx_1 = np.where(time_array >= start)
     idx_2 = np.where(time_array < end)
-    return np.mean(array[np.intersect1d(idx_1, idx_2)])
\ No newline at end of file
+    return np.mean(array[np.intersect1d(idx_1, idx_2)])
+
+
+def moving_average(arrays, time_array, smooth_before, smooth_after, times, groups=None, n_groups=1):
+    """
+    smooth_array for all times at once: the mean of the values with time in [time - smooth_before,
+    time + smooth_after), nan for empty windows or windows that contain a nan.
+    arrays: one or more value series (n_series x n_values) sharing time_array. The values are sorted by time once,
+    the window bounds are found with searchsorted and the window sums are differences of prefix sums,
+    O((n_values + n_times) log n_values).
+    With groups (an integer label < n_groups per value), the moving average of every group is returned
+    (n_groups x n_series x n_times).
+    """
+    arrays = np.atleast_2d(np.asarray(arrays, dtype=float))
+    time_array = np.asarray(time_array, dtype=float)
+    times = np.asarray(times, dtype=float)
+    if groups is None:
+        groups = np.zeros(len(time_array), dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+
+    order = np.lexsort((time_array, groups))
+    sorted_times = time_array[order]
+    sorted_arrays = arrays[:, order]
+    group_offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=n_groups), out=group_offsets[1:])
+
+    nan_values = np.isnan(sorted_arrays)
+    value_sums = np.zeros((len(arrays), len(time_array) + 1))
+    np.cumsum(np.where(nan_values, 0, sorted_arrays), axis=1, out=value_sums[:, 1:])
+    nan_counts = np.zeros((len(arrays), len(time_array) + 1), dtype=np.int64)
+    np.cumsum(nan_values, axis=1, out=nan_counts[:, 1:])
+
+    smoothed = np.full((n_groups, len(arrays), len(times)), np.nan)
+    for group in range(n_groups):
+        start, end = group_offsets[group], group_offsets[group + 1]
+        group_times = sorted_times[start:end]
+        lower = start + np.searchsorted(group_times, times - smooth_before, side='left')
+        upper = start + np.searchsorted(group_times, times + smooth_after, side='left')
+        n_values = upper - lower
+        valid = (n_values > 0) & (nan_counts[:, upper] == nan_counts[:, lower])
+        sums = value_sums[:, upper] - value_sums[:, lower]
+        smoothed[group][valid] = (sums / np.maximum(n_values, 1))[valid]
+    return smoothed if n_groups > 1 else smoothed[0]
\ No newline at end of file
@@ -0,0 +1,189 @@
+import cProfile
+import functools
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import resource
+import threading
+import time
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('InstrumentationLogger')
+
+# instrumentation is off unless enabled, e.g. with MANUAL_INHIBITION_INSTRUMENTATION=summary.jsonl
+settings = {'enabled': False, 'summary_file': None, 'profile_dir': None}
+records = []
+_active_profile = []
+
+
+# Library for opt-in timing and memory instrumentation of the analysis stages
+def enable(summary_file=None, profile_dir=None):
+    """
+    Turns on the instrumentation of all stages decorated with instrumented. Every stage call is logged and kept in
+    records; with summary_file, it is also appended as a json line. With profile_dir, every outermost stage call
+    is profiled with cProfile and dumped to profile_dir (nested stages are part of the profile of the outer stage).
+    """
+    settings.update({'enabled': True, 'summary_file': summary_file, 'profile_dir': profile_dir})
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def disable():
+    settings['enabled'] = False
+
+
+def instrumented(stage=None):
+    """
+    Decorator for a pipeline stage. Without enabled instrumentation, the stage is called directly.
+    """
+    def decorator(function):
+        name = stage or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not settings['enabled']:
+                return function(*args, **kwargs)
+            return _run_stage(name, function, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def _run_stage(name, function, args, kwargs):
+    rows_in = count_rows(list(args) + list(kwargs.values()))
+    profiler = None
+    if settings['profile_dir'] is not None and not _active_profile:
+        profiler = cProfile.Profile()
+        _active_profile.append(profiler)
+        profiler.enable()
+    error = None
+    result = None
+    memory = PeakMemory()
+    # the timers start before the memory sampling, so that a failure to start it is recorded with the times as well
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        with memory:
+            result = function(*args, **kwargs)
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        wall_time, cpu_time = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        # failed stages are recorded (and profiled) as well, with their error
+        if profiler is not None:
+            profiler.disable()
+            _active_profile.pop()
+        sampled = memory.start is not None and memory.peak is not None
+        record = {'stage': name, 'pid': os.getpid(), 'wall_time': wall_time, 'cpu_time': cpu_time,
+                  'rows_in': rows_in, 'rows_out': None if error else count_rows_out(result),
+                  'start_memory_mb': memory.start / 2 ** 20 if sampled else np.nan, 'error': error,
+                  'memory_growth_mb': (memory.peak - memory.start) / 2 ** 20 if sampled else np.nan}
+        if profiler is not None:
+            record['profile'] = os.path.join(settings['profile_dir'],
+                                             f'{name}_{os.getpid()}_{len(records):05d}.prof')
+            profiler.dump_stats(record['profile'])
+        _save_record(record)
+    return result
+
+
+def _save_record(record):
+    records.append(record)
+    logger.info(f"{record['stage']}: {record['wall_time']:.3f} s wall, {record['cpu_time']:.3f} s cpu, "
+                f"rows {record['rows_in']} -> {record['rows_out']}, "
+                f"memory growth {record['memory_growth_mb']:.1f} MB")
+    if settings['summary_file'] is not None:
+        with open(settings['summary_file'], 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def count_rows(values):
+    """
+    Rows of the first data frame in values, or of the trial data of the first object that has some
+    (e.g. a OneSubjectInhibition)
+    """
+    for value in values:
+        if isinstance(value, pd.DataFrame):
+            return len(value)
+    for value in values:
+        trial_data = getattr(value, 'preprocessed_trial_data', None)
+        if isinstance(trial_data, pd.DataFrame):
+            return len(trial_data)
+    return None
+
+
+def count_rows_out(result):
+    """
+    Rows of a resulting data frame, a list of rows for a tuple of results
+    """
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, tuple):
+        return [len(value) if isinstance(value, pd.DataFrame) else None for value in result]
+    return None
+
+
+def summary(stage_records=None):
+    """
+    Totals per stage: number of calls, wall and cpu time, maximal memory growth
+    """
+    stage_records = pd.DataFrame(records if stage_records is None else stage_records)
+    if stage_records.empty:
+        return stage_records
+    return stage_records.groupby('stage', sort=False).agg(
+        calls=('wall_time', 'size'), wall_time=('wall_time', 'sum'), cpu_time=('cpu_time', 'sum'),
+        max_memory_growth_mb=('memory_growth_mb', 'max')).sort_values('wall_time', ascending=False)
+
+
+def read_summary(summary_file):
+    """
+    Reads the records of a summary file (including records of worker processes)
+    """
+    with open(summary_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class PeakMemory:
+    """
+    Samples the resident memory of the process in a background thread while the context is active.
+    Unlike tracing allocations, sampling does not slow down the measured code.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start = self.peak = resident_memory()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, resident_memory())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, resident_memory())
+
+
+def resident_memory():
+    """
+    Resident memory of the process in bytes. Falls back to the peak so far where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+if os.environ.get('MANUAL_INHIBITION_INSTRUMENTATION'):
+    enable(summary_file=os.environ['MANUAL_INHIBITION_INSTRUMENTATION'],
+           profile_dir=os.environ.get('MANUAL_INHIBITION_PROFILE_DIR'))
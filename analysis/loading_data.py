@@ -1,25 +1,138 @@
+import csv
+import data_cache
+import dtypes
+import hashing
+import hashlib
+import json
 import logging
 import numpy as np
 import os
 import pandas as pd
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import instrumented
 
 logging.basicConfig(filename='manual_inhibition_analysis.log',
                     level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('DataLoadLogger')
 
+CORRECTION_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'correction_rules.json')
+CORRECTION_RULE_TYPES = ['set', 'fill_by_lookup', 'exclude']
+
+
+@instrumented()
+def load_all_data(path_names, n_workers=1, use_cache=True, incremental=False, optimize_memory=True):
+    """
+    Combines and corrects all raw data files. The result is cached in a columnar binary file, together with a
+    manifest of content hashes of all inputs. The cache is used as long as none of the inputs changed.
+    With incremental=True, result lines and incomplete files that were added since the last run are parsed,
+    corrected and appended to the cache, instead of rebuilding the full data set.
+    With optimize_memory, the returned data set stores repeated strings as categoricals and flags as int8
+    (see dtypes.optimize_dtypes); the cache and the out file are written with the original types.
+    """
+    cache_file, manifest_file = data_cache.cache_paths(path_names)
+    rules_file = path_names.get('correction_rules', CORRECTION_RULES_FILE)
+    if use_cache:
+        digests = data_cache.input_digests(path_names, rules_file)
+        manifest = data_cache.read_manifest(manifest_file)
+        full_data_corrected = data_cache.load_cached_frame(cache_file, manifest, digests)
+        if full_data_corrected is not None:
+            return _optimized(full_data_corrected, optimize_memory)
+        if incremental and manifest is not None and 'ledger' in manifest:
+            full_data_corrected = append_new_data(path_names, cache_file, manifest_file, manifest, digests,
+                                                  rules_file, n_workers=n_workers)
+            if full_data_corrected is not None:
+                return _optimized(full_data_corrected, optimize_memory)
 
-def load_all_data(path_names):
-    full_data_uncorrected = raw_jatosdata_to_csv(path_names['source'], path_names['incomplete'], path_names['extra'],
-                                                 path_names['extra_questions'], path_names['out_file'])
-    full_data_corrected = manual_file_correction(full_data_uncorrected)
+    full_data_uncorrected = combine_raw_data(path_names['source'], path_names['incomplete'], path_names['extra'],
+                                             path_names['extra_questions'], n_workers=n_workers)
+    full_data_corrected = manual_file_correction(full_data_uncorrected, rules_file)
     full_data_corrected.to_csv(path_names['out_file'], index=False)
     logger.info(f"data frames were combined and saved at {path_names['out_file']}")
+    if use_cache:
+        data_cache.save_cached_frame(full_data_corrected, cache_file, manifest_file, digests,
+                                     data_cache.ingest_ledger(path_names, digests))
+
+    return _optimized(full_data_corrected, optimize_memory)
+
+
+def _optimized(data, optimize_memory):
+    return dtypes.optimize_dtypes(data) if optimize_memory else data
+
+
+def data_digest(path_names, use_cache=True):
+    """
+    Digest of the data set that load_all_data returns for path_names, e.g. to cache the preprocessing of the
+    loaded data: the content hashes of all inputs, the source code of loading and caching and, with use_cache
+    (as passed to load_all_data, which has to run first), the parts of the cached data set that were returned
+    (see data_cache.cached_parts_description)
+    """
+    rules_file = path_names.get('correction_rules', CORRECTION_RULES_FILE)
+    digests = data_cache.input_digests(path_names, rules_file)
+    cached_parts = None
+    if use_cache:
+        cached_parts = data_cache.cached_parts_description(data_cache.cache_paths(path_names)[1], digests)
+    description = {'inputs': digests, 'cached_parts': cached_parts,
+                   'code': hashing.code_digest([sys.modules[__name__], data_cache])}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def append_new_data(path_names, cache_file, manifest_file, manifest, digests, rules_file=CORRECTION_RULES_FILE,
+                    n_workers=1):
+    """
+    Parses only the data that was added since the last ingestion: new lines of the JATOS result files
+    (read from the stored byte offset) and new incomplete files. The new rows are corrected and appended to the
+    cache and the out file. Returns the full data set, or None if already ingested data changed.
+    """
+    ledger = manifest['ledger']
+    source_offset = data_cache.appended_offset(path_names['source'], ledger['source'])
+    extra_offset = data_cache.appended_offset(path_names['extra'], ledger['extra'])
+    changed_files = [file for file in ledger['incomplete']
+                     if digests['incomplete'].get(file) != ledger['incomplete'][file]]
+    changed_inputs = [key for key in digests
+                      if key not in ['source', 'extra', 'incomplete'] and digests[key] != manifest['inputs'].get(key)]
+    if source_offset is None or extra_offset is None or changed_files or changed_inputs:
+        logger.info('Already ingested data was changed - rebuilding the full data set.')
+        return None
+
+    new_files = [file for file in digests['incomplete'] if file not in ledger['incomplete']]
+    new_data = pd.concat([load_rawjson(path_names['source'], offset=source_offset),
+                          load_json_from_path(path_names['incomplete'], n_workers=n_workers, file_names=new_files),
+                          load_rawjson(path_names['extra'], offset=extra_offset)],
+                         ignore_index=True)
+    logger.info(f'{len(new_data)} new rows were found ({len(new_files)} new incomplete files).')
+    new_data = manual_file_correction(new_data, rules_file)
+
+    data_cache.append_cached_frame(new_data, cache_file, manifest_file, manifest, digests,
+                                   data_cache.ingest_ledger(path_names, digests))
+    full_data_corrected = data_cache.read_cached_parts(cache_file, data_cache.read_manifest(manifest_file))
+    if not append_to_csv(new_data, path_names['out_file']):
+        full_data_corrected.to_csv(path_names['out_file'], index=False)
+    logger.info(f"new data was appended to {path_names['out_file']}")
 
     return full_data_corrected
 
 
-def raw_jatosdata_to_csv(source_file, incomplete_path, extra_file, extra_questions, destiny_file):
+def append_to_csv(new_data, csv_file):
+    """
+    Appends rows to an existing csv file in the order of its columns.
+    Returns False if the file does not exist or the new rows have columns that are not in the file.
+    """
+    try:
+        with open(csv_file, newline='') as f:
+            header = next(csv.reader(f))
+    except (FileNotFoundError, StopIteration):
+        return False
+    if not set(new_data.columns) <= set(header):
+        return False
+    new_data.reindex(columns=header).to_csv(csv_file, mode='a', header=False, index=False)
+    return True
+
+
+def raw_jatosdata_to_csv(source_file, incomplete_path, extra_file, extra_questions, destiny_file, n_workers=1):
     try:
         if os.path.getmtime(source_file) > os.path.getmtime(destiny_file) or os.path.getmtime(
                 extra_file) > os.path.getmtime(destiny_file):
@@ -31,9 +144,17 @@ def raw_jatosdata_to_csv(source_file, incomplete_path, extra_file, extra_questio
     except FileNotFoundError:
         logger.info('Creating a new data file from raw json.')
 
+    return combine_raw_data(source_file, incomplete_path, extra_file, extra_questions, n_workers=n_workers)
+
+
+@instrumented()
+def combine_raw_data(source_file, incomplete_path, extra_file, extra_questions, n_workers=1):
+    """
+    Loads the JATOS result files, the incomplete sessions and the extra questionnaire into one frame
+    """
     # load and append incomplete files
     source_to_pandas = load_rawjson(source_file)
-    incomplete_main = load_json_from_path(incomplete_path)
+    incomplete_main = load_json_from_path(incomplete_path, n_workers=n_workers)
     extra_to_pandas = load_rawjson(extra_file)
     extra_questionnaire = pd.read_csv(extra_questions)
     logger.info(f'data was imported from file {extra_questions}')
@@ -42,81 +163,208 @@ def raw_jatosdata_to_csv(source_file, incomplete_path, extra_file, extra_questio
     return source_to_pandas
 
 
-def load_rawjson(file):
-    data = {}
-    with open(file) as f:
-        # unpack the data
-        for ses, jf in enumerate(f):
-            # save it to a data frame
-            df = pd.read_json(jf)
-            try:
-                data = pd.concat([data, df], axis=0)
-            except:
-                data = df
+@instrumented()
+def load_rawjson(file, offset=0):
+    """
+    Loads a JATOS result file (one json array of trials per line) into a single data frame.
+    With offset, the file is read from this byte position on.
+    """
+    data = pd.concat(iter_rawjson_chunks(file, offset=offset), ignore_index=True)
     logger.info(f'data was imported from file: {file}.')
     return data
 
 
-def load_json_from_path(pathname):
-    data = pd.DataFrame()
+def iter_rawjson_chunks(file, chunk_size=None, offset=0):
+    """
+    Streams a JATOS result file and yields data frames with at most chunk_size rows.
+    Records are collected in column buffers and each frame is built only once.
+    With chunk_size=None, the whole file is returned as one frame.
+    """
+    buffers = {}
+    n_rows = 0
+    for record in iter_jatos_records(file, offset=offset):
+        _append_record(buffers, record, n_rows)
+        n_rows += 1
+        if n_rows == chunk_size:
+            yield _buffers_to_frame(buffers, n_rows)
+            buffers = {}
+            n_rows = 0
+    if n_rows > 0 or chunk_size is None:
+        yield _buffers_to_frame(buffers, n_rows)
+
+
+def iter_jatos_records(file, offset=0):
+    """
+    Yields the trial records of a JATOS result file one at a time, starting at the byte offset
+    """
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            records = json.loads(line)
+            if isinstance(records, dict):
+                records = [records]
+            for record in records:
+                yield record
+
+
+def _append_record(buffers, record, n_rows):
+    """
+    Appends one record to the column buffers. Columns missing in the record are filled with nan (as with
+    pd.read_json), columns that appear for the first time are padded for all previous rows.
+    """
+    for column, value in record.items():
+        if column not in buffers:
+            buffers[column] = [np.nan] * n_rows
+        buffers[column].append(value)
+    for values in buffers.values():
+        if len(values) == n_rows:
+            values.append(np.nan)
+
+
+def _buffers_to_frame(buffers, n_rows):
+    return pd.DataFrame({column: _infer_column(values) for column, values in buffers.items()},
+                        index=pd.RangeIndex(n_rows))
+
+
+def _infer_column(values):
+    """
+    Converts a column buffer to a series, numeric strings become numbers (as with pd.read_json)
+    """
+    column = pd.Series(values)
+    if pd.api.types.is_string_dtype(column.dtype):
+        try:
+            column = pd.to_numeric(column)
+        except (ValueError, TypeError):
+            pass
+    return column
 
-    for file in os.listdir(pathname):
-        df = pd.read_json(pathname + file)
-        data = pd.concat([data, df], ignore_index=True)
 
-    logger.info(f'data was imported from path: {pathname}.')
+@instrumented()
+def load_json_from_path(pathname, n_workers=1, file_names=None):
+    """
+    Loads all json files in a directory (or only file_names) and merges them in the order of their file names.
+    With n_workers > 1, the files are parsed in a process pool. Files that fail to parse are logged and skipped.
+    """
+    if file_names is None:
+        file_names = os.listdir(pathname)
+    file_names = sorted(file_names)
+    file_paths = [os.path.join(pathname, file) for file in file_names]
+
+    if n_workers > 1 and len(file_paths) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_parse_json_file, file_paths))
+    else:
+        results = [_parse_json_file(file_path) for file_path in file_paths]
+
+    frames = []
+    for file_path, df, parse_time, error in results:
+        if error is not None:
+            logger.error(f'could not parse {file_path}: {error}')
+            continue
+        logger.info(f'parsed {file_path} in {parse_time:.3f} s ({len(df)} rows).')
+        frames.append(df)
+
+    if frames:
+        data = pd.concat(frames, ignore_index=True)
+    else:
+        data = pd.DataFrame()
+
+    logger.info(f'data was imported from path: {pathname} '
+                f'({len(frames)} of {len(file_paths)} files).')
     return data
 
 
-def manual_file_correction(experiment_data):
+def _parse_json_file(file_path):
     """
-    This is a hardcoded and purely manual correction/data cleaning procedure
+    Parses a single json file. Returns the file path, the data frame, the parse time and a possible error message,
+    so that one broken file does not stop the others.
     """
-    # In this part of the manual correction, we add missing session numbers
-    missing_session_number = np.where(experiment_data.session_number.isnull() & experiment_data.success == 1)
-    missing_session_data = experiment_data.iloc[missing_session_number]
-    missing_session_data = missing_session_data[missing_session_data.trial_type == 'canvas-mi-serial']
-    logger.info(f'{len(missing_session_data)} trials with missing session data were found')
-    logger.info('comment from CK: this is because we hard-coded the parameters for trials that were repeated'
-                 'in extra session. For these trials I forgot to hard-code the session number.')
-    if len(missing_session_data) > 0:
-        session_3_id = missing_session_data[missing_session_data.trialID == 185].index
-        session_4_id = missing_session_data[missing_session_data.trialID == 8].index
+    start = time.perf_counter()
+    try:
+        df = pd.read_json(file_path)
+    except Exception as e:
+        return file_path, None, time.perf_counter() - start, repr(e)
+    return file_path, df, time.perf_counter() - start, None
 
-        experiment_data.loc[session_3_id, 'session_number'] = 3
-        experiment_data.loc[session_4_id, 'session_number'] = 4
-        logger.info('Missing session numbers were added manually')
 
-    # In this part of the manual correction, we add session and study ids
-    session_id_2 = '621fb3bfd880d8d0e1fd44ae'
-    session_id_3 = '622091b3a577c6d522b391cb'
-    session_id_4 = '6220e28a584f925fcdfc9ded'
+@instrumented()
+def manual_file_correction(experiment_data, rules_file=CORRECTION_RULES_FILE):
+    """
+    This is a manual correction/data cleaning procedure. The corrections (missing session numbers,
+    session and study ids, drop-outs) are listed in the rules file, see apply_correction_rules.
+    """
+    return apply_correction_rules(experiment_data, load_correction_rules(rules_file))
 
-    study_id_2 = '6216b9f6fa734c0a4acefab5'
-    study_id_3 = '6216bb63e6411c3f058a4480'
-    study_id_4 = '6216bbcec318b5df4e482581'
 
-    subject_data = experiment_data[experiment_data.prolific_id == '5ae0b548e0feeb0001cafc45']
+def load_correction_rules(rules_file):
+    with open(rules_file) as f:
+        rules = json.load(f)
+    unknown_rules = [rule.get('name') for rule in rules if rule.get('type') not in CORRECTION_RULE_TYPES]
+    if unknown_rules:
+        raise ValueError(f'The correction rules {unknown_rules} have an unknown type. '
+                         f'Please use one of {CORRECTION_RULE_TYPES}')
+    return rules
 
-    ids_2 = subject_data[subject_data.session_number == 2].index
-    ids_3 = subject_data[subject_data.session_number == 3].index
-    ids_4 = subject_data[subject_data.session_number == 4].index
 
-    experiment_data.loc[ids_2, 'session_id'] = session_id_2
-    experiment_data.loc[ids_3, 'session_id'] = session_id_3
-    experiment_data.loc[ids_4, 'session_id'] = session_id_4
+def apply_correction_rules(experiment_data, rules):
+    """
+    Applies a list of correction rules, in order, with vectorized masks:
+    set            - set the columns in "values" where all conditions in "where" hold
+    fill_by_lookup - fill "column" from the value of "key" (pairs in "lookup") where all conditions hold
+    exclude        - drop all rows in which "column" has one of "values"
+    Conditions are column == value (null: value is missing). The mask of every condition is computed once and only
+    recomputed if a rule wrote to its column. All exclusions are applied together at the end.
+    """
+    mask_cache = {}
+    exclude_mask = np.zeros(len(experiment_data), dtype=bool)
 
-    experiment_data.loc[ids_2, 'study_id'] = study_id_2
-    experiment_data.loc[ids_3, 'study_id'] = study_id_3
-    experiment_data.loc[ids_4, 'study_id'] = study_id_4
+    for rule in rules:
+        if rule['type'] == 'exclude':
+            mask = _condition_mask(experiment_data, rule['column'], tuple(rule['values']), mask_cache)
+            exclude_mask |= mask
+        else:
+            mask = np.ones(len(experiment_data), dtype=bool)
+            for column, value in rule.get('where', {}).items():
+                mask = mask & _condition_mask(experiment_data, column, value, mask_cache)
 
-    logger.info('missing session ids and study ids were added manually')
+            if rule['type'] == 'set':
+                written_columns = list(rule['values'])
+                if mask.any():
+                    for column, value in rule['values'].items():
+                        experiment_data.loc[mask, column] = value
+            else:
+                written_columns = [rule['column']]
+                if mask.any() and rule['key'] in experiment_data:
+                    filled = experiment_data.loc[mask, rule['key']].map(dict(rule['lookup'])).dropna()
+                    mask = experiment_data.index.isin(filled.index)
+                    experiment_data.loc[filled.index, rule['column']] = filled
+            for key in [key for key in mask_cache if key[0] in written_columns]:
+                del mask_cache[key]
 
-    # In this part of the manual correction, we remove two dropped participants
-    # remove two participants that were excluded/dropped out
-    drop_outs = ['6129dc084c55f609fd62f0bc', '5f9f4660d0edb75784c68223']
-    for idx in drop_outs:
-        experiment_data = experiment_data[experiment_data.prolific_id != idx]
-    logger.info(f'data from participants {drop_outs} was excluded from the final data set.')
+        logger.info(f"correction rule '{rule.get('name')}' ({rule['type']}) affected {mask.sum()} rows.")
+        if 'comment' in rule:
+            logger.info(f"comment on '{rule.get('name')}': {rule['comment']}")
 
+    experiment_data = experiment_data[~exclude_mask]
+    logger.info(f'{exclude_mask.sum()} rows were excluded from the final data set.')
     return experiment_data
+
+
+def _condition_mask(experiment_data, column, value, mask_cache):
+    """
+    Boolean mask of column == value (isnull for None, isin for a tuple), cached per column and value
+    """
+    if (column, value) not in mask_cache:
+        if column not in experiment_data:
+            mask = np.zeros(len(experiment_data), dtype=bool)
+        elif value is None:
+            mask = experiment_data[column].isnull().to_numpy()
+        elif isinstance(value, tuple):
+            mask = experiment_data[column].isin(value).to_numpy()
+        else:
+            mask = (experiment_data[column] == value).to_numpy()
+        mask_cache[(column, value)] = mask
+    return mask_cache[(column, value)]
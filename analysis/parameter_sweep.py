@@ -0,0 +1,114 @@
+import itertools
+import logging
+import numpy as np
+import pandas as pd
+import subject_level_stats as stats
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('ParameterSweepLogger')
+
+
+# Library for running the OneSubjectInhibition pipelines over a grid of parameters
+def parameter_combinations(parameter_dict, parameter_grid):
+    """
+    All combinations of the values in parameter_grid (name: list of values), every combination completed with
+    the values of parameter_dict
+    """
+    names = list(parameter_grid)
+    return [{**parameter_dict, **dict(zip(names, values))}
+            for values in itertools.product(*[parameter_grid[name] for name in names])]
+
+
+def run_parameter_sweep(preprocessed_trial_data, parameter_dict, parameter_grid, n_workers=1, keep_rates=False,
+                        null_condition='no_flash_no_shift', mask_rate=True, normalization='per_window',
+                        metrics_normalization='null_condition'):
+    """
+    Runs the rate, null condition normalization and metrics pipelines of OneSubjectInhibition for every subject and
+    every parameter combination of parameter_grid (e.g. {'alpha': [1 / 25, 1 / 50], 'window_start': [500, 1000]},
+    the other parameters are taken from parameter_dict).
+    Per subject, onsets, cells and trial windows are extracted once (see stats.cell_inputs). Trials per window are
+    computed once per window, kernel sums once per alpha and window; only the stages that depend on the other
+    parameters (masking, normalization, metrics) run for every combination.
+    Subjects run in a process pool if n_workers > 1.
+    Returns three frames: metrics (one row per parameter combination, subject and condition), rates (one row per
+    parameter combination, subject, condition and time point, only with keep_rates) and errors.
+    """
+    start = time.perf_counter()
+    combinations = parameter_combinations(parameter_dict, parameter_grid)
+    options = {'null_condition': null_condition, 'mask_rate': mask_rate, 'normalization': normalization,
+               'metrics_normalization': metrics_normalization, 'keep_rates': keep_rates}
+    jobs = [(prolific_id, trials, combinations, list(parameter_grid), options)
+            for prolific_id, trials in stats._partition_by_subject(preprocessed_trial_data).items()]
+
+    if n_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_sweep_one_subject, *job) for job in jobs]
+            results = [future.result() for future in as_completed(futures)]
+    else:
+        results = [_sweep_one_subject(*job) for job in jobs]
+    results = sorted(results, key=lambda result: str(result[0]))
+
+    rates, metrics, errors = [], [], []
+    for prolific_id, subject_rates, subject_metrics, error in results:
+        if error is not None:
+            logger.error(f'parameter sweep of subject {prolific_id} failed:\n{error}')
+            errors.append({'prolific_id': prolific_id, 'error': error})
+            continue
+        rates.extend(subject_rates)
+        metrics.append(subject_metrics)
+    logger.info(f'swept {len(combinations)} parameter combinations for {len(jobs)} subjects in '
+                f'{time.perf_counter() - start:.3f} s.')
+
+    rates = pd.concat(rates, ignore_index=True) if rates else pd.DataFrame()
+    metrics = pd.concat(metrics, ignore_index=True) if metrics else pd.DataFrame()
+    return rates, metrics, pd.DataFrame(errors, columns=['prolific_id', 'error'])
+
+
+def _sweep_one_subject(prolific_id, trial_data, combinations, swept_parameters, options):
+    """
+    All parameter combinations of one subject, sharing the parameter independent inputs and the cached stages
+    """
+    try:
+        inputs = stats.cell_inputs(trial_data)
+        trials_per_window_cache = {}
+        kernel_sum_cache = {}
+        rates, metrics = [], []
+        for parameters in combinations:
+            subject = stats.OneSubjectInhibition(prolific_id, parameters)
+            window = (subject.window_start, subject.window_end)
+            if window not in trials_per_window_cache:
+                trials_per_window_cache[window] = stats.cell_trials_per_window(inputs, subject.scale)
+            if (subject.alpha, window) not in kernel_sum_cache:
+                kernel_sum_cache[(subject.alpha, window)] = stats.cell_kernel_sums(inputs, subject.scale,
+                                                                                   subject.alpha)
+            cell_statistics = {'n_trials': np.bincount(inputs['trial_cells'], minlength=4),
+                               'n_trials_per_window': trials_per_window_cache[window],
+                               'kernel_sums': kernel_sum_cache[(subject.alpha, window)],
+                               'onsets': inputs['onsets'],
+                               'onset_cells': inputs['onset_cells']}
+            subject.run_rate_pipeline_batched(mask_rate=options['mask_rate'], normalization=options['normalization'],
+                                              cell_statistics=cell_statistics)
+            subject.normalize_to_null_condition(options['null_condition'])
+            subject.run_metrics_pipeline(normalization=options['metrics_normalization'])
+
+            swept_values = {name: parameters[name] for name in swept_parameters}
+            subject_metrics = subject.metrics.copy()
+            subject_metrics.insert(0, 'condition', list(subject.rates.keys()))
+            subject_metrics.insert(0, 'prolific_id', prolific_id)
+            for position, (name, value) in enumerate(swept_values.items()):
+                subject_metrics.insert(position, name, value)
+            metrics.append(subject_metrics)
+            if options['keep_rates']:
+                subject_rates = stats.subject_rates_frame(subject)
+                for position, (name, value) in enumerate(swept_values.items()):
+                    subject_rates.insert(position, name, value)
+                rates.append(subject_rates)
+    except Exception:
+        return prolific_id, None, None, traceback.format_exc()
+    return prolific_id, rates, pd.concat(metrics, ignore_index=True), None
@@ -0,0 +1,172 @@
+import helper_funcs as helper
+import logging
+import numpy as np
+import pandas as pd
+import ragged
+import subject_level_stats as stats
+import time
+
+from bootstrap import CONDITION_CELLS, run_resampling
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('PermutationLogger')
+
+
+# Library for cluster-based permutation tests of rate curves
+def permutation_test_subject(subject, condition_a='flash_shift', condition_b='no_flash_no_shift',
+                             n_permutations=1000, seed=None, chunk_size=100, n_workers=1, threshold=None,
+                             cluster_alpha=0.05):
+    """
+    Cluster-based permutation test of the rate difference condition_a - condition_b of one OneSubjectInhibition
+    (with preprocessed_trial_data set, rates normalized per window). The condition labels of the trials of both
+    conditions are shuffled. The kernel sums and windows of every trial are computed once (trials x time), so the
+    rates of a permutation are sums of the rows with the shuffled labels (one matrix product per chunk).
+    threshold: fixed cluster forming threshold of the rate difference, by default the pointwise
+    cluster_alpha / 2 and 1 - cluster_alpha / 2 percentiles of the permutation distribution.
+    Returns the clusters (sign, start, end, mass, p-value) and the statistic with its thresholds over time.
+    """
+    start = time.perf_counter()
+    inputs = trial_contributions(subject, condition_a, condition_b)
+    permutations = run_resampling(_permute_trials, (inputs,), n_permutations, seed, chunk_size, n_workers)
+    observed = rate_difference(inputs, inputs['labels'][np.newaxis])[0]
+    logger.info(f'{n_permutations} permutations of {condition_a} vs {condition_b} of subject {subject.prolific_id} '
+                f'took {time.perf_counter() - start:.3f} s.')
+    return cluster_test(observed, permutations['statistic'], subject.scale, threshold, cluster_alpha)
+
+
+def permutation_test_subjects(rates, condition_a='flash_shift', condition_b='no_flash_no_shift', column='rate',
+                              n_permutations=1000, seed=None, chunk_size=100, n_workers=1, threshold=None,
+                              cluster_alpha=0.05):
+    """
+    Group level cluster-based permutation test of the paired difference condition_a - condition_b of a tidy rates
+    frame (see stats.run_inhibition_subjects). The statistic is the one sample t value of the differences over
+    subjects; permutations flip the sign of the difference of random subjects. Subjects without both curves are
+    dropped. Returns the clusters and the statistic with its thresholds over time (see permutation_test_subject).
+    """
+    start = time.perf_counter()
+    subjects, conditions, scale, curves = stats.stack_rates_frame(rates, column)
+    conditions = list(conditions)
+    differences = curves[:, conditions.index(condition_a)] - curves[:, conditions.index(condition_b)]
+    differences = differences[~np.isnan(differences).any(axis=1)]
+    if len(differences) < 2:
+        raise ValueError(f'Only {len(differences)} subjects have both conditions. '
+                         f'Please use conditions that at least two subjects have.')
+    permutations = run_resampling(_flip_subjects, ({'differences': differences},), n_permutations, seed,
+                                  chunk_size, n_workers)
+    observed = paired_t(differences, np.ones((1, len(differences))))[0]
+    logger.info(f'{n_permutations} sign flips of {len(differences)} subjects ({condition_a} vs {condition_b}) '
+                f'took {time.perf_counter() - start:.3f} s.')
+    return cluster_test(observed, permutations['statistic'], scale, threshold, cluster_alpha)
+
+
+def trial_contributions(subject, condition_a, condition_b):
+    """
+    Kernel sums and window coverage of every trial of the two conditions (trials x time) with the label of
+    every trial (1 for condition_a)
+    """
+    cells_a, cells_b = CONDITION_CELLS[condition_a], CONDITION_CELLS[condition_b]
+    if set(cells_a) & set(cells_b):
+        raise ValueError(f'{condition_a} and {condition_b} share trials. '
+                         f'Please use two conditions without shared trials, e.g. flash_shift and no_flash_no_shift.')
+    data = subject.preprocessed_trial_data
+    trial_cells = 2 * data['flashShown'].to_numpy(dtype=int) + data['stimJumped'].to_numpy(dtype=int)
+    selected = np.where(np.isin(trial_cells, cells_a + cells_b))[0]
+    scale = subject.scale
+    n_scale = len(scale)
+
+    onsets = ragged.get_ragged(data, 'touchOnTime_to_trialOnTime_to_flashOnTime_aligned').take(selected)
+    steps, input_a, input_b, in_scale = helper.onset_steps(onsets.values, scale, subject.alpha)
+    keys = onsets.row_ids[in_scale] * n_scale + steps
+    inputs_a = np.bincount(keys, weights=input_a, minlength=len(selected) * n_scale).reshape(-1, n_scale)
+    inputs_b = np.bincount(keys, weights=input_b, minlength=len(selected) * n_scale).reshape(-1, n_scale)
+    coverage = helper.trials_per_window(
+        data['trialOnTime_to_trialOnTime_to_flashOnTime_aligned'].to_numpy(dtype=float)[selected],
+        data['trialEndTime_to_trialOnTime_to_flashOnTime_aligned'].to_numpy(dtype=float)[selected],
+        scale, groups=np.arange(len(selected)), n_groups=len(selected))
+    return {'kernel_sums': helper.kernel_sum_from_inputs(inputs_a, inputs_b, subject.alpha),
+            'coverage': np.reshape(coverage, (len(selected), n_scale)).astype(float),
+            'labels': np.isin(trial_cells[selected], cells_a).astype(float)}
+
+
+def rate_difference(inputs, labels):
+    """
+    Rate difference (per window normalized) of the trials labelled 1 and 0, for every row of labels
+    (permutations x trials)
+    """
+    kernel_a = labels @ inputs['kernel_sums']
+    coverage_a = labels @ inputs['coverage']
+    kernel_b = inputs['kernel_sums'].sum(axis=0) - kernel_a
+    coverage_b = inputs['coverage'].sum(axis=0) - coverage_a
+    return kernel_a * 1000 / np.maximum(coverage_a, 1) - kernel_b * 1000 / np.maximum(coverage_b, 1)
+
+
+def paired_t(differences, signs):
+    """
+    One sample t value over subjects of the differences (subjects x time) with the signs of every row of signs
+    (permutations x subjects). The sum of squares does not change with the signs.
+    """
+    n_subjects = len(differences)
+    means = signs @ differences / n_subjects
+    variances = (np.sum(differences ** 2, axis=0) - n_subjects * means ** 2) / (n_subjects - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_values = means / np.sqrt(variances / n_subjects)
+    return np.nan_to_num(t_values, nan=0.)
+
+
+def _permute_trials(inputs, n_permutations, seed_sequence):
+    rng = np.random.default_rng(seed_sequence)
+    labels = rng.permuted(np.tile(inputs['labels'], (n_permutations, 1)), axis=1)
+    return {'statistic': rate_difference(inputs, labels)}
+
+
+def _flip_subjects(inputs, n_permutations, seed_sequence):
+    rng = np.random.default_rng(seed_sequence)
+    signs = rng.choice([-1., 1.], size=(n_permutations, len(inputs['differences'])))
+    return {'statistic': paired_t(inputs['differences'], signs)}
+
+
+def find_clusters(statistic, lower, upper):
+    """
+    Clusters in every row of statistic (rows x time): runs of time points above upper (positive clusters) or below
+    lower (negative clusters). Returns the row, first and last time index and mass (sum of the statistic)
+    of every cluster.
+    """
+    statistic = np.atleast_2d(statistic)
+    n_rows, n_scale = statistic.shape
+    signs = (statistic > upper).astype(np.int8) - (statistic < lower).astype(np.int8)
+    previous = np.zeros_like(signs)
+    previous[:, 1:] = signs[:, :-1]
+    starts = ((signs != 0) & (signs != previous)).ravel()
+    in_cluster = signs.ravel() != 0
+    cluster_ids = np.cumsum(starts)[in_cluster] - 1
+    masses = np.bincount(cluster_ids, weights=statistic.ravel()[in_cluster], minlength=starts.sum())
+    start_positions = np.flatnonzero(starts)
+    first = start_positions % n_scale
+    last = first + np.bincount(cluster_ids, minlength=len(start_positions)) - 1
+    return start_positions // n_scale, first, last, masses
+
+
+def cluster_test(observed, permuted, scale, threshold=None, cluster_alpha=0.05):
+    """
+    Compares the clusters of the observed statistic with the distribution of the largest absolute cluster mass
+    of the permutations. Returns a frame of the observed clusters with their p-values and a frame of the statistic
+    and the cluster forming thresholds over time.
+    """
+    if threshold is None:
+        lower, upper = np.percentile(permuted, [100 * cluster_alpha / 2, 100 * (1 - cluster_alpha / 2)], axis=0)
+    else:
+        lower, upper = np.full(len(scale), -abs(threshold)), np.full(len(scale), abs(threshold))
+
+    rows, _, _, masses = find_clusters(permuted, lower, upper)
+    maximum_masses = np.zeros(len(permuted))
+    np.maximum.at(maximum_masses, rows, np.abs(masses))
+
+    _, first, last, masses = find_clusters(observed, lower, upper)
+    p_values = (1 + np.sum(maximum_masses[np.newaxis] >= np.abs(masses)[:, np.newaxis], axis=1)) / (len(permuted) + 1)
+    clusters = pd.DataFrame({'sign': np.sign(masses).astype(int), 'start': scale[first], 'end': scale[last],
+                             'mass': masses, 'p_value': p_values})
+    curve = pd.DataFrame({'time': scale, 'statistic': observed, 'lower_threshold': lower,
+                          'upper_threshold': upper})
+    return clusters.sort_values('p_value', ignore_index=True), curve
@@ -1,71 +1,173 @@
+import data_cache
+import dtypes
 import logging
 import numpy as np
 import pandas as pd
 import helper_funcs as helper
+import ragged
+import stage_cache
+
+from instrumentation import instrumented
+from itertools import chain
 
 logging.basicConfig(filename='manual_inhibition_analysis.log',
                     level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('PreprocessingLogger')
 
+LONG_DF_COLS = ['prolific_id', 'subject', 'session_id', 'study_id', 'choiceOrder',
+                'position_x_at_touch', 'position_y_at_touch', 'touch_x_to_center',
+                'touch_y_to_center', 'pos_x_touch_x_dist', 'pos_y_touch_y_dist',
+                'touch_x_to_center_dva', 'touch_y_to_center_dva', 'pos_x_touch_x_dist_dva',
+                'pos_y_touch_y_dist_dva', 'vector_touch_distance_dva', 'touch_deviation_angle']
+# per-trial lists of numbers that the final trial data holds as python lists (see preprocessing_pipeline)
+LIST_COLUMNS = ['animation_timestamps', 'touchOnTime', 'touchOffTime', 'touchX', 'touchY', 'position_x',
+                'position_y', 'shifted_position_x', 'shifted_position_y', 'animation_timestamps_to_touchOnTime',
+                'animation_timestamps_to_touchOffTime', 'position_x_at_touch', 'position_y_at_touch',
+                'touch_deviation_angle']
+
 
 # Library for preprocessing of data from the manual inhibition experiment
-def preprocessing_pipeline(data_file_name):
+@instrumented()
+def preprocessing_pipeline(data_file_name=None, optimize_memory=True, cache_dir=None, max_cache_size_mb=2048,
+                           data=None, data_digest=None, as_lists=True):
     """
     This is the full preprocessing pipeline, performing temporal and spatial alignments.
+    The input is the data file, or data, the data frame returned by loading_data.load_all_data. With cache_dir,
+    data needs a data_digest that identifies its content (see loading_data.data_digest).
+    The pipeline runs as named stages (see preprocessing_stages). With cache_dir, the result of every stage is
+    cached on disk under a hash of its input, code and parameters, so after a change of e.g. the space alignment the
+    time aligned trial data is loaded instead of recomputed. The least recently used results are evicted when the
+    cache grows beyond max_cache_size_mb.
+    With optimize_memory, repeated strings are read as categoricals and flags are stored as int8
+    in the data and its parts (see dtypes.optimize_dtypes).
+    Between the stages, every per-trial list column is a column of arrays that are views into one contiguous buffer.
+    With as_lists, the LIST_COLUMNS of the final trial data are converted to python lists, as the notebooks expect;
+    without, they stay arrays, which needs a fraction of the memory.
     """
-    data = pd.read_csv(data_file_name)
+    if (data is None) == (data_file_name is None):
+        raise ValueError('Either a data file or a data frame is needed for preprocessing. '
+                         'Please use either data_file_name or data.')
+    cache = stage_cache.StageCache(cache_dir, max_cache_size_mb) if cache_dir is not None else None
+    if cache is not None and data is not None and data_digest is None:
+        raise ValueError('A data frame can only be cached with a digest of its content. '
+                         'Please use data_digest (see loading_data.data_digest) or no cache_dir.')
+    if data is None and cache is not None:
+        data_digest = data_cache.file_digest(data_file_name)
+    results = stage_cache.run_stages(preprocessing_stages(optimize_memory),
+                                     {'data': (data_file_name if data is None else data, data_digest)}, cache,
+                                     outputs=['split', 'calibration_params', 'space_alignment', 'long_format'])
+    calibration_data, training_data, main_session_data, _, question_data = results['split']
+    calibration_params = results['calibration_params']
+    trial_data = results['space_alignment']
+    long_trial_df = results['long_format']
+    if as_lists:
+        for col in [col for col in LIST_COLUMNS if col in trial_data.columns]:
+            trial_data[col] = ragged.get_ragged(trial_data, col).to_lists()
+
+    logger.info(f"The final trial data has the following columns: {trial_data.columns} and shape {trial_data.shape}")
+    logger.info(f"The final trial data in long format contains only successful trials and has the following columns: "
+                f"{long_trial_df.columns} and shape {long_trial_df.shape}")
 
-    # split the data
-    calibration_data, training_data, main_session_data, \
-        trial_data, question_data = split_data(data)
+    return calibration_data, training_data, main_session_data, trial_data, \
+        question_data, calibration_params, long_trial_df
 
-    trial_data = ensure_formats(trial_data)
-    trial_data = perform_time_alignments(trial_data)
 
-    # get the translation between ppdva and ppm per session
+def preprocessing_stages(optimize_memory=True):
+    """
+    The stages of preprocessing_pipeline with the code that their cached results depend on: the preprocessing
+    functions of the stage and the full source (including constants) of the library modules it uses.
+    """
+    library = [helper, ragged, dtypes]
+    return [
+        stage_cache.Stage('split', read_and_split, ['data'],
+                          {'optimize_memory': optimize_memory, 'categorical_columns': dtypes.CATEGORICAL_COLUMNS,
+                           'flag_columns': dtypes.FLAG_COLUMNS},
+                          code=[read_and_split, split_data, _take_rows] + library),
+        stage_cache.Stage('formats', ensure_formats, [('split', 3)],
+                          code=[ensure_formats, _decode_list_column] + library),
+        stage_cache.Stage('time_alignment', perform_time_alignments, ['formats'],
+                          code=[perform_time_alignments, align_columns_to_trial_on_time, align_columns_to_value]
+                          + library),
+        stage_cache.Stage('calibration_params', get_calibration_params, [('split', 0)],
+                          code=[get_calibration_params], cached=False),
+        stage_cache.Stage('space_alignment', align_space_to_calibration, ['time_alignment', 'calibration_params'],
+                          code=[align_space_to_calibration, get_session_ppdva, perform_space_alignments,
+                                _set_list_column] + library),
+        stage_cache.Stage('long_format', successful_trials_long_format, ['space_alignment'],
+                          {'columns': LONG_DF_COLS},
+                          code=[successful_trials_long_format, transform_long_dataset, _flatten_list_column]
+                          + library),
+    ]
+
+
+def read_and_split(data_source, optimize_memory=True, categorical_columns=dtypes.CATEGORICAL_COLUMNS,
+                   flag_columns=dtypes.FLAG_COLUMNS):
+    """
+    Reads the data file and splits it into the parts of the experiment (see split_data).
+    data_source is the name of the data file or the loaded data frame, which gets the types of the data file.
+    """
+    if isinstance(data_source, pd.DataFrame):
+        data = dtypes.as_csv_types(data_source)
+        if optimize_memory:
+            data = dtypes.optimize_dtypes(data, categorical_columns, flag_columns)
+    elif optimize_memory:
+        data = dtypes.optimize_dtypes(dtypes.read_csv(data_source, categorical_columns), categorical_columns,
+                                      flag_columns)
+    else:
+        data = pd.read_csv(data_source)
+
+    parts = split_data(data)
+    if optimize_memory:
+        parts = tuple(dtypes.optimize_dtypes(part, categorical_columns, flag_columns, report=False) for part in parts)
+    return parts
+
+
+def get_calibration_params(calibration_data):
+    """
+    Results of the virtual chinrest calibration of every session
+    """
     calibration_params = calibration_data.dropna(subset=['session_id'], axis=0)
-    calibration_params = calibration_params[calibration_params.trial_type == 'virtual-chinrest'].dropna(axis=1)
+    return calibration_params[calibration_params.trial_type == 'virtual-chinrest'].dropna(axis=1)
+
 
+def get_session_ppdva(calibration_params):
+    """
+    Translation between pixels and degrees of visual angle per session (the last calibration of the session)
+    """
     session2ppdva = {}
     for session in np.unique(calibration_params.session_id):
         session2ppdva[session] = calibration_params[calibration_params.session_id == session]['px2deg'].values[-1]
+    return session2ppdva
 
-    trial_data = perform_space_alignments(trial_data, ppdva=session2ppdva)
-
-    long_df_cols = ['prolific_id', 'subject', 'session_id', 'study_id', 'choiceOrder',
-                    'position_x_at_touch', 'position_y_at_touch', 'touch_x_to_center',
-                    'touch_y_to_center', 'pos_x_touch_x_dist', 'pos_y_touch_y_dist',
-                    'touch_x_to_center_dva', 'touch_y_to_center_dva', 'pos_x_touch_x_dist_dva',
-                    'pos_y_touch_y_dist_dva', 'vector_touch_distance_dva', 'touch_deviation_angle']
 
-    long_trial_df = transform_long_dataset(trial_data[trial_data.success == 1], long_df_cols)
+def align_space_to_calibration(trial_data, calibration_params):
+    return perform_space_alignments(trial_data, ppdva=get_session_ppdva(calibration_params))
 
-    logger.info(f"The final trial data has the following columns: {trial_data.columns} and shape {trial_data.shape}")
-    logger.info(f"The final trial data in long format contains only successful trials and has the following columns: "
-                f"{long_trial_df.columns} and shape {long_trial_df.shape}")
 
-    return calibration_data, training_data, main_session_data, trial_data, \
-        question_data, calibration_params, long_trial_df
+def successful_trials_long_format(trial_data, columns=None):
+    return transform_long_dataset(trial_data[trial_data.success == 1], columns or LONG_DF_COLS)
 
 
+@instrumented()
 def ensure_formats(trial_data):
     """
     Transforms string representation of values into floats or lists
+    List columns are decoded in bulk with ragged arrays and stored as arrays that share one buffer per column
     Alternative: give load.json a type dictionary
     """
-    # Time formats
-    trial_data['animation_timestamps'] = helper.load_strings(trial_data.animation_timestamps,
-                                                             trial_data.index, object)
-    trial_data['touchOnTime'] = helper.load_strings(trial_data['touchOn'], trial_data.index, object)
-    trial_data['touchOffTime'] = helper.load_strings(trial_data['touchOff'], trial_data.index, object)
-    trial_data['flashOnTime'] = helper.load_strings(trial_data['flashOnTime'], trial_data.index, float)
     logger.info(f"In {sum(trial_data['flashOffTime'] == '[]')} "
                 f"trials no flash offset was recorded. Dropping these trials.")
     trial_data = trial_data[trial_data['flashOffTime'] != '[]'].copy()
     trial_data.reset_index(drop=True)
-    trial_data.loc[trial_data.index, 'flashOffTime'] = helper.load_strings(trial_data['flashOffTime'],
 
+    # Time formats
+    for source_col, col in [('animation_timestamps', 'animation_timestamps'),
+                            ('touchOn', 'touchOnTime'),
+                            ('touchOff', 'touchOffTime')]:
+        _decode_list_column(trial_data, source_col, col)
+    trial_data['flashOnTime'] = helper.load_strings(trial_data['flashOnTime'], trial_data.index, float)
+    trial_data.loc[trial_data.index, 'flashOffTime'] = helper.load_strings(trial_data['flashOffTime'],
                                                                            trial_data.index, float)
 
     trial_data['scheduled_change_onset'] = helper.load_strings(trial_data.scheduled_change_onset,
@@ -74,18 +176,22 @@ def ensure_formats(trial_data):
     trial_data['eventOnTime'] = trial_data['startTime'] + trial_data['flashOnTime']
 
     # space formats
-    trial_data['touchX'] = helper.load_strings(trial_data.touchX, trial_data.index, object)
-    trial_data['touchY'] = helper.load_strings(trial_data.touchY, trial_data.index, object)
-    trial_data['position_x'] = helper.load_strings(trial_data.position_x, trial_data.index, object)
-    trial_data['position_y'] = helper.load_strings(trial_data.position_y, trial_data.index, object)
-    trial_data['shifted_position_x'] = helper.load_strings(trial_data.shifted_position_x, trial_data.index, object)
-    trial_data['shifted_position_y'] = helper.load_strings(trial_data.shifted_position_y, trial_data.index, object)
+    for col in ['touchX', 'touchY', 'position_x', 'position_y', 'shifted_position_x', 'shifted_position_y']:
+        _decode_list_column(trial_data, col, col)
     trial_data['choiceOrder'] = helper.load_strings(trial_data['choiceOrder'], trial_data.index, object)
 
     logger.info('Format conversions completed!')
     return trial_data
 
 
+def _decode_list_column(trial_data, source_col, col):
+    """
+    Decodes a column of json lists in one pass and stores it as column col of arrays (views into one buffer)
+    """
+    trial_data[col] = ragged.RaggedArray.from_json_strings(trial_data[source_col]).to_arrays()
+
+
+@instrumented()
 def perform_time_alignments(trial_data):
     """
     Aligns time columns first to trial onset, and then to flash onset
@@ -98,99 +204,144 @@ def perform_time_alignments(trial_data):
     trial_data.rename(columns={'flashOnTime_to_trialOnTime': 'flashOnTime_aligned'}, inplace=True)
     logger.info('renamed flashOnTime_to_trialOnTime to flashOnTime_aligned')
     trial_data = align_columns_to_value(trial_data, time_cols, 'flashOnTime_aligned')
-    trial_data = helper.align_to_multiple_values_filter_first(trial_data, 'animation_timestamps',  'touchOnTime')
-    trial_data = helper.align_to_multiple_values_filter_first(trial_data, 'animation_timestamps',  'touchOffTime')
+    frames = ragged.get_ragged(trial_data, 'animation_timestamps')
+    trial_data = helper.align_to_multiple_values_filter_first(trial_data, 'animation_timestamps',  'touchOnTime',
+                                                              frames, as_lists=False)
+    trial_data = helper.align_to_multiple_values_filter_first(trial_data, 'animation_timestamps',  'touchOffTime',
+                                                              frames, as_lists=False)
     # touch events relative to first touch
-    onsets = trial_data['touchOnTime'].copy()
-    first_onsets = [x[0] for x in onsets]
-    trial_data['aligned_touchOn'] = [np.array(onsets.values[x]) - first_onsets[x] for x in range(len(first_onsets))]
+    onsets = ragged.get_ragged(trial_data, 'touchOnTime')
+    aligned_onsets = onsets.subtract(onsets.first())
+    trial_data['aligned_touchOn'] = aligned_onsets.to_arrays()
 
-    # time event/change to last interaction
-    time_to_last_interaction = []
-
-    for idx in trial_data.index:
-
-        distances = trial_data.loc[idx, 'touchOnTime'] - trial_data.loc[idx, 'flashOnTime']
-        distances = distances[distances < 0]
-        time_to_last_interaction.append(max(distances))
+    # time event/change to last interaction (the latest touch before the flash)
+    distances = onsets.values - np.repeat(trial_data['flashOnTime'].to_numpy(dtype=float), onsets.lengths)
+    distances[distances >= 0] = -np.inf
+    time_to_last_interaction = onsets.reduce(np.maximum, distances, empty=-np.inf)
+    time_to_last_interaction[np.isneginf(time_to_last_interaction)] = np.nan
 
     trial_data['interaction_to_change_distance'] = time_to_last_interaction
 
     return trial_data
 
 
+@instrumented()
 def perform_space_alignments(trial_data, ppdva):
     """
-    Align the position of the dots relative to
-
+    Align the position of the dots relative to the touches.
+    All computations run on the flat arrays of all touches (see ragged), every result is stored as a column of
+    trial_data and kept in arrays for the computations that use it.
     """
+    arrays = {}
     # get position at response time
-    trial_data['position_x_at_touch'] = helper.get_position_at_response_time(trial_data, 'position_x',
-                                                                             'shifted_position_x',
-                                                                             'aligned_touchOn', 'eventOnTime')
-    trial_data['position_y_at_touch'] = helper.get_position_at_response_time(trial_data, 'position_y',
-                                                                             'shifted_position_y',
-                                                                             'aligned_touchOn', 'eventOnTime')
+    for axis in ['x', 'y']:
+        position_at_touch = helper.positions_at_response_time(trial_data, f'position_{axis}',
+                                                              f'shifted_position_{axis}',
+                                                              'aligned_touchOn', 'eventOnTime')
+        arrays[f'position_{axis}_at_touch'] = _set_list_column(trial_data, f'position_{axis}_at_touch',
+                                                               position_at_touch)
     logger.info('extracted got positions at interaction times and created new columns')
 
     # align to screen center
-    x_center = trial_data.windowWidth / 2
-    y_center = trial_data.windowHeight / 2
-
-    trial_data['touch_x_to_center'] = [trial_data['touchX'][x] - x_center[x]
-                                       for x in trial_data.index]
-    trial_data['touch_y_to_center'] = [trial_data['touchY'][x] - y_center[x]
-                                       for x in trial_data.index]
+    for axis, size_col in [('x', 'windowWidth'), ('y', 'windowHeight')]:
+        center = trial_data[size_col].to_numpy(dtype=float) / 2
+        touches = ragged.get_ragged(trial_data, f'touch{axis.upper()}')
+        arrays[f'touch_{axis}_to_center'] = _set_list_column(trial_data, f'touch_{axis}_to_center',
+                                                             touches.subtract(center))
     logger.info('Aligned touch responses to the screen center.')
 
     # distance between touch and position
-    trial_data['pos_x_touch_x_dist'] = [helper.subtract_arrays_missing_values(trial_data['touch_x_to_center'][x],
-                                                                              trial_data['position_x_at_touch'][x])
-                                        for x in trial_data.index]
-    trial_data['pos_y_touch_y_dist'] = [helper.subtract_arrays_missing_values(trial_data['touch_y_to_center'][x],
-                                                                              trial_data['position_y_at_touch'][x])
-                                        for x in trial_data.index]
+    for axis in ['x', 'y']:
+        arrays[f'pos_{axis}_touch_{axis}_dist'] = _set_list_column(
+            trial_data, f'pos_{axis}_touch_{axis}_dist',
+            helper.subtract_ragged_missing_values(arrays[f'touch_{axis}_to_center'],
+                                                  arrays[f'position_{axis}_at_touch']))
     logger.info('computed the distance between touch response and location in pixel')
 
     # transform pixel to dva
-    trial_data['px2dva'] = trial_data['session_id'].replace(ppdva)
+    trial_data['px2dva'] = trial_data['session_id'].astype(object).replace(ppdva)
+    px2dva = trial_data['px2dva'].to_numpy(dtype=float)
     for col in ['touch_x_to_center', 'touch_y_to_center',
                 'pos_x_touch_x_dist', 'pos_y_touch_y_dist']:
-        trial_data[f'{col}_dva'] = trial_data[col] / trial_data.px2dva
+        pixel_values = arrays[col]
+        arrays[f'{col}_dva'] = _set_list_column(
+            trial_data, f'{col}_dva',
+            pixel_values.with_values(pixel_values.values / np.repeat(px2dva, pixel_values.lengths)))
     logger.info('expressed pixel values in dva')
 
     # get touch error as vector
-    trial_data['vector_touch_distance_dva'] = [helper.pythagoras(trial_data.pos_x_touch_x_dist_dva[x],
-                                               trial_data.pos_y_touch_y_dist_dva[x])
-                                               for x in trial_data.index]
+    x_distance = arrays['pos_x_touch_x_dist_dva']
+    y_distance = arrays['pos_y_touch_y_dist_dva']
+    _set_list_column(trial_data, 'vector_touch_distance_dva',
+                     x_distance.with_values(helper.pythagoras(x_distance.values, y_distance.values)))
     logger.info('computed vector distance between touch position and point')
 
     # direction of the touch in dva
-    trial_data['touch_deviation_angle'] = [helper.get_angles_from_list(trial_data['pos_x_touch_x_dist_dva'][x],
-                                           trial_data['pos_y_touch_y_dist_dva'][x])
-                                           for x in trial_data.index]
+    _set_list_column(trial_data, 'touch_deviation_angle',
+                     x_distance.with_values(helper.cart2pol(x_distance.values, y_distance.values)[2]))
     logger.info('angle between touch position and point')
 
     return trial_data
 
 
-def transform_long_dataset(wide_data, columns):
+def _set_list_column(trial_data, col, ragged_array):
+    """
+    Stores a ragged array as column of arrays (views into one buffer) of trial_data and returns it
+    """
+    trial_data[col] = ragged_array.to_arrays()
+    return ragged_array
+
+
+@instrumented()
+def transform_long_dataset(wide_data, columns, index_col='dot_index'):
     """
-    Transform a wide dataset to a long dataset
+    Transform a wide dataset to a long dataset with one row per list entry (dot/touch) of every trial.
+    A trial has as many rows as its longest list column; shorter lists are filled with nan and scalar columns are
+    repeated (keeping their dtype, e.g. categorical). index_col holds the position of the entry in its trial.
+    The long columns are built directly from the flat list buffers, memory scales with the number of entries.
     """
-    long_df = pd.DataFrame()
+    list_columns = [col for col in columns if ragged.is_list_column(wide_data, col)]
+    flat_lists = {col: _flatten_list_column(wide_data, col) for col in list_columns}
+
+    n_rows = np.zeros(len(wide_data), dtype=np.int64)
+    for values, lengths in flat_lists.values():
+        n_rows = np.maximum(n_rows, lengths)
+    offsets = np.zeros(len(wide_data) + 1, dtype=np.int64)
+    np.cumsum(n_rows, out=offsets[1:])
+    dot_index = np.arange(offsets[-1]) - np.repeat(offsets[:-1], n_rows)
+    trial_positions = np.repeat(np.arange(len(wide_data)), n_rows)
+
+    long_columns = {}
     for col in columns:
-        first_entry_test = wide_data[col].iloc[0]
-        if type(first_entry_test) == list or type(first_entry_test) == np.ndarray:
-            if len(first_entry_test) == 6:
-                long_df[col] = helper.get_long_column(wide_data, col)
-                logger.info(f"stacked {col} into the long format dataset.")
-            else:
-                logger.info(f"{col} was a list of length {len(first_entry_test)}. \n "
-                            f"The test entry was {first_entry_test}.")
+        if col not in flat_lists:
+            long_columns[col] = wide_data[col].array.take(trial_positions)
+            continue
+        values, lengths = flat_lists[col]
+        if np.array_equal(lengths, n_rows):
+            long_columns[col] = values
         else:
-            long_df[col] = helper.stack_unique_cols(wide_data, col, 6)
-    return long_df
+            logger.info(f"{col} has fewer entries than other columns in {np.sum(lengths < n_rows)} trials, "
+                        f"filling them with nan.")
+            value_starts = np.cumsum(lengths) - lengths
+            positions = np.repeat(offsets[:-1] - value_starts, lengths) + np.arange(len(values))
+            padded = np.full(offsets[-1], np.nan)
+            padded[positions] = values
+            long_columns[col] = padded
+        logger.info(f"stacked {col} into the long format dataset.")
+    long_columns[index_col] = dot_index
+    return pd.DataFrame(long_columns)
+
+
+def _flatten_list_column(data, col):
+    """
+    Values and per-trial lengths of a list column. Columns of lists keep the dtype of their entries
+    (e.g. integer choice order), columns of arrays are concatenated.
+    """
+    cells = data[col].to_list()
+    lengths = np.fromiter(map(len, cells), dtype=np.int64, count=len(cells))
+    if cells and all(isinstance(cell, np.ndarray) for cell in cells):
+        return np.concatenate(cells), lengths
+    return np.array(list(chain.from_iterable(cells))), lengths
 
 
 def align_columns_to_trial_on_time(trial_data):
@@ -198,7 +349,7 @@ def align_columns_to_trial_on_time(trial_data):
     Alignment to trial on time (first recorded timestamp from animation timestamps)
     Performs the extraction of trialOnTime and adds startTime to flashOnTime
     """
-    trial_data['trialOnTime'] = [trial_data['animation_timestamps'][x][0] for x in trial_data.index]
+    trial_data['trialOnTime'] = ragged.get_ragged(trial_data, 'animation_timestamps').first()
     trial_data['flashOnTime'] += trial_data['startTime']
     trial_data['flashOffTime'] += trial_data['startTime']
     # set the end time of each trial to the maximum time people had to make the response
@@ -213,14 +364,15 @@ def align_columns_to_trial_on_time(trial_data):
 def align_columns_to_value(trial_data, col_list, value_col):
     """
     Performs subtraction of two columns for alignment.
+    List columns are aligned on their ragged arrays and stored as columns of arrays.
     """
     for col in col_list:
         name = f"{col}_to_{value_col}"
-        try:
+        if ragged.is_list_column(trial_data, col):
+            aligned = ragged.get_ragged(trial_data, col).subtract(trial_data[value_col].to_numpy(dtype=float))
+            trial_data[name] = aligned.to_arrays()
+        else:
             trial_data[name] = trial_data[col] - trial_data[value_col]
-        except TypeError:
-            # The column might be a list, so we convert it to a numpy array
-            trial_data[name] = [np.array(trial_data[col][x]) - trial_data[value_col][x] for x in trial_data.index]
         logger.info(f'aligned the column {col} to {value_col}')
     return trial_data
 
@@ -229,11 +381,14 @@ def split_data(data):
     """
     Splits dataframe into subparts corresponding to the individual parts of the experiment
     Labels the condition in trial data
+    The parts are taken from data (one copy each), not masked and copied again.
     """
-    calibration_data = data[data.component == 'Calibrate_Screen'].copy()
-    training_data = data[data.component == 'Training_Serial'].copy()
-    main_session_data = data[data.component == 'Trials_Serial'].copy()
-    trial_data = main_session_data[main_session_data.test_part == 'trial'].dropna(axis=1).copy()
+    calibration_data = _take_rows(data, data.component == 'Calibrate_Screen')
+    training_data = _take_rows(data, data.component == 'Training_Serial')
+    main_session_data = _take_rows(data, data.component == 'Trials_Serial')
+    is_trial = (main_session_data.test_part == 'trial').to_numpy()
+    complete_columns = main_session_data.notna().to_numpy()[is_trial].all(axis=0)
+    trial_data = _take_rows(main_session_data, is_trial).take(np.flatnonzero(complete_columns), axis=1)
 
     # add a column for conditions
     trial_data['condition'] = 'not defined'
@@ -250,8 +405,14 @@ def split_data(data):
     trial_data.loc[flash_no_shift_ids, 'condition'] = 'Flash_No_Shift'
     trial_data.loc[no_flash_shift_ids, 'condition'] = 'No_Flash_Shift'
     trial_data.loc[no_flash_no_shift_ids, 'condition'] = 'No_Flash_No_Shift'
-    question_data = data[data.component == 'Outro_General'].copy()
+    question_data = _take_rows(data, data.component == 'Outro_General')
 
     logger.info('datafile was split into the components of the experiment')
     return calibration_data, training_data, main_session_data, trial_data, question_data
 
+
+def _take_rows(data, mask):
+    """
+    Rows of data where mask is true, as an independent frame
+    """
+    return data.take(np.flatnonzero(mask))
@@ -0,0 +1,196 @@
+import json
+import numpy as np
+
+from itertools import chain
+
+
+# Library for per-trial lists of numbers (touches, positions, frame timestamps) stored in flat arrays
+class RaggedArray:
+    """
+    Per-trial lists of numbers in one contiguous float64 buffer.
+    The values of trial i are values[offsets[i]:offsets[i + 1]].
+    index holds the row labels of the data frame the lists belong to.
+    The buffers are read-only, so views of single trials cannot change the values.
+    """
+    def __init__(self, values, offsets, index=None):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values.flags.writeable = False
+        self.offsets.flags.writeable = False
+        self.index = index
+
+    @classmethod
+    def from_lists(cls, lists, index=None):
+        lists = list(lists)
+        lengths = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if lists and all(isinstance(cell, np.ndarray) for cell in lists):
+            values = np.concatenate(lists).astype(np.float64, copy=False)
+        else:
+            values = np.array(list(chain.from_iterable(lists)), dtype=np.float64)
+        return cls(values, offsets, index)
+
+    @classmethod
+    def from_json_strings(cls, cells, index=None):
+        """
+        Decodes a column of json strings (e.g. '[1.5, 2.5]') in one pass. Cells that are already lists are kept.
+        """
+        cells = list(cells)
+        string_positions = [i for i, cell in enumerate(cells) if isinstance(cell, str)]
+        if string_positions:
+            decoded = json.loads('[' + ','.join([cells[i] for i in string_positions]) + ']')
+            for i, cell in zip(string_positions, decoded):
+                cells[i] = cell
+        return cls.from_lists(cells, index)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        # a view into the value buffer, no copy
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def row_ids(self):
+        """
+        Position of the trial of every value
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.lengths)
+
+    @property
+    def starts(self):
+        return self.offsets[:-1]
+
+    def first(self):
+        """
+        First value of every trial, nan for empty trials
+        """
+        first = np.full(len(self), np.nan)
+        nonempty = self.lengths > 0
+        first[nonempty] = self.values[self.starts[nonempty]]
+        return first
+
+    def subtract(self, per_trial_values):
+        """
+        Subtracts one value per trial from all values of the trial
+        """
+        per_trial_values = np.asarray(per_trial_values, dtype=np.float64)
+        return RaggedArray(self.values - np.repeat(per_trial_values, self.lengths), self.offsets, self.index)
+
+    def reduce(self, ufunc, values=None, empty=np.nan):
+        """
+        Per-trial reduction with a numpy ufunc (e.g. np.maximum, np.add) of values, which default to the stored
+        values but can be any array aligned with them. Empty trials get the value empty.
+        """
+        values = self.values if values is None else values
+        result = np.full(len(self), empty, dtype=np.float64)
+        nonempty = self.lengths > 0
+        if nonempty.any():
+            result[nonempty] = ufunc.reduceat(values, self.starts[nonempty])
+        return result
+
+    def truncate(self, max_lengths):
+        """
+        Keeps the first max_lengths[i] values of every trial
+        """
+        lengths = np.minimum(self.lengths, max_lengths)
+        value_positions = np.arange(len(self.values)) - np.repeat(self.starts, self.lengths)
+        keep = value_positions < np.repeat(lengths, self.lengths)
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return RaggedArray(self.values[keep], offsets, self.index)
+
+    def with_values(self, values):
+        """
+        Ragged array with the same trials and new values (e.g. the result of an elementwise operation)
+        """
+        return RaggedArray(values, self.offsets, self.index)
+
+    def take(self, positions, index=None):
+        """
+        Selects trials by position
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        lengths = self.lengths[positions]
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        value_ids = np.repeat(self.offsets[positions] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.values[value_ids], offsets, index)
+
+    def to_arrays(self):
+        """
+        List of per-trial arrays, all views into one writeable copy of the values
+        """
+        return np.split(self.values.copy(), self.offsets[1:-1]) if len(self) > 0 else []
+
+    def to_lists(self):
+        """
+        Per-trial python lists, the format of the list columns of trial data
+        """
+        return [array.tolist() for array in self.to_arrays()]
+
+
+def is_list_column(data, column):
+    """
+    True if the column holds lists/arrays
+    """
+    return data[column].dtype == object and len(data) > 0 and isinstance(data[column].iloc[0], (list, np.ndarray))
+
+
+def get_ragged(data, column):
+    """
+    Decodes a list column (lists, arrays or json strings) into a ragged array with the index of data.
+    The ragged array is not stored with the frame; pass it on to avoid decoding the column again.
+    """
+    return RaggedArray.from_json_strings(data[column], index=data.index)
+
+
+def distance_to_next(reference, queries):
+    """
+    For every query value (e.g. a touch), the distance to the first reference value (e.g. an animation frame)
+    of the same trial that is at or after it. Queries without such a reference value are dropped.
+    All trials are searched at once: every trial is shifted to its own range of one sorted key array,
+    which is searched with a single binary search.
+    """
+    if reference.values.size == 0:
+        # no reference values in any trial: every query is dropped
+        return RaggedArray(np.array([]), np.zeros(len(queries) + 1, dtype=np.int64), queries.index)
+    reference_rows = reference.row_ids
+    reference_values = reference.values
+    if reference_values.size > 1 and (np.diff(reference_values)[np.diff(reference_rows) == 0] < 0).any():
+        # the values are expected to be sorted within trials (as animation timestamps are)
+        reference_values = reference_values[np.lexsort((reference_values, reference_rows))]
+    query_rows = queries.row_ids
+    query_values = queries.values
+
+    # keys: trial position * width + value relative to the first value of the trial
+    origin = np.zeros(len(reference))
+    nonempty = reference.lengths > 0
+    origin[nonempty] = reference_values[reference.starts[nonempty]]
+    reference_relative = reference_values - origin[reference_rows]
+    span = reference_relative.max() + 1 if reference_relative.size else 1
+    width = span + 1
+    reference_keys = reference_rows * width + reference_relative
+    query_keys = query_rows * width + np.clip(query_values - origin[query_rows], 0, span)
+
+    positions = np.searchsorted(reference_keys, query_keys, side='left')
+    starts = reference.offsets[:-1][query_rows]
+    ends = reference.offsets[1:][query_rows]
+    # correct positions that are off by one because of rounding of the keys
+    last = max(reference_values.size - 1, 0)
+    behind = (positions < ends) & (reference_values[np.minimum(positions, last)] < query_values)
+    positions[behind] += 1
+    ahead = (positions > starts) & (reference_values[np.clip(positions - 1, 0, last)] >= query_values)
+    positions[ahead] -= 1
+
+    found = positions < ends
+    distances = reference_values[positions[found]] - query_values[found]
+    lengths = np.bincount(query_rows[found], minlength=len(queries))
+    offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return RaggedArray(distances, offsets, queries.index)
@@ -0,0 +1,182 @@
+import argparse
+import data_cache
+import instrumentation
+import json
+import logging
+import os
+import stage_cache
+import subject_level_stats as stats
+import sys
+import time
+
+import loading_data as loader
+
+from preprocessing import preprocessing_pipeline
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('RunAnalysisLogger')
+
+STAGES = ['load', 'preprocess', 'inhibition']
+LOAD_PATHS = ['source', 'incomplete', 'extra', 'extra_questions']
+REQUIRED_PATHS = ['out_file', 'output_dir']
+OUTPUTS_FILE = 'outputs.json'
+
+
+# Command line entry point that runs the analysis without a notebook, e.g.
+# python run_analysis.py pipeline_config.json --jobs 8 --stages preprocess inhibition
+def read_config(config_file, stages=STAGES):
+    """
+    Reads a json config with the paths (see pipeline_config.json) and the parameters of OneSubjectInhibition.
+    Relative paths are relative to the directory of the config file, so the analysis can run from anywhere.
+    """
+    with open(config_file) as f:
+        config = json.load(f)
+    required = REQUIRED_PATHS + (LOAD_PATHS if 'load' in stages else [])
+    missing = [key for key in required if config.get('paths', {}).get(key) is None]
+    if missing:
+        raise ValueError(f'The config {config_file} has no paths for {missing}. '
+                         f'Please use a config with the paths {required}.')
+    if 'inhibition' in stages and 'parameters' not in config:
+        raise ValueError(f'The config {config_file} has no parameters for the inhibition pipeline. '
+                         f'Please use a config with parameters (see pipeline_config.json).')
+    config_dir = os.path.dirname(os.path.abspath(config_file))
+    config['paths'] = {key: os.path.normpath(os.path.join(config_dir, path))
+                       for key, path in config['paths'].items() if path is not None}
+    return config
+
+
+def run_pipeline(config, stages=STAGES, n_workers=1, use_cache=True, incremental=False, progress=None):
+    """
+    Runs the selected stages: load (load_all_data, writes the combined out_file), preprocess (preprocessing_pipeline
+    on the loaded data, or on the out_file if load is not selected) and inhibition (run_inhibition_subjects on the
+    successful trials). Outputs are written to the output_dir of the config as parquet files; a stage that is not
+    selected reads the outputs of an earlier run.
+    Returns the number of subjects that failed in the inhibition pipeline.
+    """
+    progress = progress or ProgressReport()
+    paths = config['paths']
+    trial_data = None
+    data = None
+
+    if 'load' in stages:
+        start = time.perf_counter()
+        progress.message('load: combining the raw data files')
+        data = loader.load_all_data(paths, n_workers=n_workers, use_cache=use_cache, incremental=incremental)
+        progress.message(f'load: {len(data)} rows in {time.perf_counter() - start:.1f} s')
+
+    if 'preprocess' in stages:
+        start = time.perf_counter()
+        if data is None:
+            progress.message(f"preprocess: {paths['out_file']}")
+            source = {'data_file_name': paths['out_file']}
+        else:
+            # the loaded data, the out_file is not rewritten if the data was loaded from its cache
+            progress.message('preprocess: the loaded data')
+            digest = loader.data_digest(paths, use_cache=use_cache) if paths.get('stage_cache_dir') else None
+            source = {'data': data, 'data_digest': digest}
+        calibration_data, training_data, main_session_data, trial_data, question_data, calibration_params, \
+            long_trial_data = preprocessing_pipeline(cache_dir=paths.get('stage_cache_dir'), as_lists=False, **source)
+        del data
+        write_outputs({'calibration_data': calibration_data, 'calibration_params': calibration_params,
+                       'training_data': training_data, 'question_data': question_data, 'trial_data': trial_data,
+                       'successful_trials_long': long_trial_data}, paths['output_dir'])
+        progress.message(f'preprocess: {len(trial_data)} trials in {time.perf_counter() - start:.1f} s')
+
+    n_failed = 0
+    if 'inhibition' in stages:
+        start = time.perf_counter()
+        if trial_data is None:
+            trial_data = read_output(paths['output_dir'], 'trial_data')
+        successful_trials = trial_data[trial_data.success == 1]
+        progress.message(f'inhibition: {len(successful_trials)} successful trials, {n_workers} workers')
+        rates, metrics, errors = stats.run_inhibition_subjects(successful_trials, config['parameters'],
+                                                               n_workers=n_workers, progress=progress.subjects,
+                                                               **config.get('options', {}))
+        write_outputs({'rates': rates, 'metrics': metrics, 'inhibition_errors': errors}, paths['output_dir'])
+        n_failed = len(errors)
+        n_subjects = metrics['prolific_id'].nunique() if len(metrics) else 0
+        progress.message(f'inhibition: {n_subjects} subjects, {n_failed} failed, '
+                         f'in {time.perf_counter() - start:.1f} s')
+    return n_failed
+
+
+def write_outputs(frames, output_dir):
+    """
+    Writes frames (name: frame) to output_dir as parquet files, list columns as flat arrays
+    (see stage_cache.write_cached_frame), and records them in the outputs manifest
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_file = os.path.join(output_dir, OUTPUTS_FILE)
+    manifest = data_cache.read_manifest(manifest_file) or {}
+    for name, frame in frames.items():
+        manifest[name] = stage_cache.write_cached_frame(frame, output_dir, name)
+    data_cache.write_manifest(manifest, manifest_file)
+    logger.info(f'wrote {list(frames)} to {output_dir}.')
+
+
+def read_output(output_dir, name):
+    """
+    Reads a frame that was written with write_outputs
+    """
+    manifest = data_cache.read_manifest(os.path.join(output_dir, OUTPUTS_FILE))
+    if manifest is None or name not in manifest:
+        raise ValueError(f'{name} was not found in {output_dir}. '
+                         f'Please run the stage that writes it first (e.g. --stages preprocess inhibition).')
+    return stage_cache.read_cached_frame(output_dir, manifest[name])
+
+
+class ProgressReport:
+    """
+    Progress messages with the time since the start, written to the log and to stderr
+    """
+    def __init__(self, stream=sys.stderr, quiet=False):
+        self.stream = stream
+        self.quiet = quiet
+        self.start = time.perf_counter()
+        self.reported_fraction = 0
+
+    def message(self, text):
+        logger.info(text)
+        if not self.quiet:
+            print(f'[{time.perf_counter() - self.start:9.1f} s] {text}', file=self.stream, flush=True)
+
+    def subjects(self, n_done, n_total, prolific_id):
+        # about every 10 % of the subjects
+        if n_done == n_total or n_done / n_total >= self.reported_fraction + 0.1:
+            self.reported_fraction = n_done / n_total
+            self.message(f'inhibition: {n_done}/{n_total} subjects (last: {prolific_id})')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the manual inhibition analysis without a notebook. '
+                                                 'Exits with 1 if subjects failed in the inhibition pipeline.')
+    parser.add_argument('config', help='json file with paths and parameters, see pipeline_config.json')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes for loading and the subjects (0: all cores)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='rebuild the combined data set instead of using its cache')
+    parser.add_argument('--incremental', action='store_true', help='only parse data that was added since the last run')
+    parser.add_argument('--stage-cache', help='directory of the preprocessing stage cache (overrides the config)')
+    parser.add_argument('--instrumentation', help='json lines file for the timings of every stage')
+    parser.add_argument('--profile-dir', help='directory for cProfile dumps of the stages')
+    parser.add_argument('--quiet', action='store_true', help='no progress messages on stderr')
+    arguments = parser.parse_args(argv)
+
+    stages = [stage for stage in STAGES if stage in arguments.stages]
+    config = read_config(arguments.config, stages)
+    if arguments.stage_cache:
+        config['paths']['stage_cache_dir'] = os.path.abspath(arguments.stage_cache)
+    if arguments.instrumentation or arguments.profile_dir:
+        instrumentation.enable(arguments.instrumentation, arguments.profile_dir)
+    n_workers = arguments.jobs if arguments.jobs > 0 else os.cpu_count()
+
+    n_failed = run_pipeline(config, stages, n_workers, use_cache=not arguments.no_cache,
+                            incremental=arguments.incremental, progress=ProgressReport(quiet=arguments.quiet))
+    return 1 if n_failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import data_cache
+import hashing
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import time
+
+from itertools import chain
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('StageCacheLogger')
+
+INDEX_FILE = 'stage_index.json'
+
+
+# Library for caching the results of pipeline stages on disk, addressed by the hash of their inputs and code
+class Stage:
+    """
+    A named step of a pipeline. function is called with the results of inputs (names of sources or earlier stages,
+    or (name, position) for one frame of a stage with several results) and with parameters as keyword arguments.
+    code lists the functions, classes or modules whose source is part of the cache key; version can be raised to
+    invalidate the cached results after changes in code that is not listed. Stages with cached=False are cheap and
+    always recomputed, their code is still part of the keys of the stages that use their results.
+    """
+    def __init__(self, name, function, inputs=(), parameters=None, code=(), version=1, cached=True):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.parameters = parameters or {}
+        self.code = list(code) or [function]
+        self.version = version
+        self.cached = cached
+
+
+class StageCache:
+    """
+    Results of stages in a directory, one subdirectory per cache key: the frames as parquet files (see
+    data_cache.write_frame) and their list columns as flat arrays in npz files.
+    An index keeps the size and the last use of every entry; when the total size exceeds max_size_mb,
+    the least recently used entries are removed.
+    """
+    def __init__(self, directory, max_size_mb=2048):
+        self.directory = directory
+        self.max_size_mb = max_size_mb
+        os.makedirs(directory, exist_ok=True)
+        self.index_file = os.path.join(directory, INDEX_FILE)
+        self.index = data_cache.read_manifest(self.index_file) or {}
+
+    def __contains__(self, key):
+        return key in self.index and os.path.isdir(os.path.join(self.directory, key))
+
+    def load(self, key):
+        """
+        Returns the cached result of a key (a frame or a tuple of frames), None if it is not cached
+        """
+        if key not in self:
+            return None
+        entry_dir = os.path.join(self.directory, key)
+        try:
+            frames = [read_cached_frame(entry_dir, part) for part in self.index[key]['parts']]
+        except FileNotFoundError:
+            logger.info(f'A file of cache entry {key} is missing.')
+            self._remove(key)
+            return None
+        self.index[key]['last_used'] = time.time()
+        data_cache.write_manifest(self.index, self.index_file)
+        return tuple(frames) if self.index[key]['is_tuple'] else frames[0]
+
+    def save(self, key, stage_name, result):
+        """
+        Writes the result of a stage and evicts the least recently used entries if the cache is too large
+        """
+        entry_dir = os.path.join(self.directory, key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(entry_dir)
+        frames = result if isinstance(result, tuple) else (result,)
+        parts = [write_cached_frame(frame, entry_dir, f'frame{position}') for position, frame in enumerate(frames)]
+        self.index[key] = {'stage': stage_name, 'parts': parts, 'is_tuple': isinstance(result, tuple),
+                           'size': _directory_size(entry_dir), 'last_used': time.time()}
+        self.evict(keep=key)
+        data_cache.write_manifest(self.index, self.index_file)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits into max_size_mb (the entry keep is not removed)
+        """
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if total <= self.max_size_mb * 2 ** 20:
+                break
+            if key == keep:
+                continue
+            total -= self.index[key]['size']
+            logger.info(f"Evicted {self.index[key]['stage']} ({key}) from the stage cache.")
+            self._remove(key)
+
+    def clear(self):
+        for key in list(self.index):
+            self._remove(key)
+        data_cache.write_manifest(self.index, self.index_file)
+
+    def _remove(self, key):
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+        self.index.pop(key, None)
+
+
+def stage_key(stage, input_keys):
+    """
+    Cache key of a stage: hash of the keys of its inputs, its parameters, its code and its version.
+    The keys of the inputs are themselves hashes of their content (sources) or of their stages, so a key addresses
+    the content of the result.
+    """
+    description = {'stage': stage.name, 'inputs': input_keys, 'parameters': stage.parameters,
+                   'code': hashing.code_digest(stage.code), 'version': stage.version}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def run_stages(stages, sources, cache=None, outputs=None):
+    """
+    Runs a pipeline of stages. sources maps the names of external inputs to (value, content digest),
+    e.g. the name of a data file and the digest of the file. Stages are only computed if their result is needed
+    for outputs (names of stages, all stages by default) and not in cache; loaded or computed results are saved
+    to the cache and reused within the run.
+    Returns a dict of the results of outputs.
+    """
+    keys = {name: digest for name, (value, digest) in sources.items()}
+    stages = {stage.name: stage for stage in stages}
+    for stage in stages.values():
+        keys[stage.name] = stage_key(stage, [keys[_input_name(stage_input)] for stage_input in stage.inputs])
+    results = {name: value for name, (value, digest) in sources.items()}
+
+    def resolve(stage_input):
+        name = _input_name(stage_input)
+        if name not in results:
+            results[name] = _run_stage(stages[name], keys[name], cache, resolve)
+        if isinstance(stage_input, tuple):
+            return results[name][stage_input[1]]
+        return results[name]
+
+    return {name: resolve(name) for name in (outputs or list(stages))}
+
+
+def _run_stage(stage, key, cache, resolve):
+    if cache is not None and stage.cached:
+        result = cache.load(key)
+        if result is not None:
+            logger.info(f'Loaded {stage.name} from the stage cache ({key}).')
+            return result
+    start = time.perf_counter()
+    result = stage.function(*[resolve(stage_input) for stage_input in stage.inputs], **stage.parameters)
+    logger.info(f'Computed {stage.name} in {time.perf_counter() - start:.3f} s.')
+    if cache is not None and stage.cached:
+        cache.save(key, stage.name, result)
+    return result
+
+
+def _input_name(stage_input):
+    return stage_input[0] if isinstance(stage_input, tuple) else stage_input
+
+
+def write_cached_frame(data, entry_dir, name):
+    """
+    Writes a frame with its index. Columns of lists or arrays of numbers are stored only as flat arrays
+    and rebuilt from them when the frame is read.
+    """
+    list_columns = {}
+    flat_arrays = {}
+    for col in data.columns[data.dtypes == object]:
+        flat = _flatten_list_column(data[col])
+        if flat is None:
+            continue
+        number = len(list_columns)
+        flat_arrays[f'values{number}'], flat_arrays[f'offsets{number}'], as_lists = flat
+        list_columns[col] = {'number': number, 'position': data.columns.get_loc(col), 'as_lists': as_lists}
+    stored = data.drop(columns=list(list_columns))
+    file = os.path.join(entry_dir, f'{name}.parquet')
+    file_format, json_columns = data_cache.write_frame(stored.rename_axis('_row').reset_index(), file)
+    if flat_arrays:
+        np.savez(os.path.join(entry_dir, f'{name}_lists.npz'), **flat_arrays)
+    return {'name': name, 'format': file_format, 'json_columns': json_columns, 'list_columns': list_columns,
+            'dtypes': data_cache.frame_dtypes(stored)}
+
+
+def read_cached_frame(entry_dir, part):
+    file = os.path.join(entry_dir, f"{part['name']}.parquet")
+    data = data_cache.read_frame(file, part['format'], part['json_columns'], part['dtypes'])
+    data = data.set_index('_row').rename_axis(None)
+    if part['list_columns']:
+        # columns are inserted in the order of their position, so the frame gets its original column order
+        list_columns = sorted(part['list_columns'].items(), key=lambda item: item[1]['position'])
+        with np.load(os.path.join(entry_dir, f"{part['name']}_lists.npz")) as flat_arrays:
+            for col, description in list_columns:
+                number = description['number']
+                cells = _split_flat_values(flat_arrays[f'values{number}'], flat_arrays[f'offsets{number}'])
+                data.insert(description['position'], col,
+                            [cell.tolist() for cell in cells] if description['as_lists'] else cells)
+    return data
+
+
+def _flatten_list_column(column):
+    """
+    Flat values, offsets and whether the cells are python lists for a column of lists/arrays of numbers,
+    None for any other column
+    """
+    cells = column.to_list()
+    if not cells or not all(isinstance(cell, (list, np.ndarray)) for cell in cells):
+        return None
+    try:
+        if all(isinstance(cell, np.ndarray) for cell in cells):
+            values = np.concatenate(cells)
+        else:
+            values = np.array(list(chain.from_iterable(cells)))
+    except ValueError:
+        return None
+    if values.ndim != 1 or values.dtype.kind not in 'biuf':
+        return None
+    offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, cells), dtype=np.int64, count=len(cells)), out=offsets[1:])
+    return values, offsets, isinstance(cells[0], list)
+
+
+def _split_flat_values(values, offsets):
+    # one writeable copy of the values, split into per-row views
+    return np.split(values.copy(), offsets[1:-1]) if len(offsets) > 1 else []
+
+
+def _directory_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
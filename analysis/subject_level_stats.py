@@ -1,11 +1,22 @@
 import helper_funcs as helper
-import json
+import logging
 import math
 import numpy as np
 import pandas as pd
+import ragged
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from instrumentation import instrumented
+from subject_store import SubjectStore
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('SubjectStatsLogger')
 
 # Todo restructure
-# Todo add logging
 
 
 class OneSubject:
@@ -39,10 +50,10 @@ class OneSubject:
     def _set_data(self, data):
         """
         Filters the dataframe to include only data from the prolific id of the subject
-        data: pd dataframe, contains at least the column "prolific_id"
+        data: pd dataframe, contains at least the column "prolific_id", or a SubjectStore
         """
         # add checks that the the prolific ID is in the data and that all columns are in the data
-        self.data = data[data.prolific_id == self.prolific_id]
+        self.data = get_subject_rows(data, self.prolific_id)
 
     def _set_jatos_worker(self):
         self.jatos_workers = np.unique(self.data.subject)
@@ -62,13 +73,19 @@ class OneSubject:
         """
         trial_data = self.data[self.data.component == 'Trials_Serial']
         trial_data = trial_data[trial_data.test_part == 'trial']
+        # trials in which no flash onset was recorded have no event time and are dropped
+        has_flash_onset = ragged.get_ragged(trial_data, 'flashOnTime').lengths > 0
+        if not has_flash_onset.all():
+            logger.info(f'{self.prolific_id}: no flash onset was recorded in {np.sum(~has_flash_onset)} trials. '
+                        f'Dropping these trials.')
+        trial_data = trial_data[has_flash_onset].copy()
         helper.convert_string_to_array(trial_data)
         # add column with start time
         self.unsuccessful_trials = trial_data[trial_data.success == 0].dropna(axis=1)
         self.trial_data = trial_data[trial_data.success == 1].dropna(axis=1)
         self.first_trial_data = trial_data[0:200].dropna(axis=1)
         self.last_trial_data = trial_data[200:].dropna(axis=1)
-        self.preprocessed_trial_data = preprocessed_data[preprocessed_data.prolific_id == self.prolific_id]
+        self.preprocessed_trial_data = get_subject_rows(preprocessed_data, self.prolific_id)
 
     def _set_questionnaire_data(self):
         self.questionnaire_data = self.data[self.data.component == 'Outro_General']
@@ -103,6 +120,17 @@ class OneSubject:
         return unique_prop
 
 
+def get_subject_rows(data, prolific_id):
+    """
+    Rows of one subject from a data frame or a SubjectStore (without scanning the full data)
+    """
+    if data is None:
+        return None
+    if isinstance(data, SubjectStore):
+        return data.get(prolific_id)
+    return data[data.prolific_id == prolific_id]
+
+
 empty_property_array = {'all': [],
                         'flash': [],
                         'no_flash': [],
@@ -135,7 +163,17 @@ class OneSubjectInhibition(OneSubject):
         self.metrics = pd.DataFrame(columns=['flashShown', 'stimJumped', 'minimum',
                                              'magnitude', 'bottom', 'latency'])
 
-    def run_rate_pipeline(self, mask_rate=True, normalization='per_window'):
+    @instrumented()
+    def run_rate_pipeline(self, mask_rate=True, normalization='per_window', batched=True):
+        """
+        Computes onsets, trials per window, rates and baseline normalized rates of all 9 conditions.
+        batched: onsets, trials per window and kernel sums are computed once per flash x jump cell, the other
+        conditions are sums of cells (rates are linear in the onsets). Otherwise every condition is filtered
+        and computed separately.
+        """
+        if batched:
+            self.run_rate_pipeline_batched(mask_rate=mask_rate, normalization=normalization)
+            return
         flash_conditions = [None, 0, 1]
         jump_conditions = [None, 0, 1]
         for flash in flash_conditions:
@@ -155,6 +193,61 @@ class OneSubjectInhibition(OneSubject):
                 baseline = compute_baseline(self.scale, self.time_window_for_baseline, self.rates[name])
                 self.normalized_baseline_rates[name] = self.rates[name]/baseline
 
+    def run_rate_pipeline_batched(self, mask_rate=True, normalization='per_window', cell_statistics=None):
+        """
+        cell_statistics: precomputed result of compute_cell_statistics (e.g. shared by a parameter sweep)
+        """
+        if cell_statistics is None:
+            cell_statistics = self.compute_cell_statistics()
+        for flash in [None, 0, 1]:
+            for jump in [None, 0, 1]:
+                name = condition_name(flash, jump)
+                cells = condition_cells(flash, jump)
+                self.n_trials[name] = int(cell_statistics['n_trials'][cells].sum())
+                self.onsets[name] = cell_statistics['onsets'][np.isin(cell_statistics['onset_cells'], cells)]
+                self.n_trials_per_window[name] = np.maximum(cell_statistics['n_trials_per_window'][cells].sum(axis=0),
+                                                            1)
+                self.rates[name] = self.rates_from_kernel_sum(name, cell_statistics['kernel_sums'][cells].sum(axis=0),
+                                                              mask_rate=mask_rate, normalization=normalization)
+                baseline = compute_baseline(self.scale, self.time_window_for_baseline, self.rates[name])
+                self.normalized_baseline_rates[name] = self.rates[name]/baseline
+
+    @instrumented()
+    def compute_cell_statistics(self, inputs=None):
+        """
+        Statistics of the 4 flash x jump cells (cell = 2 * flashShown + stimJumped), each computed once:
+        n_trials (4), n_trials_per_window (4 x time, without minimum of 1), kernel_sums (4 x time, the summed causal
+        kernels of the onsets), and the onsets with the cell of every onset (in the order of the trials)
+        inputs: result of cell_inputs, extracted from preprocessed_trial_data if not given
+        """
+        if inputs is None:
+            inputs = cell_inputs(self.preprocessed_trial_data)
+        return {
+            'n_trials': np.bincount(inputs['trial_cells'], minlength=4),
+            'n_trials_per_window': cell_trials_per_window(inputs, self.scale),
+            'kernel_sums': cell_kernel_sums(inputs, self.scale, self.alpha),
+            'onsets': inputs['onsets'],
+            'onset_cells': inputs['onset_cells'],
+        }
+
+    def rates_from_kernel_sum(self, condition_name, kernel_sum, mask_rate, normalization='per_window'):
+        """
+        Movement rate of a condition from the sum of the causal kernels of its onsets (see helper.causal_rate)
+        """
+        if normalization == 'per_window':
+            n_trials = self.n_trials_per_window[condition_name]
+        elif normalization == 'uniform':
+            n_trials = self.n_trials[condition_name]
+        else:
+            raise ValueError('Unknown normalization argument. '
+                             'Use "per_window" or "uniform"')
+
+        rate = kernel_sum * 1000 / np.asarray(n_trials)
+        if mask_rate:
+            rate = np.multiply(rate, np.array(self.n_trials[condition_name]) > self.minimum_n_cutoff)
+        return rate
+
+    @instrumented()
     def normalize_to_null_condition(self, null_condition):
         for key in self.rates.keys():
             self.normalized_null_condition_rates[key] = normalize_rates_to_null_condition(
@@ -162,6 +255,7 @@ class OneSubjectInhibition(OneSubject):
                 self.rates[null_condition].copy()
             )
 
+    @instrumented()
     def run_metrics_pipeline(self, normalization='null_condition'):
         if normalization == 'null_condition':
             data = self.normalized_null_condition_rates
@@ -173,26 +267,15 @@ class OneSubjectInhibition(OneSubject):
             raise ValueError(f'The normalization argument {normalization} is not known. '
                              f'Please use "null_condition" (default), "baseline", "none"')
 
-        for key in data.keys():
-            metric_frame = pd.DataFrame(columns=['flashShown', 'stimJumped', 'minimum',
-                                                 'magnitude', 'bottom', 'latency'])
-            metric_frame.loc[0, 'flashShown'] = int('no_flash' not in key)
-            metric_frame.loc[0, 'stimJumped'] = int('no_shift' not in key)
-
-            metric_search_data = np.array(data[key])[self.metrics_search_start[0]:self.metrics_search_end[0]]
-            metric_frame.loc[0, 'minimum'] = np.min(metric_search_data)
-            # TODO Make this robust to different normalizations
-            metric_frame.loc[0, 'magnitude'] = 1 - metric_frame.loc[0, 'minimum']
-            metric_frame.loc[0, 'bottom'] = get_bottom_of_dip(
-                metric_search_data, metric_frame.loc[0, 'minimum']
-            )
-            try:
-                metric_frame.loc[0, 'latency'] = get_latency(
-                    metric_search_data,
-                    np.array(self.scale)[self.metrics_search_start[0]:self.metrics_search_end[0]],
-                    metric_frame.loc[0, 'minimum'])
-            except NotImplementedError:
-                print('missing latency')
+        conditions = list(data.keys())
+        metrics = compute_metrics(np.array([data[key] for key in conditions], dtype=float), self.scale,
+                                  self.metrics_search_start[0], self.metrics_search_end[0])
+        metric_frame = pd.DataFrame({'flashShown': [int('no_flash' not in key) for key in conditions],
+                                     'stimJumped': [int('no_shift' not in key) for key in conditions],
+                                     **metrics})
+        if self.metrics.empty:
+            self.metrics = metric_frame
+        else:
             self.metrics = pd.concat([self.metrics, metric_frame], ignore_index=True)
 
     def compute_onsets(self, data, condition_name):
@@ -220,41 +303,93 @@ class OneSubjectInhibition(OneSubject):
                                          n_trials, alpha=self.alpha)
         if mask_rate:
             rate = np.multiply(rate, np.array(self.n_trials[condition_name]) > self.minimum_n_cutoff)
-        self.rates[condition_name] = rate
+        self.rates[condition_name] = np.asarray(rate)
 
     def get_trials_per_window(self, data, name):
+        distribution = helper.trials_per_window(data['trialOnTime_to_trialOnTime_to_flashOnTime_aligned'],
+                                                data['trialEndTime_to_trialOnTime_to_flashOnTime_aligned'],
+                                                self.scale)
+
+        self.n_trials_per_window[name] = np.maximum(distribution, 1)
+
+    def get_trials_per_window_all_conditions(self):
+        """
+        Trials per window for all conditions in one pass: counted once per flash x jump cell,
+        the other conditions are sums of these cells
+        """
+        data = self.preprocessed_trial_data
+        cells = 2 * data['flashShown'].to_numpy(dtype=int) + data['stimJumped'].to_numpy(dtype=int)
+        cell_distributions = helper.trials_per_window(data['trialOnTime_to_trialOnTime_to_flashOnTime_aligned'],
+                                                      data['trialEndTime_to_trialOnTime_to_flashOnTime_aligned'],
+                                                      self.scale, groups=cells, n_groups=4)
+        for flash in [None, 0, 1]:
+            for jump in [None, 0, 1]:
+                distribution = cell_distributions[condition_cells(flash, jump)].sum(axis=0)
+                self.n_trials_per_window[condition_name(flash, jump)] = np.maximum(distribution, 1)
+
+
+def cell_inputs(data):
+    """
+    Everything the cell statistics need from the preprocessed trial data, independent of the rate parameters:
+    the cell of every trial, the onsets with their cells and the windows of the trials
+    """
+    trial_cells = 2 * data['flashShown'].to_numpy(dtype=int) + data['stimJumped'].to_numpy(dtype=int)
+    onsets = ragged.get_ragged(data, 'touchOnTime_to_trialOnTime_to_flashOnTime_aligned')
+    return {'trial_cells': trial_cells,
+            'onsets': onsets.values,
+            'onset_cells': trial_cells[onsets.row_ids],
+            'window_starts': data['trialOnTime_to_trialOnTime_to_flashOnTime_aligned'].to_numpy(dtype=float),
+            'window_ends': data['trialEndTime_to_trialOnTime_to_flashOnTime_aligned'].to_numpy(dtype=float)}
+
+
+def cell_trials_per_window(inputs, scale):
+    """
+    Trials per window of the 4 cells (4 x time, without minimum of 1)
+    """
+    return helper.trials_per_window(inputs['window_starts'], inputs['window_ends'], scale,
+                                    groups=inputs['trial_cells'], n_groups=4)
+
+
+def cell_kernel_sums(inputs, scale, alpha):
+    """
+    Summed causal kernels of the onsets of the 4 cells (4 x time)
+    """
+    return np.array([helper.causal_kernel_sum(inputs['onsets'][inputs['onset_cells'] == cell], scale, alpha)
+                     for cell in range(4)])
+
+
+def condition_name(flash, jump):
+    """
+    Name of a condition, e.g. flash_no_shift for flash=1, jump=0. None means both values.
+    """
+    flash_name = '' if flash is None else ['no_flash', 'flash'][flash]
+    shift_name = '' if jump is None else ['no_shift', 'shift'][jump]
+    if flash_name == '' or shift_name == '':
+        name = flash_name+shift_name
+    else:
+        name = f'{flash_name}_{shift_name}'
+    if name == '':
+        name = 'all'
+    return name
 
-        trial_windows = []
-        for i in data.index:
-            trial_scale = np.arange(round(self.preprocessed_trial_data[
-                                              'trialOnTime_to_trialOnTime_to_flashOnTime_aligned'][i]),
-                                    round(self.preprocessed_trial_data[
-                                              'trialEndTime_to_trialOnTime_to_flashOnTime_aligned'][i]), 1)
-            trial_windows.append(trial_scale)
-        trial_windows = np.concatenate(trial_windows).flatten()
-        distribution, scale = np.histogram(trial_windows, bins=np.append(self.scale, self.scale[-1] + 1))
-        distribution = [max(1, x) for x in distribution]
 
-        self.n_trials_per_window[name] = distribution
+def condition_cells(flash, jump):
+    """
+    The flash x jump cells (2 * flashShown + stimJumped) that make up a condition
+    """
+    flash_values = [0, 1] if flash is None else [flash]
+    jump_values = [0, 1] if jump is None else [jump]
+    return [2 * f + j for f in flash_values for j in jump_values]
 
 
 def filter_by_conditions(data, kwargs):
-    flash_name = ''
-    shift_name = ''
     if not kwargs['flashShown'] is None:
         data = data[data['flashShown'] == kwargs['flashShown']]
-        flash_name = ['no_flash', 'flash'][kwargs['flashShown']]
     if not kwargs['stimJumped'] is None:
         data = data[data['stimJumped'] == kwargs['stimJumped']]
-        shift_name = ['no_shift', 'shift'][kwargs['stimJumped']]
 
     # determine the condition name
-    if flash_name == '' or shift_name == '':
-        name = flash_name+shift_name
-    else:
-        name = f'{flash_name}_{shift_name}'
-    if name == '':
-        name = 'all'
+    name = condition_name(kwargs['flashShown'], kwargs['stimJumped'])
 
     return data, name
 
@@ -273,6 +408,52 @@ def normalize_rates_to_null_condition(rates, null_rates):
     return rates/null_rates
 
 
+def compute_metrics(curves, scale, search_start, search_end, baseline=1):
+    """
+    Dip metrics of a stack of rate curves (e.g. conditions x time or subjects x conditions x time), computed with
+    reductions over the last axis within scale[search_start:search_end]:
+    minimum, magnitude (1 - minimum), bottom (see get_bottom_of_dip) and latency (see get_latency, nan if the
+    curve has no minimum, e.g. contains nan). Returns a dict of arrays with the shape of the leading axes.
+    """
+    search_data = np.asarray(curves, dtype=float)[..., search_start:search_end]
+    search_scale = np.asarray(scale)[search_start:search_end]
+    minimum = search_data.min(axis=-1)
+    tolerance = (baseline - minimum) * 0.1
+    bottom = np.sum(search_data < (minimum + tolerance)[..., np.newaxis], axis=-1)
+    at_minimum = search_data == minimum[..., np.newaxis]
+    latency = np.where(at_minimum.any(axis=-1), search_scale[np.argmax(at_minimum, axis=-1)], np.nan)
+    return {'minimum': minimum, 'magnitude': 1 - minimum, 'bottom': bottom, 'latency': latency}
+
+
+def stack_rates_frame(rates, column='normalized_null_condition_rate'):
+    """
+    Stacks a column of a tidy rates frame (see run_inhibition_subjects) to subjects x conditions x time,
+    missing curves are nan. Returns subjects, conditions, scale and the stack.
+    """
+    subjects, subject_ids = np.unique(rates['prolific_id'].astype(str), return_inverse=True)
+    conditions, condition_ids = np.unique(rates['condition'], return_inverse=True)
+    scale, time_ids = np.unique(rates['time'], return_inverse=True)
+    curves = np.full((len(subjects), len(conditions), len(scale)), np.nan)
+    curves[subject_ids, condition_ids, time_ids] = rates[column].to_numpy(dtype=float)
+    return subjects, conditions, scale, curves
+
+
+def metrics_from_rates_frame(rates, search_start, search_end, column='normalized_null_condition_rate'):
+    """
+    Metrics of all subjects and conditions of a tidy rates frame (see run_inhibition_subjects) in one batch:
+    the curves are stacked to subjects x conditions x time. search_start and search_end are time points.
+    Returns one frame with a row per subject and condition.
+    """
+    subjects, conditions, scale, curves = stack_rates_frame(rates, column)
+    search = np.where((scale >= search_start) & (scale < search_end))[0]
+    metrics = compute_metrics(curves, scale, search[0], search[-1] + 1)
+    return pd.DataFrame({'prolific_id': np.repeat(subjects, len(conditions)),
+                         'condition': np.tile(conditions, len(subjects)),
+                         'flashShown': np.tile([int('no_flash' not in key) for key in conditions], len(subjects)),
+                         'stimJumped': np.tile([int('no_shift' not in key) for key in conditions], len(subjects)),
+                         **{name: values.ravel() for name, values in metrics.items()}})
+
+
 def get_latency(data, time_scale, minimum):
     """latency is the time point of the minimum"""
     return time_scale[np.where(data == minimum)[0][0]]
@@ -285,76 +466,227 @@ def get_bottom_of_dip(rates, minimum_frequency, baseline=1):
     bottom = np.where(rates < minimum_frequency + tolerance)
     return len(bottom[0])
 
+
+@instrumented()
+def run_inhibition_subjects(preprocessed_trial_data, parameter_dict, data=None, n_workers=1, deterministic=True,
+                            null_condition='no_flash_no_shift', mask_rate=True, normalization='per_window',
+                            metrics_normalization='null_condition', progress=None):
+    """
+    Runs the rate, null condition normalization and metrics pipelines of OneSubjectInhibition for all subjects.
+    The trial data is split by prolific_id once, and every worker of the process pool receives only the partition
+    of its subject. If data (the combined data set) is given, set_all_properties is run on the subject's
+    partition as well.
+    deterministic: results are ordered by prolific_id, otherwise in the order in which subjects finish
+    progress: called with the number of finished subjects, the number of subjects and the prolific id of the
+    last finished subject
+    Returns three tidy frames: rates (one row per subject, condition and time point), metrics (one row per subject
+    and condition) and errors (subjects that failed, with the traceback). A failing subject does not stop the others.
+    """
+    trial_partitions = _partition_by_subject(preprocessed_trial_data)
+    data_partitions = _partition_by_subject(data) if data is not None else {}
+    options = {'null_condition': null_condition, 'mask_rate': mask_rate, 'normalization': normalization,
+               'metrics_normalization': metrics_normalization}
+    jobs = [(prolific_id, trials, data_partitions.get(prolific_id), parameter_dict, options)
+            for prolific_id, trials in trial_partitions.items()]
+
+    results = []
+    if n_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_run_one_inhibition_subject, *job) for job in jobs]
+            for future in as_completed(futures):
+                results.append(future.result())
+                if progress is not None:
+                    progress(len(results), len(jobs), results[-1][0])
+    else:
+        for job in jobs:
+            results.append(_run_one_inhibition_subject(*job))
+            if progress is not None:
+                progress(len(results), len(jobs), results[-1][0])
+    if deterministic:
+        results = sorted(results, key=lambda result: str(result[0]))
+
+    rates, metrics, errors = [], [], []
+    for prolific_id, subject_rates, subject_metrics, run_time, error in results:
+        if error is not None:
+            logger.error(f'subject {prolific_id} failed after {run_time:.3f} s:\n{error}')
+            errors.append({'prolific_id': prolific_id, 'error': error})
+            continue
+        logger.info(f'subject {prolific_id} was analysed in {run_time:.3f} s.')
+        rates.append(subject_rates)
+        metrics.append(subject_metrics)
+
+    rates = pd.concat(rates, ignore_index=True) if rates else pd.DataFrame()
+    metrics = pd.concat(metrics, ignore_index=True) if metrics else pd.DataFrame()
+    return rates, metrics, pd.DataFrame(errors, columns=['prolific_id', 'error'])
+
+
+def _partition_by_subject(data):
+    """
+    Splits a frame (or a SubjectStore) by prolific_id in one pass
+    """
+    if isinstance(data, SubjectStore):
+        return {prolific_id: data.get(prolific_id).copy() for prolific_id in data.subjects}
+    return dict(iter(data.groupby('prolific_id', sort=False, observed=True)))
+
+
+def _run_one_inhibition_subject(prolific_id, trial_data, data, parameter_dict, options):
+    """
+    Runs all pipelines of one subject. Returns the tidy rates and metrics, the run time and a possible error.
+    """
+    start = time.perf_counter()
+    try:
+        subject = OneSubjectInhibition(prolific_id, parameter_dict)
+        if data is not None:
+            subject.set_all_properties(data, trial_data)
+        else:
+            subject.preprocessed_trial_data = trial_data
+        subject.run_rate_pipeline(mask_rate=options['mask_rate'], normalization=options['normalization'])
+        subject.normalize_to_null_condition(options['null_condition'])
+        subject.run_metrics_pipeline(normalization=options['metrics_normalization'])
+        rates = subject_rates_frame(subject)
+        metrics = subject.metrics.copy()
+        metrics.insert(0, 'condition', list(subject.rates.keys()))
+        metrics.insert(0, 'prolific_id', prolific_id)
+    except Exception:
+        return prolific_id, None, None, time.perf_counter() - start, traceback.format_exc()
+    return prolific_id, rates, metrics, time.perf_counter() - start, None
+
+
+def subject_rates_frame(subject):
+    """
+    Tidy frame of the rates of one OneSubjectInhibition: one row per condition and time point
+    """
+    conditions = list(subject.rates.keys())
+    n_scale = len(subject.scale)
+    return pd.DataFrame({
+        'prolific_id': subject.prolific_id,
+        'condition': np.repeat(conditions, n_scale),
+        'time': np.tile(subject.scale, len(conditions)),
+        'n_trials': np.repeat([subject.n_trials[key] for key in conditions], n_scale),
+        'n_trials_per_window': np.concatenate([subject.n_trials_per_window[key] for key in conditions]),
+        'rate': np.concatenate([subject.rates[key] for key in conditions]),
+        'normalized_baseline_rate': np.concatenate([subject.normalized_baseline_rates[key] for key in conditions]),
+        'normalized_null_condition_rate': np.concatenate([subject.normalized_null_condition_rates[key]
+                                                          for key in conditions]),
+    })
+
+
 ##########################################################
 # TODO: Later ############################################
 ##########################################################
 
 
 class OneSubjectErrorSize(OneSubject):
-    def __init__(self, prolific_id, data):
+    """
+    Touch error of one subject: distance between every touch and the original/shifted dot position, and its moving
+    average over time relative to the flash onset for the four flash x jump conditions.
+    smooth: half width of the moving average window in ms, time_range: (first, last) time point of the error curves
+    """
+    def __init__(self, prolific_id, data, preprocessed_trial_data=None, smooth=40, time_range=(-500, 1000)):
         OneSubject.__init__(self, prolific_id)
-        self.set_all_properties(data)
+        self.set_all_properties(data, preprocessed_trial_data)
         self.baseline = None
-        self.smooth = 40
+        self.smooth = smooth
+        self.scale = np.arange(time_range[0], time_range[1], 1)
         self.flash_shift = None
         self.flash_noshift = None
         self.noflash_shift = None
         self.noflash_noshift = None
+        self.error_original = {}
+        self.error_shifted = {}
+
+    @instrumented()
+    def run_error_pipeline(self):
+        self.get_distance_to_dot('position_x', 'position_y', 'distance_original')
+        self.get_distance_to_dot('shifted_position_x', 'shifted_position_y', 'distance_shifted')
+        self.get_distance_to_event()
+        self.parse_conditions()
+        self.compute_error_all_conditions()
 
     def get_distance_to_dot(self, dot_x, dot_y, colname):
-        distance = []
-        for i in self.trial_data.index:
-            touch_x = json.loads(self.trial_data.loc[i, 'touchX'])
-            touch_y = json.loads(self.trial_data.loc[i, 'touchY'])
-            position_x = json.loads(self.trial_data.loc[i, dot_x])
-            position_y = json.loads(self.trial_data.loc[i, dot_y])
-            width = self.trial_data.loc[i, 'windowWidth']/2
-            height = self.trial_data.loc[i, 'windowHeight']/2
-
-            dist = [compute_distance_pythagoras(
-                touch_x[x], position_x[x] + width, touch_y[x], position_y[x] + height
-            ) for x in range(len(touch_x))]
-            distance.append(dist)
-
-        self.trial_data[colname] = distance
+        """
+        Distance between every touch and the dot (positions are relative to the screen center), computed on the
+        decoded lists of all trials at once
+        """
+        touch_x = ragged.get_ragged(self.trial_data, 'touchX_list')
+        touch_y = ragged.get_ragged(self.trial_data, 'touchY_list')
+        n_touches = np.minimum(touch_x.lengths, ragged.get_ragged(self.trial_data, f'{dot_x}_list').lengths)
+        touch_x, touch_y = touch_x.truncate(n_touches), touch_y.truncate(n_touches)
+        position_x = ragged.get_ragged(self.trial_data, f'{dot_x}_list').truncate(n_touches)
+        position_y = ragged.get_ragged(self.trial_data, f'{dot_y}_list').truncate(n_touches)
+        width = np.repeat(self.trial_data['windowWidth'].to_numpy(dtype=float) / 2, n_touches)
+        height = np.repeat(self.trial_data['windowHeight'].to_numpy(dtype=float) / 2, n_touches)
+
+        distance = touch_x.with_values(helper.compute_distance_pythagoras(
+            touch_x.values, position_x.values + width, touch_y.values, position_y.values + height))
+        self.trial_data[colname] = distance.to_lists()
 
     def get_distance_to_event(self):
-        onset_to_start = align_to_start(self.trial_data, 'touchOn', 'startTime')
-        onset_to_flash = align_to_start(onset_to_start, 'touchOn_to_startTime', 'flashOnTime')
-
-        self.trial_data['distance_to_onset'] = onset_to_flash.touchOn_to_startTime_to_flashOnTime
+        """
+        Time of every touch relative to the flash onset (flash on time is relative to the start time)
+        """
+        event_on = self.trial_data['startTime'].to_numpy(dtype=float) + self.trial_data['eventOn_float'].to_numpy(
+            dtype=float)
+        distance = ragged.get_ragged(self.trial_data, 'touchOn_list').subtract(event_on)
+        self.trial_data['distance_to_onset'] = distance.to_lists()
 
     def parse_conditions(self):
         flash_data = self.trial_data[self.trial_data.flashShown == 1]
         noflash_data = self.trial_data[self.trial_data.flashShown == 0]
 
-        self.flash_shift = flash_data[flash_data.stimJumped == 1].reset_index(drop=True)
-        self.flash_noshift = flash_data[flash_data.stimJumped == 0].reset_index(drop=True)
-        self.noflash_shift = noflash_data[noflash_data.stimJumped == 1].reset_index(drop=True)
-        self.noflash_noshift = noflash_data[noflash_data.stimJumped == 0].reset_index(drop=True)
+        self.flash_shift = flash_data[flash_data.stimJumped == 1]
+        self.flash_noshift = flash_data[flash_data.stimJumped == 0]
+        self.noflash_shift = noflash_data[noflash_data.stimJumped == 1]
+        self.noflash_noshift = noflash_data[noflash_data.stimJumped == 0]
 
-        self.baseline = np.mean(np.concatenate(self.noflash_noshift.distance_original).flatten())
+        self.baseline = np.mean(ragged.get_ragged(self.noflash_noshift, 'distance_original').values)
 
     def compute_moving_average_error(self, data):
-        distance_original = np.concatenate(data.distance_original).flatten()
-        distance_shifted = np.concatenate(data.distance_shifted).flatten()
-        time = np.concatenate(data.distance_to_onset).flatten()
-
-        # sort all arrays by time
-        idx = time.argsort()
-        distance_original = distance_original[idx]
-        distance_shifted = distance_shifted[idx]
-        time = time[idx]
-
-        distance_original_smooth = [smooth_array(
-            distance_original, time, self.smooth, self.smooth, i
-        ) for i in np.arange(-500, 1000, 1)]
+        """
+        Moving average of the distances to the original and shifted dot positions of the trials in data
+        """
+        distances, time, _ = self._touch_errors(data)
+        distance_original_smooth, distance_shifted_smooth = helper.moving_average(
+            distances, time, self.smooth, self.smooth, self.scale)
+        return distance_original_smooth, distance_shifted_smooth, self.scale
 
-        distance_shifted_smooth = [smooth_array(
-            distance_shifted, time, self.smooth, self.smooth, i
-        ) for i in np.arange(-500, 1000, 1)]
+    def compute_error_all_conditions(self):
+        """
+        Moving average errors of the four flash x jump conditions, computed in one batch with one sort of all touches
+        """
+        distances, time, touch_rows = self._touch_errors(self.trial_data)
+        trial_cells = 2 * self.trial_data['flashShown'].to_numpy(dtype=int) + \
+            self.trial_data['stimJumped'].to_numpy(dtype=int)
+        smoothed = helper.moving_average(distances, time, self.smooth, self.smooth, self.scale,
+                                         groups=trial_cells[touch_rows], n_groups=4)
+        for cell in range(4):
+            name = condition_name(cell // 2, cell % 2)
+            self.error_original[name], self.error_shifted[name] = smoothed[cell]
+
+    @staticmethod
+    def _touch_errors(data):
+        """
+        Distances (original, shifted), times and trial positions of all touches that have a distance
+        """
+        time = ragged.get_ragged(data, 'distance_to_onset')
+        distance_original = ragged.get_ragged(data, 'distance_original')
+        distance_shifted = ragged.get_ragged(data, 'distance_shifted')
+        time = time.truncate(distance_original.lengths)
+        return np.array([distance_original.values, distance_shifted.values]), time.values, time.row_ids
 
-        return distance_original_smooth, distance_shifted_smooth, np.arange(-500, 1000, 1)
+    def error_frame(self):
+        """
+        Tidy frame of the error curves: one row per condition and time point
+        """
+        conditions = list(self.error_original.keys())
+        n_scale = len(self.scale)
+        return pd.DataFrame({
+            'prolific_id': self.prolific_id,
+            'condition': np.repeat(conditions, n_scale),
+            'time': np.tile(self.scale, len(conditions)),
+            'error_original': np.concatenate([self.error_original[key] for key in conditions]),
+            'error_shifted': np.concatenate([self.error_shifted[key] for key in conditions]),
+        })
 
 
 def assert_condition(condition, function):
@@ -0,0 +1,88 @@
+import data_cache
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('SubjectStoreLogger')
+
+
+class SubjectStore:
+    """
+    The rows of a data frame (combined data or preprocessed trial data), partitioned by prolific_id.
+    In memory, the frame is sorted by prolific_id once (keeping the order of rows within each subject), so that
+    every subject is a contiguous row range and get costs O(rows of the subject).
+    On disk, every subject is a separate file that is only loaded when it is requested.
+    OneSubject accepts a SubjectStore wherever it accepts the full data frame.
+    """
+    def __init__(self, data=None, ranges=None, directory=None, files=None, columns=None):
+        self.data = data
+        self.ranges = ranges or {}
+        self.directory = directory
+        self.files = files or {}
+        self.columns = list(data.columns) if data is not None else list(columns or [])
+        self.loaded = {}
+
+    @classmethod
+    def from_frame(cls, data):
+        codes, subjects = pd.factorize(data['prolific_id'])
+        order = np.argsort(codes, kind='stable')
+        # rows without prolific id (code -1) are sorted to the front and not part of any subject
+        counts = np.bincount(codes[codes >= 0], minlength=len(subjects))
+        ends = np.cumsum(counts) + np.sum(codes < 0)
+        ranges = {subject: (int(end - count), int(end)) for subject, count, end in zip(subjects, counts, ends)}
+        logger.info(f'partitioned {len(data)} rows into {len(subjects)} subjects.')
+        return cls(data=data.take(order), ranges=ranges)
+
+    @classmethod
+    def open(cls, directory):
+        """
+        Opens a store that was saved with save, no subject is loaded yet
+        """
+        with open(os.path.join(directory, 'subjects.json')) as f:
+            index = json.load(f)
+        return cls(directory=directory, files=index['files'], columns=index['columns'])
+
+    def save(self, directory):
+        """
+        Writes one file per subject and an index of the files and the columns
+        """
+        os.makedirs(directory, exist_ok=True)
+        files = {}
+        for number, prolific_id in enumerate(self.subjects):
+            file = f'subject_{number:05d}.parquet'
+            partition = self.get(prolific_id)
+            file_format, json_columns = data_cache.write_frame(partition.rename_axis('_row').reset_index(),
+                                                               os.path.join(directory, file))
+            files[prolific_id] = {'file': file, 'format': file_format, 'json_columns': json_columns,
+                                  'dtypes': data_cache.frame_dtypes(partition)}
+        with open(os.path.join(directory, 'subjects.json'), 'w') as f:
+            json.dump({'columns': self.columns, 'files': files}, f, indent=1)
+        logger.info(f'saved {len(files)} subjects to {directory}.')
+
+    @property
+    def subjects(self):
+        return list(self.ranges) if self.data is not None else list(self.files)
+
+    def __contains__(self, prolific_id):
+        return prolific_id in self.ranges or prolific_id in self.files
+
+    def get(self, prolific_id):
+        """
+        Rows of one subject, an empty frame with the columns of the store if the subject is not in the store
+        """
+        if self.data is not None:
+            start, end = self.ranges.get(prolific_id, (0, 0))
+            return self.data.iloc[start:end]
+        if prolific_id not in self.loaded:
+            if prolific_id not in self.files:
+                return pd.DataFrame(columns=self.columns)
+            entry = self.files[prolific_id]
+            partition = data_cache.read_frame(os.path.join(self.directory, entry['file']), entry['format'],
+                                              entry['json_columns'], entry['dtypes'])
+            self.loaded[prolific_id] = partition.set_index('_row').rename_axis(None)
+        return self.loaded[prolific_id]
@@ -0,0 +1,254 @@
+import json
+import logging
+import numpy as np
+import os
+
+logging.basicConfig(filename='manual_inhibition_analysis.log',
+                    level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('SyntheticDataLogger')
+
+N_DOTS = 6
+TRIAL_DURATION = 1500
+FLASH_DURATION = 50
+USER_AGENTS = ['Mozilla/5.0 (Linux; Android 10; SM-A505FN) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/98.0.4758.101 Mobile Safari/537.36',
+               'Mozilla/5.0 (iPhone; CPU iPhone OS 15_3 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+               'Version/15.3 Mobile/15E148 Safari/604.1',
+               'Mozilla/5.0 (Linux; Android 11; Pixel 4a) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/99.0.4844.58 Mobile Safari/537.36']
+
+
+# Library for synthetic JATOS result files of the manual inhibition experiment
+def write_jatos_export(directory, n_subjects=10, n_sessions=1, n_trials=200, seed=0, incomplete_fraction=0.1):
+    """
+    Writes a synthetic data set in the layout load_all_data expects: a JATOS result file (one json array of
+    jsPsych records per component), a directory with incomplete sessions, an additional result file and the
+    missing questionnaire csv. Every session has the Calibrate_Screen, Trials_Serial (with n_trials trials,
+    failed trials are repeated) and Outro_General components, the first session also Training_Serial.
+    The trial records follow canvas-manual-inhibition-serial.js.
+    Returns the path_names of the data set.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(directory, 'incomplete_main_sessions'), exist_ok=True)
+    path_names = {'source': os.path.join(directory, 'full_datafile.txt'),
+                  'incomplete': os.path.join(directory, 'incomplete_main_sessions'),
+                  'extra': os.path.join(directory, 'additional_datafile.txt'),
+                  'extra_questions': os.path.join(directory, 'missing_questionnaire.csv'),
+                  'out_file': os.path.join(directory, 'full_datafile.csv')}
+    study_ids = [_hex_id(rng) for _ in range(n_sessions + 1)]
+
+    n_records = 0
+    with open(path_names['source'], 'w') as source:
+        for subject_number in range(n_subjects):
+            subject = _subject_properties(rng, subject_number)
+            for session_number in range(1, n_sessions + 1):
+                for component in session_components(rng, subject, session_number, study_ids[session_number - 1],
+                                                    n_trials):
+                    source.write(json.dumps(component) + '\n')
+                    n_records += len(component)
+            if rng.random() < incomplete_fraction:
+                # an aborted additional session, saved from the JATOS result page
+                components = session_components(rng, subject, n_sessions + 1, study_ids[-1], n_trials)
+                aborted = components[0] + components[1][:int(rng.integers(1, len(components[1])))]
+                with open(os.path.join(path_names['incomplete'], f'{subject["prolific_id"]}.json'), 'w') as f:
+                    json.dump(aborted, f)
+    with open(path_names['extra'], 'w'):
+        pass
+    with open(path_names['extra_questions'], 'w') as f:
+        f.write('subject,prolific_id,study_id,session_id,session_number,component,test_part,response\n')
+    logger.info(f'wrote {n_records} records of {n_subjects} subjects with {n_sessions} sessions to {directory}.')
+    return path_names
+
+
+def session_components(rng, subject, session_number, study_id, n_trials):
+    """
+    The components of one session as lists of jsPsych records, in the order in which JATOS saves them
+    """
+    properties = {'subject': subject['subject'], 'prolific_id': subject['prolific_id'], 'study_id': study_id,
+                  'session_id': _hex_id(rng), 'session_number': session_number}
+    clock = _Clock(rng)
+    components = [_with_properties(calibration_records(rng, subject, clock), properties, 'Calibrate_Screen')]
+    if session_number == 1:
+        components.append(_with_properties(trial_records(rng, subject, clock, 12), properties, 'Training_Serial'))
+    components.append(_with_properties(trial_records(rng, subject, clock, n_trials), properties, 'Trials_Serial'))
+    components.append(_with_properties(questionnaire_records(rng, clock), properties, 'Outro_General'))
+    return components
+
+
+def calibration_records(rng, subject, clock):
+    """
+    Fullscreen request and virtual chinrest records
+    """
+    view_distance = rng.uniform(300, 500)
+    px2mm = subject['px2deg'] / (view_distance * np.tan(np.radians(1)))
+    return [
+        {'trial_type': 'fullscreen', 'test_part': 'fullscreen_request', 'success': True, 'rt': clock.advance(2000)},
+        {'trial_type': 'virtual-chinrest', 'test_part': 'virtual_chinrest', 'rt': clock.advance(30000),
+         'item_width_mm': 85.6, 'item_height_mm': 53.98, 'item_width_px': round(85.6 * px2mm, 2),
+         'px2mm': px2mm, 'view_dist_mm': view_distance, 'px2deg': subject['px2deg'],
+         'item_width_deg': 85.6 * px2mm / subject['px2deg'],
+         'win_width_deg': subject['window_width'] / subject['px2deg'],
+         'win_height_deg': subject['window_height'] / subject['px2deg']},
+    ]
+
+
+def trial_records(rng, subject, clock, n_trials):
+    """
+    The trials of a block: every condition of the 2 x 2 flash x jump design in equal parts, in random order.
+    Each trial is followed by a feedback screen, failed trials are repeated once at the end of the block.
+    """
+    design = [(trial_id, trial_id % 2, (trial_id // 2) % 2) for trial_id in range(n_trials)]
+    design = [design[i] for i in rng.permutation(n_trials)]
+    records = [{'trial_type': 'fullscreen', 'test_part': 'fullscreen_request', 'success': True,
+                'rt': clock.advance(1500)}]
+    repeats = []
+    for trial_id, flash_shown, stim_jumped in design:
+        record = simulate_trial(rng, subject, clock, trial_id, flash_shown, stim_jumped)
+        records.append(record)
+        records.append({'trial_type': 'html-keyboard-response', 'test_part': 'feedback', 'rt': clock.advance(500)})
+        if not record['success']:
+            repeats.append((trial_id, flash_shown, stim_jumped))
+    for trial_id, flash_shown, stim_jumped in repeats:
+        records.append(simulate_trial(rng, subject, clock, trial_id, flash_shown, stim_jumped))
+    return records
+
+
+def simulate_trial(rng, subject, clock, trial_id, flash_shown, stim_jumped):
+    """
+    One canvas-mi-serial record. Dots are arranged from left to right (positions relative to the screen center,
+    in pixel), touches follow the dots in order and are delayed after a flash (the inhibition).
+    Times are performance.now() timestamps, flash on and off times are relative to startTime (the first touch).
+    """
+    ppd = subject['px2deg']
+    position_x = (np.linspace(-7, 7, N_DOTS) + rng.uniform(-0.5, 0.5, N_DOTS)) * ppd
+    position_y = rng.uniform(-2, 2, N_DOTS) * ppd
+    if stim_jumped:
+        shifted_x = position_x + rng.uniform(-0.5, 0.5, N_DOTS) * ppd
+        shifted_y = position_y + rng.choice([-1, 1], N_DOTS) * rng.uniform(0.5, 1, N_DOTS) * ppd
+    else:
+        shifted_x, shifted_y = position_x, position_y
+    change_onset = [float(rng.uniform(0, 1000))]
+
+    # touches: first touch starts the trial, inter-touch intervals, delayed after the flash
+    first_frame = clock.now
+    start_time = first_frame + rng.uniform(200, 600)
+    intervals = rng.gamma(8, subject['touch_interval'] / 8, N_DOTS - 1)
+    touch_on = start_time + np.concatenate([[0], np.cumsum(intervals)])
+    if flash_shown:
+        inhibited = (touch_on - start_time > change_onset[0] + 60) & (touch_on - start_time < change_onset[0] + 220)
+        if inhibited.any():
+            touch_on[np.argmax(inhibited):] += rng.uniform(40, 120)
+    error = rng.random()
+    if error < subject['error_rate'] / 2:
+        # too many touches
+        touch_on = np.sort(np.append(touch_on, rng.uniform(touch_on[0], touch_on[-1])))
+    elif error < subject['error_rate']:
+        # late response: touches after the trial duration are not recorded
+        touch_on = touch_on[touch_on - start_time < TRIAL_DURATION * rng.uniform(0.5, 1)]
+    touch_off = touch_on + rng.uniform(40, 90, len(touch_on))
+
+    # animation frames until the last dot was selected or the trial duration is over
+    frame_period = 1000 / subject['refresh_rate']
+    end_limit = start_time + TRIAL_DURATION if len(touch_on) < N_DOTS else touch_on[-1]
+    n_frames = int(np.ceil((end_limit - first_frame) / frame_period)) + 1
+    frames = first_frame + np.arange(n_frames) * frame_period + rng.normal(0, 0.3, n_frames)
+    frames = np.sort(frames)
+    end_time = frames[-1]
+
+    relative_frames = frames[frames >= start_time] - start_time
+    flash_on = relative_frames[relative_frames > change_onset[0]][:1]
+    flash_off = relative_frames[relative_frames >= flash_on[0] + FLASH_DURATION][:1] if len(flash_on) else []
+
+    # touch positions: the dot that is next in order, shifted after the change
+    n_selected = min(len(touch_on), N_DOTS)
+    after_change = touch_on[:n_selected] - start_time > change_onset[0]
+    target_x = np.where(after_change, shifted_x[:n_selected], position_x[:n_selected])
+    target_y = np.where(after_change, shifted_y[:n_selected], position_y[:n_selected])
+    touch_x = np.concatenate([target_x, rng.uniform(-7, 7, len(touch_on) - n_selected) * ppd])
+    touch_y = np.concatenate([target_y, rng.uniform(-2, 2, len(touch_on) - n_selected) * ppd])
+    touch_x = np.round(touch_x + subject['window_width'] / 2 + rng.normal(0, 0.3 * ppd, len(touch_on)))
+    touch_y = np.round(touch_y + subject['window_height'] / 2 + rng.normal(0, 0.3 * ppd, len(touch_on)))
+    choice_order = list(range(n_selected))
+
+    clock.set(end_time)
+    too_many_touches = len(touch_on) > N_DOTS
+    late_response = len(choice_order) != N_DOTS
+    return {
+        'trial_type': 'canvas-mi-serial', 'test_part': 'trial', 'time_elapsed': clock.elapsed,
+        'flashTime': change_onset, 'trialID': trial_id, 'stimJumped': stim_jumped, 'flashShown': flash_shown,
+        'startTime': start_time, 'endTime': end_time,
+        'flashOnTime': [float(t) for t in flash_on], 'flashOffTime': [float(t) for t in flash_off],
+        'touchOn': touch_on.tolist(), 'touchOff': touch_off.tolist(),
+        'scheduled_change_onset': change_onset, 'flash_duration': FLASH_DURATION,
+        'change_onset': change_onset[0], 'trial_duration': TRIAL_DURATION,
+        'animation_timestamps': frames.tolist(),
+        'touchX': touch_x.tolist(), 'touchY': touch_y.tolist(), 'choiceOrder': choice_order,
+        'position_x': position_x.tolist(), 'position_y': position_y.tolist(),
+        'shifted_position_x': shifted_x.tolist(), 'shifted_position_y': shifted_y.tolist(),
+        'lateResponse': late_response, 'orderResponse': True, 'tooManyTouches': too_many_touches,
+        'screenInLandscape': True, 'success': not late_response and not too_many_touches,
+        'windowWidth': subject['window_width'], 'windowHeight': subject['window_height'],
+        'userInfo': subject['user_agent'], 'platform': subject['platform'],
+    }
+
+
+def questionnaire_records(rng, clock):
+    scale = ['very distracted', 'distracted', 'neutral', 'concentrated', 'very concentrated']
+    concentration = int(rng.integers(0, len(scale)))
+    return [
+        {'trial_type': 'html-slider-response', 'test_part': 'outro_concentration', 'response': concentration,
+         'survey_response': scale[concentration], 'rt': clock.advance(4000)},
+        {'trial_type': 'html-button-response', 'test_part': 'outro_finger', 'response': int(rng.integers(0, 3)),
+         'rt': clock.advance(3000)},
+        {'trial_type': 'html-button-response', 'test_part': 'outro_screen', 'response': int(rng.integers(0, 2)),
+         'rt': clock.advance(3000)},
+        {'trial_type': 'html-button-response', 'test_part': 'outro_hand', 'response': int(rng.integers(0, 2)),
+         'rt': clock.advance(3000)},
+        {'trial_type': 'survey-text', 'test_part': 'outro_comments', 'response': {'Q0': ''},
+         'rt': clock.advance(5000)},
+        {'trial_type': 'html-button-response', 'test_part': 'outro_bye', 'response': 0, 'rt': clock.advance(2000)},
+    ]
+
+
+class _Clock:
+    """
+    performance.now() of a page: starts at page load and is advanced by the records
+    """
+    def __init__(self, rng):
+        self.rng = rng
+        self.start = rng.uniform(500, 3000)
+        self.now = self.start
+
+    @property
+    def elapsed(self):
+        return int(self.now - self.start)
+
+    def advance(self, mean_duration):
+        duration = float(mean_duration * np.exp(self.rng.normal(0, 0.2)))
+        self.now += duration
+        return duration
+
+    def set(self, now):
+        self.now = now
+
+
+def _subject_properties(rng, subject_number):
+    window_width, window_height = [(780, 360), (844, 390), (915, 412)][int(rng.integers(0, 3))]
+    return {'subject': 1000 + subject_number, 'prolific_id': _hex_id(rng),
+            'px2deg': float(rng.uniform(25, 45)), 'window_width': window_width, 'window_height': window_height,
+            'refresh_rate': float(rng.choice([60, 60, 90, 120])), 'touch_interval': float(rng.uniform(150, 250)),
+            'error_rate': float(rng.uniform(0.05, 0.2)), 'user_agent': USER_AGENTS[int(rng.integers(0, 3))],
+            'platform': 'Linux armv8l'}
+
+
+def _with_properties(records, properties, component):
+    """
+    Adds the properties of jsPsych.data.addProperties and the trial index of jsPsych to every record
+    """
+    return [{**record, 'trial_index': index, **properties, 'component': component}
+            for index, record in enumerate(records)]
+
+
+def _hex_id(rng):
+    return ''.join(rng.choice(list('0123456789abcdef'), 24))
@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+import loading_data as loader
+
+
+def example_data():
+    return pd.DataFrame({'prolific_id': ['a', 'a', 'b', 'c'],
+                         'session_number': [2, np.nan, np.nan, 1],
+                         'trialID': [185, 185, 8, 3],
+                         'success': [1, 1, 1, 1],
+                         'session_id': ['s1', 's1', 's2', 's3']})
+
+
+def test_set_only_where_all_conditions_hold():
+    rules = [{'name': 'set', 'type': 'set', 'where': {'prolific_id': 'a', 'session_number': 2},
+              'values': {'session_id': 'fixed'}}]
+    corrected = loader.apply_correction_rules(example_data(), rules)
+    assert corrected['session_id'].tolist() == ['fixed', 's1', 's2', 's3']
+
+
+def test_fill_by_lookup_fills_missing_values_with_known_keys():
+    rules = [{'name': 'fill', 'type': 'fill_by_lookup', 'column': 'session_number', 'key': 'trialID',
+              'where': {'session_number': None, 'success': 1}, 'lookup': [[185, 3]]}]
+    corrected = loader.apply_correction_rules(example_data(), rules)
+    np.testing.assert_array_equal(corrected['session_number'], [2, 3, np.nan, 1])
+
+
+def test_rules_see_the_values_written_by_earlier_rules():
+    rules = [{'name': 'fill', 'type': 'fill_by_lookup', 'column': 'session_number', 'key': 'trialID',
+              'where': {'session_number': None}, 'lookup': [[185, 3], [8, 4]]},
+             {'name': 'set', 'type': 'set', 'where': {'session_number': 3}, 'values': {'session_id': 'third'}},
+             {'name': 'unfilled', 'type': 'set', 'where': {'session_number': None}, 'values': {'session_id': 'none'}}]
+    corrected = loader.apply_correction_rules(example_data(), rules)
+    assert corrected['session_id'].tolist() == ['s1', 'third', 's2', 's3']
+
+
+def test_exclusions_are_applied_at_the_end():
+    rules = [{'name': 'exclude', 'type': 'exclude', 'column': 'prolific_id', 'values': ['a', 'x']},
+             {'name': 'set', 'type': 'set', 'where': {'prolific_id': 'a'}, 'values': {'session_id': 'set'}}]
+    corrected = loader.apply_correction_rules(example_data(), rules)
+    assert corrected['prolific_id'].tolist() == ['b', 'c']
+    assert corrected.index.tolist() == [2, 3]
+
+
+def test_conditions_on_missing_columns_match_no_rows():
+    rules = [{'name': 'set', 'type': 'set', 'where': {'not_a_column': 1}, 'values': {'session_id': 'set'}}]
+    corrected = loader.apply_correction_rules(example_data(), rules)
+    assert corrected['session_id'].tolist() == ['s1', 's1', 's2', 's3']
+
+
+def test_unknown_rule_types_are_rejected(tmp_path):
+    rules_file = tmp_path / 'rules.json'
+    rules_file.write_text(json.dumps([{'name': 'rename', 'type': 'rename'}]))
+    with pytest.raises(ValueError, match='rename'):
+        loader.load_correction_rules(rules_file)
+
+
+def test_shipped_rules_file():
+    rules = loader.load_correction_rules(loader.CORRECTION_RULES_FILE)
+    assert {rule['type'] for rule in rules} <= set(loader.CORRECTION_RULE_TYPES)
+    data = pd.DataFrame({'prolific_id': ['5ae0b548e0feeb0001cafc45', '6129dc084c55f609fd62f0bc', 'other'],
+                         'session_number': [2, 1, np.nan], 'trialID': [1, 1, 185], 'success': [1, 1, 1],
+                         'trial_type': ['canvas-mi-serial'] * 3, 'session_id': ['x', 'y', 'z'],
+                         'study_id': ['x', 'y', 'z']})
+    corrected = loader.manual_file_correction(data)
+    assert corrected['prolific_id'].tolist() == ['5ae0b548e0feeb0001cafc45', 'other']
+    assert corrected['session_id'].tolist() == ['621fb3bfd880d8d0e1fd44ae', 'z']
+    assert corrected['session_number'].tolist() == [2, 3]
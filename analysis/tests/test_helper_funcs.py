@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import helper_funcs as helper
+
+
+@pytest.mark.parametrize('seed, alpha', [(0, 1 / 50), (1, 1 / 20), (2, 1 / 5)])
+def test_recursive_causal_rate_matches_the_reference(seed, alpha):
+    rng = np.random.default_rng(seed)
+    # onsets before, inside and after the scale, some of them on the same millisecond
+    move_onset = np.concatenate([rng.uniform(-1500, 2500, 400), np.round(rng.uniform(-100, 500, 50))])
+    for n_trials in [40, rng.integers(1, 60, 3000).astype(float)]:
+        rate, scale = helper.causal_rate(move_onset, 1000, 2000, n_trials, alpha)
+        reference, reference_scale = helper.causal_rate(move_onset, 1000, 2000, n_trials, alpha, method='reference')
+        np.testing.assert_array_equal(scale, reference_scale)
+        np.testing.assert_allclose(rate, reference, rtol=1e-9, atol=1e-12)
+
+
+def test_causal_rate_without_onsets():
+    rate = helper.causal_rate(np.array([]), 100, 200, 10)[0]
+    assert rate == helper.causal_rate(np.array([]), 100, 200, 10, method='reference')[0] == [0.0] * 300
+
+
+def trials_per_window_histogram(window_starts, window_ends, scale):
+    # the histogram that trials_per_window replaced
+    trial_windows = [np.arange(round(start), round(end), 1) for start, end in zip(window_starts, window_ends)]
+    distribution, _ = np.histogram(np.concatenate(trial_windows), bins=np.append(scale, scale[-1] + 1))
+    return distribution
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_trials_per_window_matches_the_histogram(seed):
+    rng = np.random.default_rng(seed)
+    scale = np.arange(-1000, 2000, 1)
+    # windows inside, across and outside the scale, empty and reversed windows, and halves that round to even
+    window_starts = np.concatenate([rng.uniform(-3000, 1000, 300), [-1000.5, 1999, 2500, 10.0, 20.5]])
+    window_ends = np.concatenate([window_starts[:300] + rng.uniform(0, 3000, 300), [0.5, 2000, 3000, 5.0, 21.5]])
+    expected = trials_per_window_histogram(window_starts, window_ends, scale)
+    np.testing.assert_array_equal(helper.trials_per_window(window_starts, window_ends, scale), expected)
+
+    # one row per group, and weights count a trial as often as it is repeated
+    groups = rng.integers(0, 4, len(window_starts))
+    counts = helper.trials_per_window(window_starts, window_ends, scale, groups, n_groups=4)
+    for group in range(4):
+        np.testing.assert_array_equal(counts[group], trials_per_window_histogram(
+            window_starts[groups == group], window_ends[groups == group], scale))
+    weights = rng.integers(0, 3, len(window_starts))
+    np.testing.assert_array_equal(
+        helper.trials_per_window(window_starts, window_ends, scale, weights=weights),
+        trials_per_window_histogram(np.repeat(window_starts, weights), np.repeat(window_ends, weights), scale))
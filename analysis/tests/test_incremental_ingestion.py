@@ -0,0 +1,104 @@
+import os
+import pandas as pd
+import pytest
+import shutil
+
+import data_cache
+import loading_data as loader
+import synthetic_data
+
+
+@pytest.fixture
+def export(tmp_path):
+    return synthetic_data.write_jatos_export(str(tmp_path), n_subjects=4, n_trials=10, seed=1,
+                                             incomplete_fraction=0.5)
+
+
+def sorted_rows(data):
+    # appended rows come after the rows of the first ingestion, sorted by their text
+    columns = sorted(data.columns)
+    return data[columns].astype(str).sort_values(columns).reset_index(drop=True)
+
+
+def test_appended_offset(tmp_path):
+    file = tmp_path / 'results.txt'
+    file.write_text('first line\n')
+    entry = {'offset': file.stat().st_size, 'digest': data_cache.file_digest(file)}
+    with open(file, 'a') as f:
+        f.write('second line\n')
+    assert data_cache.appended_offset(file, entry) == entry['offset']
+    file.write_text('First line\nsecond line\n')
+    assert data_cache.appended_offset(file, entry) is None
+    file.write_text('first')
+    assert data_cache.appended_offset(file, entry) is None
+
+
+@pytest.mark.parametrize('optimize_memory', [False, True])
+def test_cached_data_is_identical_to_the_built_data(export, optimize_memory):
+    built = loader.load_all_data(export, optimize_memory=optimize_memory)
+    cached = loader.load_all_data(export, optimize_memory=optimize_memory)
+    assert data_cache.read_manifest(data_cache.cache_paths(export)[1])['parts'][0]['dtypes']['subject'] == 'object'
+    pd.testing.assert_frame_equal(cached, built)
+    # missing cells of list and json columns are nan (not None), as in the built data
+    assert cached['touchOn'].isna().sum() > 0
+    for column in ['touchOn', 'response', 'survey_response']:
+        assert cached[column].astype(str).tolist() == built[column].astype(str).tolist()
+        assert all(isinstance(cell, float) for cell in cached.loc[cached[column].isna(), column])
+
+
+def test_appended_data_is_ingested_like_a_full_rebuild(export):
+    with open(export['source']) as f:
+        lines = f.readlines()
+    with open(export['source'], 'w') as f:
+        f.writelines(lines[:-2])
+    incomplete_files = sorted(os.listdir(export['incomplete']))
+    held_back = os.path.join(os.path.dirname(export['incomplete']), incomplete_files[-1])
+    shutil.move(os.path.join(export['incomplete'], incomplete_files[-1]), held_back)
+    first = loader.load_all_data(export, incremental=True, optimize_memory=False)
+
+    with open(export['source'], 'a') as f:
+        f.writelines(lines[-2:])
+    shutil.move(held_back, export['incomplete'])
+    appended = loader.load_all_data(export, incremental=True, optimize_memory=False)
+    rebuilt = loader.load_all_data(export, use_cache=False, optimize_memory=False)
+
+    assert len(first) < len(appended)
+    pd.testing.assert_frame_equal(sorted_rows(appended), sorted_rows(rebuilt))
+    assert len(pd.read_csv(export['out_file'])) == len(rebuilt)
+    manifest = data_cache.read_manifest(data_cache.cache_paths(export)[1])
+    assert manifest['ledger']['source']['offset'] == os.path.getsize(export['source'])
+    assert sorted(manifest['ledger']['incomplete']) == incomplete_files
+
+
+def test_changed_ingested_data_is_rebuilt(export):
+    loader.load_all_data(export, incremental=True, optimize_memory=False)
+    with open(export['source']) as f:
+        lines = f.readlines()
+    # a changed line in the already ingested part of the file
+    with open(export['source'], 'w') as f:
+        f.writelines(lines[1:] + lines[:1])
+    reloaded = loader.load_all_data(export, incremental=True, optimize_memory=False)
+    rebuilt = loader.load_all_data(export, use_cache=False, optimize_memory=False)
+    pd.testing.assert_frame_equal(reloaded.reset_index(drop=True), rebuilt.reset_index(drop=True))
+
+
+def test_data_digest_tells_appended_from_rebuilt_data(export):
+    with open(export['source']) as f:
+        lines = f.readlines()
+    with open(export['source'], 'w') as f:
+        f.writelines(lines[:-2])
+    loader.load_all_data(export, incremental=True)
+    with open(export['source'], 'a') as f:
+        f.writelines(lines[-2:])
+    loader.load_all_data(export, incremental=True)
+    appended = loader.data_digest(export)
+    assert loader.data_digest(export) == appended
+
+    # the same inputs, rebuilt into a single part with other row order
+    manifest_file = data_cache.cache_paths(export)[1]
+    os.remove(manifest_file)
+    loader.load_all_data(export)
+    assert len(data_cache.read_manifest(manifest_file)['parts']) == 1
+    rebuilt = loader.data_digest(export)
+    assert rebuilt != appended
+    assert loader.data_digest(export, use_cache=False) not in [appended, rebuilt]
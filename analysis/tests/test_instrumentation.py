@@ -0,0 +1,34 @@
+import pytest
+
+import instrumentation
+
+
+@instrumentation.instrumented('stage')
+def stage(value):
+    return value
+
+
+@pytest.fixture
+def enabled():
+    instrumentation.records.clear()
+    instrumentation.enable()
+    yield instrumentation.records
+    instrumentation.disable()
+    instrumentation.records.clear()
+
+
+def test_stages_are_recorded(enabled):
+    assert stage(3) == 3
+    assert enabled[0]['stage'] == 'stage' and enabled[0]['error'] is None
+    assert enabled[0]['wall_time'] >= 0 and enabled[0]['memory_growth_mb'] >= 0
+
+
+def test_stages_are_recorded_when_memory_sampling_fails(enabled, monkeypatch):
+    def fail(memory):
+        raise OSError('no memory sampling')
+    monkeypatch.setattr(instrumentation.PeakMemory, '__enter__', fail)
+    with pytest.raises(OSError):
+        stage(3)
+    assert enabled[0]['error'] == "OSError('no memory sampling')"
+    assert enabled[0]['wall_time'] >= 0 and enabled[0]['cpu_time'] >= 0
+    assert instrumentation.summary().loc['stage', 'calls'] == 1
@@ -0,0 +1,200 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import helper_funcs as helper
+import loading_data as loader
+import preprocessing
+import synthetic_data
+
+from test_ragged import align_to_multiple_values_filter_first_loop
+
+
+def align_columns_to_value_loop(trial_data, col_list, value_col):
+    # the per-trial alignment that align_columns_to_value replaced
+    for col in col_list:
+        name = f"{col}_to_{value_col}"
+        try:
+            trial_data[name] = trial_data[col] - trial_data[value_col]
+        except (TypeError, ValueError):
+            trial_data[name] = [np.array(trial_data[col][x]) - trial_data[value_col][x] for x in trial_data.index]
+    return trial_data
+
+
+def perform_time_alignments_loop(trial_data):
+    # the per-trial loops that perform_time_alignments replaced
+    trial_data['trialOnTime'] = [trial_data['animation_timestamps'][x][0] for x in trial_data.index]
+    trial_data['flashOnTime'] += trial_data['startTime']
+    trial_data['flashOffTime'] += trial_data['startTime']
+    trial_data['trialEndTime'] = trial_data['startTime'] + 1500
+    trial_data = align_columns_to_value_loop(trial_data, ['trialOnTime', 'startTime', 'flashOnTime', 'flashOffTime',
+                                                          'endTime', 'trialEndTime', 'touchOnTime', 'touchOffTime'],
+                                             'trialOnTime')
+    trial_data.rename(columns={'flashOnTime_to_trialOnTime': 'flashOnTime_aligned'}, inplace=True)
+    trial_data = align_columns_to_value_loop(trial_data, ['trialOnTime_to_trialOnTime', 'startTime_to_trialOnTime',
+                                                          'flashOnTime_aligned', 'flashOffTime_to_trialOnTime',
+                                                          'endTime_to_trialOnTime', 'trialEndTime_to_trialOnTime',
+                                                          'touchOnTime_to_trialOnTime', 'touchOffTime_to_trialOnTime'],
+                                             'flashOnTime_aligned')
+    for col in ['touchOnTime', 'touchOffTime']:
+        trial_data[f'animation_timestamps_to_{col}'] = align_to_multiple_values_filter_first_loop(
+            trial_data, 'animation_timestamps', col)
+    onsets = trial_data['touchOnTime'].copy()
+    first_onsets = [x[0] for x in onsets]
+    trial_data['aligned_touchOn'] = [np.array(onsets.values[x]) - first_onsets[x] for x in range(len(first_onsets))]
+    time_to_last_interaction = []
+    for idx in trial_data.index:
+        distances = trial_data.loc[idx, 'touchOnTime'] - trial_data.loc[idx, 'flashOnTime']
+        time_to_last_interaction.append(max(distances[distances < 0], default=np.nan))
+    trial_data['interaction_to_change_distance'] = time_to_last_interaction
+    return trial_data
+
+
+def get_position_at_response_time_loop(data, start_position_col, shift_position_col, response_time_col,
+                                      change_time_col):
+    # the per-trial loop that positions_at_response_time replaced
+    pos_at_touch = []
+    for idx in data.index:
+        touch_on = data[response_time_col][idx]
+        change_on = data[change_time_col][idx]
+        pos_before = data[start_position_col][idx]
+        pos_after = data[shift_position_col][idx]
+        if len(touch_on) < len(pos_before):
+            pos_before = pos_before[:len(touch_on)]
+            pos_after = pos_after[:len(touch_on)]
+        elif len(touch_on) > len(pos_before):
+            touch_on = touch_on[:len(pos_before)]
+        mask_before = touch_on <= change_on
+        masked_positions = np.concatenate([np.array(pos_before)[mask_before],
+                                           np.array(pos_after)[np.where(mask_before == False)]])  # noqa: E712
+        pos_at_touch.append(masked_positions.tolist())
+    return pos_at_touch
+
+
+def subtract_arrays_missing_values_loop(array_a, array_b):
+    # the per-trial truncation that subtract_ragged_missing_values replaced
+    array_a, array_b = np.asarray(array_a), np.asarray(array_b)
+    try:
+        return array_a - array_b
+    except ValueError:
+        if len(array_a) > len(array_b):
+            return array_a[:len(array_b)] - array_b
+        return array_a - array_b[:len(array_a)]
+
+
+def angle_loop(x, y):
+    # the scalar cart2pol that the angles were computed with
+    theta_rad = np.arctan2(y, x)
+    if theta_rad < 0:
+        theta_rad += 2 * np.pi
+    return theta_rad * (180 / np.pi)
+
+
+def perform_space_alignments_loop(trial_data, ppdva):
+    # the per-trial loops that perform_space_alignments replaced
+    for axis in ['x', 'y']:
+        trial_data[f'position_{axis}_at_touch'] = get_position_at_response_time_loop(
+            trial_data, f'position_{axis}', f'shifted_position_{axis}', 'aligned_touchOn', 'eventOnTime')
+    for axis, size_col in [('x', 'windowWidth'), ('y', 'windowHeight')]:
+        center = trial_data[size_col] / 2
+        trial_data[f'touch_{axis}_to_center'] = [np.asarray(trial_data[f'touch{axis.upper()}'][x]) - center[x]
+                                                 for x in trial_data.index]
+        trial_data[f'pos_{axis}_touch_{axis}_dist'] = [
+            subtract_arrays_missing_values_loop(trial_data[f'touch_{axis}_to_center'][x],
+                                                trial_data[f'position_{axis}_at_touch'][x])
+            for x in trial_data.index]
+    trial_data['px2dva'] = trial_data['session_id'].astype(object).replace(ppdva)
+    for col in ['touch_x_to_center', 'touch_y_to_center', 'pos_x_touch_x_dist', 'pos_y_touch_y_dist']:
+        trial_data[f'{col}_dva'] = [trial_data[col][x] / trial_data.px2dva[x] for x in trial_data.index]
+    trial_data['vector_touch_distance_dva'] = [np.sqrt(trial_data.pos_x_touch_x_dist_dva[x] ** 2 +
+                                                       trial_data.pos_y_touch_y_dist_dva[x] ** 2)
+                                               for x in trial_data.index]
+    trial_data['touch_deviation_angle'] = [[angle_loop(x, y) for x, y in zip(trial_data['pos_x_touch_x_dist_dva'][i],
+                                                                              trial_data['pos_y_touch_y_dist_dva'][i])]
+                                           for i in trial_data.index]
+    return trial_data
+
+
+def assert_columns_equal(result, expected, columns):
+    assert result.index.equals(expected.index)
+    for col in columns:
+        if isinstance(expected[col].iloc[0], (list, np.ndarray)):
+            for cell, expected_cell in zip(result[col], expected[col]):
+                np.testing.assert_allclose(np.asarray(cell, dtype=float), np.asarray(expected_cell, dtype=float),
+                                           rtol=0, atol=1e-9, err_msg=col)
+        else:
+            np.testing.assert_allclose(result[col].to_numpy(dtype=float), expected[col].to_numpy(dtype=float),
+                                       rtol=0, atol=1e-9, err_msg=col)
+
+
+@pytest.fixture(scope='module')
+def parts(tmp_path_factory):
+    """
+    The parts of a synthetic data set (with late responses and too many touches)
+    """
+    path_names = synthetic_data.write_jatos_export(str(tmp_path_factory.mktemp('export')), n_subjects=3,
+                                                   n_trials=60, seed=5)
+    return preprocessing.read_and_split(loader.load_all_data(path_names))
+
+
+@pytest.fixture(scope='module')
+def formatted(parts):
+    return preprocessing.ensure_formats(parts[3])
+
+
+def test_time_alignments_match_the_loops(formatted):
+    expected = perform_time_alignments_loop(formatted.copy())
+    result = preprocessing.perform_time_alignments(formatted.copy())
+    assert set(expected.columns) <= set(result.columns)
+    new_columns = [col for col in expected.columns if col not in formatted.columns]
+    assert_columns_equal(result, expected, ['flashOnTime', 'flashOffTime'] + new_columns)
+
+
+def test_space_alignments_match_the_loops(parts, formatted):
+    time_aligned = preprocessing.perform_time_alignments(formatted.copy())
+    ppdva = preprocessing.get_session_ppdva(preprocessing.get_calibration_params(parts[0]))
+    expected = perform_space_alignments_loop(time_aligned.copy(), ppdva)
+    result = preprocessing.perform_space_alignments(time_aligned.copy(), ppdva)
+    assert set(expected.columns) == set(result.columns)
+    assert_columns_equal(result, expected, [col for col in expected.columns if col not in time_aligned.columns])
+
+
+def transform_long_dataset_stacked(wide_data, columns):
+    # the stacking of 6-dot trials that transform_long_dataset replaced
+    long_df = pd.DataFrame()
+    for col in columns:
+        first_entry_test = wide_data[col].iloc[0]
+        if isinstance(first_entry_test, (list, np.ndarray)):
+            if len(first_entry_test) == 6:
+                long_df[col] = helper.get_long_column(wide_data, col)
+        else:
+            long_df[col] = helper.stack_unique_cols(wide_data, col, 6)
+    return long_df
+
+
+def test_long_format_matches_the_stacked_columns(parts, formatted):
+    ppdva = preprocessing.get_session_ppdva(preprocessing.get_calibration_params(parts[0]))
+    trial_data = preprocessing.perform_space_alignments(preprocessing.perform_time_alignments(formatted.copy()), ppdva)
+    successful_trials = trial_data[trial_data.success == 1]
+    expected = transform_long_dataset_stacked(successful_trials, preprocessing.LONG_DF_COLS)
+    result = preprocessing.successful_trials_long_format(trial_data)
+    assert list(result.columns) == preprocessing.LONG_DF_COLS + ['dot_index']
+    assert len(result) == len(expected) == 6 * len(successful_trials)
+    for col in preprocessing.LONG_DF_COLS:
+        if pd.api.types.is_numeric_dtype(expected[col]):
+            np.testing.assert_allclose(result[col].to_numpy(dtype=float), expected[col].to_numpy(dtype=float),
+                                       rtol=0, atol=1e-9, err_msg=col)
+        else:
+            assert result[col].astype(object).tolist() == expected[col].astype(object).tolist(), col
+    np.testing.assert_array_equal(result['dot_index'], np.tile(np.arange(6), len(successful_trials)))
+
+
+def test_long_format_of_lists_with_different_lengths():
+    wide_data = pd.DataFrame({'subject': pd.Categorical(['a', 'b']), 'touches': [[1.0, 2.0, 3.0], [4.0]],
+                              'order': [[0, 1], [0, 1, 2]]}, index=[5, 7])
+    long_data = preprocessing.transform_long_dataset(wide_data, ['subject', 'touches', 'order'])
+    assert long_data['subject'].tolist() == ['a'] * 3 + ['b'] * 3
+    assert isinstance(long_data['subject'].dtype, pd.CategoricalDtype)
+    np.testing.assert_array_equal(long_data['touches'], [1.0, 2.0, 3.0, 4.0, np.nan, np.nan])
+    np.testing.assert_array_equal(long_data['order'], [0, 1, np.nan, 0, 1, 2])
+    assert long_data['dot_index'].tolist() == [0, 1, 2, 0, 1, 2]
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import helper_funcs as helper
+import ragged
+
+
+def align_to_multiple_values_filter_first_loop(data, column, multi_value_column):
+    # the per-trial loop that align_to_multiple_values_filter_first replaced
+    aligned_list = []
+    for idx in data.index:
+        index_list = []
+        for value in data.loc[idx, multi_value_column]:
+            aligned_values = np.array([x - value for x in data.loc[idx, column]])
+            aligned_values = aligned_values[aligned_values >= 0]
+            if aligned_values.size:
+                index_list.append(min(aligned_values))
+        aligned_list.append(index_list)
+    return aligned_list
+
+
+def random_trials(rng, n_trials):
+    frames, touches = [], []
+    for _ in range(n_trials):
+        start = rng.uniform(0, 1e6)
+        frames.append((start + np.cumsum(rng.uniform(5, 20, rng.integers(0, 30)))).tolist())
+        touches.append((start + rng.uniform(-50, 400, rng.integers(0, 6))).tolist())
+    return frames, touches
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_distance_to_next_frame_matches_the_loop(seed):
+    frames, touches = random_trials(np.random.default_rng(seed), 200)
+    # empty reference and empty query trials, and touches at a frame
+    frames[:3] = [[], [], [10.0, 20.0]]
+    touches[:3] = [[1.0, 2.0], [], [10.0, 20.0, 20.5]]
+    data = pd.DataFrame({'f': frames, 't': touches}, index=np.arange(200) * 2)
+    expected = align_to_multiple_values_filter_first_loop(data, 'f', 't')
+    aligned = helper.align_to_multiple_values_filter_first(data, 'f', 't')['f_to_t']
+    assert len(aligned) == len(expected)
+    for result, reference in zip(aligned, expected):
+        np.testing.assert_allclose(result, reference, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('frames, touches', [([[]], [[1.0, 2.0]]), ([[], []], [[], [3.0]]), ([[1.0]], [[]])])
+def test_distance_to_next_without_results(frames, touches):
+    distances = ragged.distance_to_next(ragged.RaggedArray.from_lists(frames), ragged.RaggedArray.from_lists(touches))
+    assert distances.to_lists() == align_to_multiple_values_filter_first_loop(
+        pd.DataFrame({'f': frames, 't': touches}), 'f', 't')
+    assert distances.offsets.tolist() == [0] * (len(touches) + 1)
+
+
+def test_ragged_array_round_trip():
+    lists = [[1.5, 2.5], [], [3.0]]
+    decoded = ragged.RaggedArray.from_json_strings(['[1.5, 2.5]', [], '[3]'])
+    assert decoded.to_lists() == lists
+    assert ragged.RaggedArray.from_lists([np.array(cell) for cell in lists]).to_lists() == lists
+    np.testing.assert_array_equal(decoded.first(), [1.5, np.nan, 3.0])
+    assert decoded.take([2, 0]).to_lists() == [[3.0], [1.5, 2.5]]
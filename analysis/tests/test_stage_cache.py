@@ -0,0 +1,107 @@
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+import stage_cache
+
+calls = []
+
+
+def make_frame(source, rows=3):
+    calls.append('make_frame')
+    return pd.DataFrame({'value': np.arange(rows, dtype=float) + source,
+                         'touches': [[1.5, 2.5], [], [3.0]][:rows],
+                         'aligned': [np.array([0.5]), np.array([]), np.array([1.0, 2.0])][:rows],
+                         'order': [[2, 0], [1], []][:rows]}, index=[10, 20, 30][:rows])
+
+
+def double(data):
+    calls.append('double')
+    return data.assign(value=2 * data['value'])
+
+
+def double_differently(data):
+    calls.append('double')
+    return data.assign(value=data['value'] + data['value'])
+
+
+def fail(data):
+    raise ValueError('stage failed')
+
+
+def run(cache, rows=3, second=double, source=1):
+    stages = [stage_cache.Stage('frame', make_frame, ['source'], {'rows': rows}),
+              stage_cache.Stage('double', second, ['frame'])]
+    return stage_cache.run_stages(stages, {'source': (source, str(source))}, cache)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    calls.clear()
+    return stage_cache.StageCache(str(tmp_path / 'stages'))
+
+
+def test_cached_results_are_loaded_with_lists_index_and_types(cache):
+    computed = run(cache)
+    loaded = run(cache)
+    assert calls == ['make_frame', 'double']
+    for name in ['frame', 'double']:
+        pd.testing.assert_frame_equal(loaded[name], computed[name])
+    assert loaded['frame']['order'].tolist() == [[2, 0], [1], []]
+    assert isinstance(loaded['frame']['order'].iloc[0][0], int)
+    assert isinstance(loaded['frame']['aligned'].iloc[0], np.ndarray)
+    assert isinstance(loaded['frame']['touches'].iloc[0], list)
+
+
+def test_changes_of_parameters_sources_and_code_invalidate_dependent_stages(cache):
+    run(cache)
+    calls.clear()
+    run(cache, rows=2)
+    assert calls == ['make_frame', 'double']
+    calls.clear()
+    run(cache, source=2)
+    assert calls == ['make_frame', 'double']
+    calls.clear()
+    run(cache, second=double_differently)
+    assert calls == ['double']
+
+
+def test_missing_files_are_recomputed(cache):
+    run(cache)
+    for key, entry in cache.index.items():
+        if entry['stage'] == 'frame':
+            os.remove(os.path.join(cache.directory, key, 'frame0.parquet'))
+    calls.clear()
+    results = run(cache)
+    assert calls == ['make_frame']
+    assert results['frame']['value'].tolist() == [1.0, 2.0, 3.0]
+    calls.clear()
+    run(cache)
+    assert calls == []
+
+
+def test_failing_stages_are_not_cached(cache):
+    with pytest.raises(ValueError, match='stage failed'):
+        run(cache, second=fail)
+    assert [entry['stage'] for entry in cache.index.values()] == ['frame']
+    assert len(stage_cache.StageCache(cache.directory).index) == 1
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    run(cache, source=1)
+    run(cache, source=2)
+    oldest = next(iter(cache.index))
+    cache.index[oldest]['last_used'] = 0
+    total = sum(entry['size'] for entry in cache.index.values())
+    cache.max_size_mb = (total - cache.index[oldest]['size'] / 2) / 2 ** 20
+    cache.evict()
+    assert oldest not in cache
+    assert not os.path.exists(os.path.join(cache.directory, oldest))
+    assert len(cache.index) == 3
+
+
+def test_frames_without_rows(cache):
+    empty = make_frame(1).iloc[:0]
+    cache.save('empty', 'frame', empty)
+    pd.testing.assert_frame_equal(cache.load('empty'), empty, check_index_type=False)
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import loading_data as loader
+import preprocessing
+import subject_level_stats as stats
+import synthetic_data
+
+PARAMETERS = {'alpha': 1 / 50, 'minimum_n_cutoff': 20, 'time_window_for_baseline': -100, 'window_start': 1000,
+              'window_end': 2000, 'metrics_search_start': 0, 'metrics_search_end': 500}
+
+
+@pytest.fixture(scope='module')
+def loaded(tmp_path_factory):
+    """
+    A synthetic data set as returned by load_all_data (list cells, some trials without flash onset),
+    and its preprocessed trial data
+    """
+    path_names = synthetic_data.write_jatos_export(str(tmp_path_factory.mktemp('export')), n_subjects=4,
+                                                   n_trials=60, seed=3)
+    data = loader.load_all_data(path_names)
+    trial_data = preprocessing.preprocessing_pipeline(data=data)[3]
+    return data, trial_data
+
+
+def test_error_size_on_loaded_data(loaded):
+    data, trial_data = loaded
+    for prolific_id in data.prolific_id.unique():
+        subject = stats.OneSubjectErrorSize(prolific_id, data, trial_data)
+        subject.run_error_pipeline()
+        errors = subject.error_frame()
+        assert len(errors) == 4 * len(subject.scale)
+        assert np.isfinite(subject.baseline)
+        assert subject.trial_data['eventOn_float'].notna().all()
+
+
+def test_inhibition_runner_with_loaded_data(loaded):
+    data, trial_data = loaded
+    successful_trials = trial_data[trial_data.success == 1]
+    rates, metrics, errors = stats.run_inhibition_subjects(successful_trials, PARAMETERS, data=data)
+    assert errors.empty
+    assert sorted(metrics['prolific_id'].unique()) == sorted(successful_trials['prolific_id'].unique())
+    without_data = stats.run_inhibition_subjects(successful_trials, PARAMETERS)[1]
+    np.testing.assert_array_equal(metrics.select_dtypes('number'), without_data.select_dtypes('number'))
+
+
+@pytest.mark.parametrize('mask_rate, normalization', [(True, 'per_window'), (False, 'per_window'), (True, 'uniform')])
+def test_batched_rate_pipeline_matches_the_per_condition_pipeline(loaded, mask_rate, normalization):
+    trial_data = loaded[1]
+    successful_trials = trial_data[trial_data.success == 1]
+    for prolific_id, subject_trials in successful_trials.groupby('prolific_id', observed=True):
+        subjects = {}
+        for batched in [True, False]:
+            subjects[batched] = stats.OneSubjectInhibition(prolific_id, PARAMETERS)
+            subjects[batched].preprocessed_trial_data = subject_trials
+            subjects[batched].run_rate_pipeline(mask_rate=mask_rate, normalization=normalization, batched=batched)
+        batched, per_condition = subjects[True], subjects[False]
+        assert batched.n_trials == per_condition.n_trials
+        for name in per_condition.rates:
+            np.testing.assert_array_equal(batched.onsets[name], per_condition.onsets[name])
+            np.testing.assert_array_equal(batched.n_trials_per_window[name], per_condition.n_trials_per_window[name])
+            np.testing.assert_allclose(batched.rates[name], per_condition.rates[name], rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(batched.normalized_baseline_rates[name],
+                                       per_condition.normalized_baseline_rates[name], rtol=1e-9, atol=1e-12)
+
+
+def metrics_per_curve(subject, data):
+    # the per-curve metric frames that run_metrics_pipeline replaced (curves without a minimum get a nan latency)
+    rows = []
+    search = slice(subject.metrics_search_start[0], subject.metrics_search_end[0])
+    for key in data.keys():
+        metric_search_data = np.array(data[key])[search]
+        minimum = np.min(metric_search_data)
+        if np.any(metric_search_data == minimum):
+            latency = stats.get_latency(metric_search_data, np.array(subject.scale)[search], minimum)
+        else:
+            latency = np.nan
+        rows.append({'flashShown': int('no_flash' not in key), 'stimJumped': int('no_shift' not in key),
+                     'minimum': minimum, 'magnitude': 1 - minimum,
+                     'bottom': stats.get_bottom_of_dip(metric_search_data, minimum), 'latency': latency})
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('normalization', ['null_condition', 'baseline', 'none'])
+def test_stacked_metrics_match_the_per_curve_metrics(loaded, normalization):
+    trial_data = loaded[1]
+    # a low cutoff keeps most curves unmasked
+    parameters = {**PARAMETERS, 'minimum_n_cutoff': 1}
+    for prolific_id, subject_trials in trial_data.groupby('prolific_id', observed=True):
+        subject = stats.OneSubjectInhibition(prolific_id, parameters)
+        subject.preprocessed_trial_data = subject_trials
+        subject.run_rate_pipeline()
+        subject.normalize_to_null_condition('no_flash_no_shift')
+        subject.run_metrics_pipeline(normalization=normalization)
+        expected = metrics_per_curve(subject, {'null_condition': subject.normalized_null_condition_rates,
+                                               'baseline': subject.normalized_baseline_rates,
+                                               'none': subject.rates}[normalization])
+        np.testing.assert_array_equal(subject.metrics.to_numpy(dtype=float), expected.to_numpy(dtype=float))
+
+    # all subjects and conditions in one stack
+    rates, metrics, _ = stats.run_inhibition_subjects(trial_data, parameters, metrics_normalization=normalization)
+    column = {'null_condition': 'normalized_null_condition_rate', 'baseline': 'normalized_baseline_rate',
+              'none': 'rate'}[normalization]
+    stacked = stats.metrics_from_rates_frame(rates, 0, 500, column)
+    merged = metrics.merge(stacked, on=['prolific_id', 'condition'], suffixes=('', '_stacked'))
+    assert len(merged) == len(metrics)
+    for col in ['flashShown', 'stimJumped', 'minimum', 'magnitude', 'bottom', 'latency']:
+        np.testing.assert_array_equal(merged[col].to_numpy(dtype=float), merged[f'{col}_stacked'].to_numpy(dtype=float))
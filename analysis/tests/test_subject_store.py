@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from subject_store import SubjectStore
+
+
+@pytest.fixture
+def data():
+    # rows of three subjects in mixed order and two rows without prolific id
+    return pd.DataFrame({'prolific_id': ['b', 'a', np.nan, 'b', 'c', None, 'a'],
+                         'trial': np.arange(7, dtype=float), 'subject': [2, 1, 0, 2, 3, 0, 1],
+                         'session_number': np.array([1, 1, 1, 2, 1, 1, 2], dtype=object),
+                         'touchOnTime': [[1.5, 2.5], [], [3.0], [4.0], [5.0, 6.0], [7.0], [8.0]]},
+                        index=np.arange(7) * 10)
+
+
+def assert_partitions(store, data):
+    assert store.subjects == ['b', 'a', 'c']
+    for prolific_id in store.subjects:
+        partition = store.get(prolific_id)
+        expected = data[data.prolific_id == prolific_id]
+        assert partition.index.tolist() == expected.index.tolist()
+        assert partition['trial'].tolist() == expected['trial'].tolist()
+        assert partition['touchOnTime'].tolist() == expected['touchOnTime'].tolist()
+
+
+def test_partitions_in_memory_and_on_disk(data, tmp_path):
+    store = SubjectStore.from_frame(data)
+    assert_partitions(store, data)
+    assert 'a' in store and np.nan not in store
+    store.save(str(tmp_path / 'store'))
+    opened = SubjectStore.open(str(tmp_path / 'store'))
+    assert opened.loaded == {}
+    assert_partitions(opened, data)
+    for prolific_id in store.subjects:
+        pd.testing.assert_frame_equal(opened.get(prolific_id), store.get(prolific_id))
+
+
+def test_unknown_subjects_are_empty_frames_with_the_columns(data, tmp_path):
+    store = SubjectStore.from_frame(data)
+    store.save(str(tmp_path / 'store'))
+    for source in [store, SubjectStore.open(str(tmp_path / 'store'))]:
+        partition = source.get('unknown')
+        assert partition.empty
+        assert list(partition.columns) == list(data.columns)